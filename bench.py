@@ -0,0 +1,635 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import bencoding
+
+from file_saver import FileSaver
+from framer import MessageFramer
+from peer import PROTOCOL, Peer
+from pytor import DownloadSession
+from ratelimit import TokenBucket
+from swarm import Swarm
+from torrent import Torrent
+
+MiB = 1024 * 1024
+
+# Torrent shapes: number of files, total length and piece length, before scaling
+SHAPES = {
+    'single': (1, 64 * MiB, 256 * 1024),
+    'many-small': (1024, 32 * MiB, 64 * 1024),
+    'huge-pieces': (1, 128 * MiB, 16 * MiB),
+}
+
+# Seeder behaviours: latency added to every message in seconds, upload rate of each seeder in bytes per second,
+# probability of corrupting a block and probability of dropping the connection on a request
+PROFILES = {
+    'clean': dict(latency=0, rate=0, corrupt_rate=0, drop_rate=0),
+    'wan': dict(latency=0.05, rate=4 * MiB, corrupt_rate=0, drop_rate=0),
+    'faulty': dict(latency=0.02, rate=0, corrupt_rate=0.0002, drop_rate=0.0005),
+}
+
+
+class SyntheticTorrent:
+    """
+    Random payload cut into files and pieces, with the metainfo describing it
+    The payload stays in memory for the seeders, the announce URL is only filled in when the torrent file is
+    written so every run can point at its own tracker without hashing the payload again
+    """
+    def __init__(self, name: str, files: int, total_length: int, piece_length: int):
+        self.name = name
+        self.piece_length = piece_length
+        self.payload = os.urandom(total_length)
+
+        # File lengths vary around their average, like real content does
+        rand = random.Random(total_length)
+        weights = [rand.uniform(0.1, 1.9) for _ in range(files)]
+        self.lengths = [int(total_length * weight / sum(weights)) for weight in weights]
+        self.lengths[-1] += total_length - sum(self.lengths)
+
+        pieces = b''.join(
+            hashlib.sha1(self.payload[offset:offset + piece_length]).digest()
+            for offset in range(0, total_length, piece_length)
+        )
+        self.info = {b'name': name.encode(), b'piece length': piece_length, b'pieces': pieces}
+        if files == 1:
+            self.info[b'length'] = total_length
+            self.paths = [name]
+        else:
+            self.info[b'files'] = [
+                {b'length': length, b'path': [b'dir%d' % (index // 100), b'file%d.bin' % index]}
+                for index, length in enumerate(self.lengths)
+            ]
+            self.paths = [
+                os.path.join(name, 'dir%d' % (index // 100), 'file%d.bin' % index) for index in range(files)
+            ]
+        self.info_hash = hashlib.sha1(bencoding.bencode(self.info)).digest()
+
+    def write(self, path: str, announce: str):
+        with open(path, 'wb') as f:
+            f.write(bencoding.bencode({b'announce': announce.encode(), b'info': self.info}))
+
+    def verify(self, outdir: str) -> bool:
+        """
+        True if the files downloaded to outdir hold the payload
+        """
+        offset = 0
+        for path, length in zip(self.paths, self.lengths):
+            try:
+                with open(os.path.join(outdir, path), 'rb') as f:
+                    if f.read() != self.payload[offset:offset + length]:
+                        return False
+            except OSError:
+                return False
+            offset += length
+        return True
+
+
+class FakeTracker:
+    """
+    Minimal HTTP tracker on the loopback interface, answering every announce with the same compact peer list
+    """
+    def __init__(self, peers: list):
+        self.peers = b''.join(struct.pack('>4sH', bytes([127, 0, 0, 1]), port) for _, port in peers)
+        self.announces = 0
+        self.queries = []  # Query string of every announce
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        """
+        Listens on a free port of the loopback interface
+        """
+        self.server = await asyncio.start_server(self.on_request, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    @property
+    def url(self) -> str:
+        """
+        Announce URL to write in the torrent
+        """
+        return 'http://127.0.0.1:{}/announce'.format(self.port)
+
+    async def on_request(self, reader, writer):
+        """
+        Answers an announce with the peer list and closes the connection
+        """
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except Exception:
+            writer.close()
+            return
+        self.announces += 1
+        self.queries.append(request.split(b' ', 2)[1].partition(b'?')[2].decode())
+        body = bencoding.bencode({b'interval': 1800, b'peers': self.peers})
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n'
+                     b'Connection: close\r\n\r\n' % len(body) + body)
+        await writer.drain()
+        writer.close()
+
+    async def close(self):
+        """
+        Stops listening
+        """
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class Seeder:
+    """
+    Local peer having every piece of a synthetic torrent, unchoking whoever is interested
+    Every message it sends is delayed by the latency, piece messages are metered by a token bucket shared by all
+    of its connections, and blocks are corrupted or connections dropped at the configured rates
+    """
+    def __init__(self, torrent: SyntheticTorrent, latency: float = 0, rate: int = 0, corrupt_rate: float = 0,
+                 drop_rate: float = 0):
+        self.torrent = torrent
+        self.payload = memoryview(torrent.payload)
+        self.number_of_pieces = len(torrent.info[b'pieces']) // 20
+        self.peer_id = b'-BENCH-' + os.urandom(13)
+        self.latency = latency
+        self.bucket = TokenBucket(rate)
+        self.corrupt_rate = corrupt_rate
+        self.drop_rate = drop_rate
+        self.server = None
+        self.port = None
+        self.uploaded = 0
+        self.corrupted = 0
+        self.dropped = 0
+
+    async def start(self):
+        """
+        Listens on a free port of the loopback interface
+        """
+        self.server = await asyncio.start_server(self.on_connection, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stops listening
+        """
+        self.server.close()
+        await self.server.wait_closed()
+
+    def bitfield(self) -> bytes:
+        """
+        Bitfield payload with every piece set and the spare bits of the last byte cleared
+        """
+        bitfield = bytearray(b'\xff' * ((self.number_of_pieces + 7) // 8))
+        spare = len(bitfield) * 8 - self.number_of_pieces
+        if spare:
+            bitfield[-1] = (0xff << spare) & 0xff
+        return bytes(bitfield)
+
+    async def send(self, writer, outbox: asyncio.Queue, pending: set):
+        """
+        Writes queued messages once their latency has passed, piece messages only if not cancelled meanwhile
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            due, key, chunks = await outbox.get()
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if key is not None:
+                if key not in pending:
+                    continue
+                pending.discard(key)
+                await self.bucket.consume(len(chunks[1]))
+                self.uploaded += len(chunks[1])
+            writer.writelines(chunks)
+            await writer.drain()
+
+    async def on_connection(self, reader, writer):
+        """
+        Serves a leecher: handshake and bitfield, unchoke once interested, then blocks for its requests
+        """
+        try:
+            handshake = await asyncio.wait_for(reader.readexactly(68), timeout=5)
+        except Exception:
+            writer.close()
+            return
+        if Peer.parse_handshake(handshake) != self.torrent.info_hash:
+            writer.close()
+            return
+
+        loop = asyncio.get_event_loop()
+        outbox = asyncio.Queue()
+        pending = set()  # (piece index, begin) requested and not sent nor cancelled yet
+
+        def post(*chunks, key=None):
+            """
+            Queues a message to be sent once the latency has passed
+            :param key: (piece index, begin) of a piece message, which is not sent if cancelled meanwhile
+            """
+            outbox.put_nowait((loop.time() + self.latency, key, chunks))
+
+        bitfield = self.bitfield()
+        post(struct.pack('>B19s8x20s20s', 19, PROTOCOL, self.torrent.info_hash, self.peer_id),
+             struct.pack('>Ib', 1 + len(bitfield), 5), bitfield)
+        sending = asyncio.ensure_future(self.send(writer, outbox, pending))
+        framer = MessageFramer()
+        piece_length = self.torrent.piece_length
+        try:
+            while not sending.done():
+                data = await reader.read(65536)
+                if not data:
+                    return
+                framer.feed(data)
+                for msg_id, payload in framer.messages():
+                    if msg_id == 2:
+                        post(struct.pack('>Ib', 1, 1))
+                    elif msg_id == 6:
+                        piece_idx, begin, length = struct.unpack('>III', payload)
+                        if random.random() < self.drop_rate:
+                            self.dropped += 1
+                            return
+                        offset = piece_idx * piece_length + begin
+                        block = self.payload[offset:offset + length]
+                        if random.random() < self.corrupt_rate:
+                            self.corrupted += 1
+                            block = bytearray(block)
+                            block[0] ^= 0xff
+                        pending.add((piece_idx, begin))
+                        post(struct.pack('>IbII', 9 + length, 7, piece_idx, begin), block, key=(piece_idx, begin))
+                    elif msg_id == 8:
+                        piece_idx, begin, _ = struct.unpack('>III', payload)
+                        pending.discard((piece_idx, begin))
+        except Exception as e:
+            print('[Seeder] Connection lost\n{}'.format(e))
+        finally:
+            sending.cancel()
+            writer.close()
+
+
+async def leech(torrent_file: str, outdir: str, timeout: float, workers: int = 0) -> dict:
+    """
+    Downloads a torrent into an empty directory and times its pieces hitting the disk
+    :param workers: download through the multi-process engine with that many workers, 0 for a single process
+    """
+    written = []  # Seconds from the start to every piece written
+
+    if workers:
+        from multiproc import Coordinator
+
+        coordinator = Coordinator(torrent_file, outdir, workers=workers, port=0)
+
+        def on_piece_written(piece_idx: int):
+            """
+            Times the piece on its way through the coordinator
+            """
+            Coordinator.on_piece_written(coordinator, piece_idx)
+            written.append(time.monotonic() - start)
+
+        coordinator.on_piece_written = on_piece_written
+        worker_peaks = {}
+        watching = asyncio.ensure_future(watch_workers(coordinator, worker_peaks))
+        start = time.monotonic()
+        try:
+            completed = await asyncio.wait_for(coordinator.run(), timeout)
+        except asyncio.TimeoutError:
+            completed = False
+        finally:
+            watching.cancel()
+        session = coordinator.session
+    else:
+        torrent = Torrent(torrent_file)
+        file_saver = FileSaver(outdir, torrent)
+        session = DownloadSession(torrent, file_saver.get_received_pieces_queue(), file_saver=file_saver)
+
+        def on_piece_written(piece_idx: int):
+            """
+            Times the piece on its way through the session
+            """
+            session.on_piece_written(piece_idx)
+            written.append(time.monotonic() - start)
+
+        file_saver.on_piece_written = on_piece_written
+        file_saver.on_piece_failed = session.on_piece_failed
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(Swarm(session, torrent).run(), timeout)
+            # Received is not written yet, the last pieces are still on their way to disk
+            while session.unwritten:
+                await asyncio.sleep(0.01)
+            # A piece which failed to be written is missing again
+            completed = session.is_complete()
+        except asyncio.TimeoutError:
+            completed = False
+        finally:
+            session.close()
+            file_saver.get_received_pieces_queue().put_nowait(None)
+            await file_saver.writing
+            file_saver.disk.close()
+
+    count = len(written)
+    result = {
+        'completed': completed,
+        'pieces_written': count,
+        'downloaded': session.downloaded,
+        'seconds': written[-1] if completed and count else time.monotonic() - start,
+        'time_to_first_piece': written[0] if count else None,
+        # Time the last 10% of the pieces took, stragglers and endgame show up here
+        'tail_seconds': written[-1] - written[(count * 9 + 9) // 10 - 1] if count else None,
+    }
+    if workers and worker_peaks:
+        result['worker_peak_rss_mb'] = max(worker_peaks.values())
+    return result
+
+
+def peak_rss_mb(pid='self') -> float:
+    """
+    Peak resident memory of a process in MiB. A spawned process inherits its parent's ru_maxrss on Linux, the
+    parent holding the seeders' payload, so the high water mark of its own memory map is read where there is one
+    :param pid: process id, this process by default
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        if pid != 'self':
+            return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def watch_workers(coordinator, peaks: dict, interval: float = 0.2):
+    """
+    Keeps the peak resident memory of every worker of a coordinator, read while they run
+    """
+    while True:
+        for worker in coordinator.workers:
+            peak = peak_rss_mb(worker.process.pid)
+            if peak is not None:
+                peaks[worker.index] = peak
+        await asyncio.sleep(interval)
+
+
+def leech_main(torrent_file: str, outdir: str, timeout: float, workers: int, log_path: str, conn):
+    """
+    Entry point of the downloading process, measured on its own
+    """
+    sys.stdout = open(log_path, 'w')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    cpu = time.process_time()
+    try:
+        result = loop.run_until_complete(leech(torrent_file, outdir, timeout, workers))
+    finally:
+        loop.close()
+    result['cpu_seconds'] = time.process_time() - cpu
+    result['peak_rss_mb'] = peak_rss_mb()
+    if workers:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result['cpu_seconds'] += children.ru_utime + children.ru_stime
+    conn.send(result)
+
+
+async def run_scenario(torrent: SyntheticTorrent, shape: str, profile: str, seeders: int, workdir: str,
+                       timeout: float, workers: int = 0, overrides: dict = None) -> dict:
+    """
+    One download of a synthetic torrent from local seeders, in a fresh process and directory
+    :param overrides: seeder settings replacing the profile's, same keys as PROFILES
+    """
+    settings = dict(PROFILES[profile], **(overrides or {}))
+    peers = [Seeder(torrent, **settings) for _ in range(seeders)]
+    for seeder in peers:
+        await seeder.start()
+    tracker = FakeTracker([('127.0.0.1', seeder.port) for seeder in peers])
+    await tracker.start()
+
+    rundir = tempfile.mkdtemp(prefix='{}-{}-'.format(shape, profile), dir=workdir)
+    torrent_file = os.path.join(rundir, 'bench.torrent')
+    torrent.write(torrent_file, tracker.url)
+    outdir = os.path.join(rundir, 'downloads')
+    os.makedirs(outdir)
+
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=leech_main, args=(
+        torrent_file, outdir, timeout, workers, os.path.join(rundir, 'client.log'), child_conn
+    ))
+    loop = asyncio.get_event_loop()
+    try:
+        process.start()
+        child_conn.close()
+        # Generous margin over the download timeout for startup and shutdown
+        if await loop.run_in_executor(None, conn.poll, timeout + 60):
+            result = conn.recv()
+        else:
+            result = {'completed': False, 'error': 'no result from the downloading process'}
+        await loop.run_in_executor(None, process.join, 10)
+        if process.is_alive():
+            process.terminate()
+    except EOFError:
+        result = {'completed': False, 'error': 'downloading process exited with {}'.format(process.exitcode)}
+    finally:
+        await tracker.close()
+        for seeder in peers:
+            await seeder.close()
+
+    total = len(torrent.payload)
+    result.update({
+        'shape': shape,
+        'profile': profile,
+        'seeder': settings,
+        'engine': 'multiproc' if workers else 'single',
+        'workers': workers,
+        'seeders': seeders,
+        'files': len(torrent.paths),
+        'bytes': total,
+        'piece_length': torrent.piece_length,
+        'pieces': len(torrent.info[b'pieces']) // 20,
+        'announces': tracker.announces,
+        'corrupted_blocks': sum(seeder.corrupted for seeder in peers),
+        'dropped_connections': sum(seeder.dropped for seeder in peers),
+    })
+    if result.get('completed'):
+        result['verified'] = await loop.run_in_executor(None, torrent.verify, outdir)
+        result['mb_per_s'] = total / MiB / result['seconds']
+        result['cpu_seconds_per_mb'] = result['cpu_seconds'] / (total / MiB)
+        # Payload received over what was needed, duplicates from endgame and corrupted pieces
+        result['download_overhead'] = result['downloaded'] / total - 1
+    shutil.rmtree(rundir, ignore_errors=True)
+    return result
+
+
+def machine_info() -> dict:
+    """
+    Where the results come from: time, commit, Python version, platform and CPU count
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().strip()
+    except OSError:
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+async def benchmark(shapes: list, profiles: list, seeders: int = 4, scale: float = 1.0, timeout: float = 300,
+                    workers: list = (0,), overrides: dict = None, out: str = None) -> dict:
+    """
+    Runs every shape against every profile with every engine and writes the results as JSON
+    :param scale: factor applied to the total length of every shape
+    :param workers: worker counts of the multi-process engine to run, 0 for the single process engine. With more
+    than one, the report has the scaling of the throughput over the worker counts
+    :param overrides: seeder settings replacing those of every profile, same keys as PROFILES
+    :param out: path of the JSON results, written after every run so an interrupted suite keeps its results
+    """
+    report = {'machine': machine_info(), 'seeders': seeders, 'scale': scale, 'overrides': overrides or {},
+              'results': []}
+    workdir = tempfile.mkdtemp(prefix='bittorpy-bench-')
+    try:
+        for shape in shapes:
+            files, total_length, piece_length = SHAPES[shape]
+            torrent = SyntheticTorrent(shape, files, max(int(total_length * scale), piece_length), piece_length)
+            for profile in profiles:
+                for count in workers:
+                    print('[Bench] {} / {} / {} workers'.format(shape, profile, count))
+                    result = await run_scenario(torrent, shape, profile, seeders, workdir, timeout, count, overrides)
+                    print('[Bench] {}'.format(json.dumps(result)))
+                    report['results'].append(result)
+                if len(workers) > 1:
+                    report['scaling'] = scaling(report['results'])
+                if out:
+                    with open(out, 'w') as f:
+                        json.dump(report, f, indent=2)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def scaling(results: list) -> list:
+    """
+    Throughput of every worker count relative to the first one run, for each shape and profile
+    :return: list of dicts with the shape, profile, workers, MB/s and speedup
+    """
+    baselines = {}
+    rows = []
+    for result in results:
+        key = (result['shape'], result['profile'])
+        mb_per_s = result.get('mb_per_s')
+        baselines.setdefault(key, mb_per_s)
+        base = baselines[key]
+        rows.append({
+            'shape': result['shape'],
+            'profile': result['profile'],
+            'workers': result['workers'],
+            'mb_per_s': mb_per_s,
+            'speedup': mb_per_s / base if mb_per_s and base else None,
+        })
+    return rows
+
+
+# Metrics compared between two reports, and whether higher is better
+METRICS = {
+    'mb_per_s': True,
+    'cpu_seconds_per_mb': False,
+    'peak_rss_mb': False,
+    'time_to_first_piece': False,
+    'tail_seconds': False,
+}
+
+
+def compare(baseline_path: str, current_path: str, threshold: float = 0.1) -> list:
+    """
+    Regressions of a report against a baseline, for the runs both have with the same seeder settings
+    :param threshold: relative change tolerated before a metric counts as regressed
+    :return: list of (shape, profile, workers, metric, baseline value, current value)
+    """
+    with open(baseline_path) as f:
+        baseline = {(r['shape'], r['profile'], r['workers']): r for r in json.load(f)['results']}
+    with open(current_path) as f:
+        current = json.load(f)['results']
+
+    regressions = []
+    for result in current:
+        key = (result['shape'], result['profile'], result['workers'])
+        base = baseline.get(key)
+        if not base:
+            continue
+        # Seeders overridden on the command line make a different run, reports without settings used the profile's
+        if base.get('seeder', PROFILES.get(key[1])) != result.get('seeder', PROFILES.get(key[1])):
+            continue
+        if base.get('completed') and not result.get('completed'):
+            regressions.append(key + ('completed', True, False))
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            print('{:12} {:7} {:2} {:20} {:10.3f} -> {:10.3f} ({:+.1%})'.format(*key, metric, old, new, change))
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(key + (metric, old, new))
+    return regressions
+
+
+def arg(name: str, default: str) -> str:
+    """
+    Value of a --name=value command line option
+    """
+    for value in sys.argv[1:]:
+        if value.startswith('--{}='.format(name)):
+            return value.split('=', 1)[1]
+    return default
+
+
+def profile_overrides() -> dict:
+    """
+    Seeder settings given on the command line, replacing those of the profiles
+    :return: dict with the keys of PROFILES that were given, latency in seconds and rate in bytes per second
+    """
+    overrides = {}
+    if arg('latency', None) is not None:
+        overrides['latency'] = float(arg('latency', None)) / 1000
+    if arg('rate', None) is not None:
+        overrides['rate'] = int(float(arg('rate', None)) * MiB)
+    for name in ('corrupt-rate', 'drop-rate'):
+        if arg(name, None) is not None:
+            overrides[name.replace('-', '_')] = float(arg(name, None))
+    return overrides
+
+
+if __name__ == '__main__':
+    # python bench.py [--shapes=single,many-small,huge-pieces] [--profiles=clean,wan,faulty] [--seeders=4]
+    #                 [--scale=1.0] [--timeout=300] [--workers=0,1,2,4] [--out=bench.json]
+    #                 [--latency=50] [--rate=4] [--corrupt-rate=0.0002] [--drop-rate=0.0005]
+    # Latency in ms and rate in MiB/s per seeder with 0 for unlimited, replacing those of every profile
+    # python bench.py compare <baseline json> <current json> [--threshold=0.1]
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        found = compare(sys.argv[2], sys.argv[3], float(arg('threshold', '0.1')))
+        for regression in found:
+            print('REGRESSION {} {} {} workers {}: {} -> {}'.format(*regression))
+        sys.exit(1 if found else 0)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(benchmark(
+        arg('shapes', ','.join(SHAPES)).split(','),
+        arg('profiles', ','.join(PROFILES)).split(','),
+        seeders=int(arg('seeders', '4')),
+        scale=float(arg('scale', '1.0')),
+        timeout=float(arg('timeout', '300')),
+        workers=[int(count) for count in arg('workers', '0').split(',')],
+        overrides=profile_overrides(),
+        out=arg('out', 'bench-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'))),
+    ))
+    loop.close()
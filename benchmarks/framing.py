@@ -0,0 +1,159 @@
+import json
+import os
+import struct
+import time
+
+from bench import MiB, arg, machine_info
+from framer import MessageFramer
+
+BLOCK_SIZE = 16384
+
+
+def wire_stream(length: int) -> bytes:
+    """
+    Peer wire messages a seeding peer sends: piece messages of 16 KiB blocks, a HAVE every 16 blocks and a keep
+    alive every 1024
+    """
+    block = os.urandom(BLOCK_SIZE)
+    messages = []
+    for count in range(length // BLOCK_SIZE):
+        piece_idx, begin = divmod(count * BLOCK_SIZE, 256 * 1024)
+        messages.append(struct.pack('>IbII', 9 + BLOCK_SIZE, 7, piece_idx, begin) + block)
+        if count % 16 == 15:
+            messages.append(struct.pack('>IbI', 5, 4, piece_idx))
+        if count % 1024 == 1023:
+            messages.append(struct.pack('>I', 0))
+    return b''.join(messages)
+
+
+def socket_reads(stream: bytes, read_size: int) -> list:
+    """
+    The stream cut the way reader.read(read_size) hands it out on a busy connection
+    """
+    return [stream[start:start + read_size] for start in range(0, len(stream), read_size)]
+
+
+def old_loop(reads: list, sink: bytearray) -> int:
+    """
+    Message loop of Peer._download before MessageFramer: the receive buffer is re-sliced for every message and
+    piece payloads are copied out by struct.unpack. Its two framing bugs, a length check missing the prefix and
+    HAVE skipping its header twice, are fixed so that both loops decode the same stream
+    :return: number of blocks decoded
+    """
+    blocks = 0
+    buf = b''
+    for resp in reads:
+        buf += resp
+        while True:
+            if len(buf) < 4:
+                break
+
+            length = struct.unpack('>I', buf[0:4])[0]
+
+            if not len(buf) >= 4 + length:
+                break
+
+            def consume(buffer):
+                return buffer[4 + length:]
+
+            def get_data(buffer):
+                return buffer[:4 + length]
+
+            if length == 0:
+                buf = consume(buf)
+                continue
+
+            msg_id = struct.unpack('>b', buf[4:5])[0]
+
+            if msg_id == 4:
+                data = get_data(buf)
+                buf = consume(buf)
+                struct.unpack('>I', data[5:9])
+
+            elif msg_id == 7:
+                data = get_data(buf)
+                buf = consume(buf)
+
+                payload = struct.unpack('>I', data[:4])[0]
+                parts = struct.unpack('>IbII' + str(payload - 9) + 's', data[:length + 4])
+                piece_idx, begin, data = parts[2], parts[3], parts[4]
+                sink[:len(data)] = data
+                blocks += 1
+
+            else:
+                buf = consume(buf)
+    return blocks
+
+
+def new_loop(reads: list, sink: bytearray) -> int:
+    """
+    Message loop of Peer.run: payloads are views into the framer's buffer, a block is copied once into its piece
+    :return: number of blocks decoded
+    """
+    blocks = 0
+    framer = MessageFramer()
+    for resp in reads:
+        framer.feed(resp)
+        for msg_id, payload in framer.messages():
+            if msg_id == 4:
+                struct.unpack_from('>I', payload)
+            elif msg_id == 7:
+                piece_idx, begin = struct.unpack_from('>II', payload)
+                sink[:len(payload) - 8] = payload[8:]
+                blocks += 1
+    return blocks
+
+
+def measure(loop, reads: list, stream_length: int, repeat: int) -> dict:
+    """
+    Best of repeat runs of a message loop over the reads, in CPU time of the decoding thread
+    """
+    sink = bytearray(BLOCK_SIZE)
+    cpu_seconds = []
+    for _ in range(repeat):
+        start = time.process_time()
+        blocks = loop(reads, sink)
+        cpu_seconds.append(time.process_time() - start)
+    best = min(cpu_seconds)
+    return {
+        'blocks': blocks,
+        'cpu_seconds': best,
+        'mb_per_s_per_core': stream_length / MiB / best if best else None,
+    }
+
+
+def main(length: int, read_sizes: list, repeat: int, out: str = None) -> dict:
+    """
+    Decodes the same stream with both loops at every read size
+    """
+    stream = wire_stream(length)
+    report = {'machine': machine_info(), 'stream_bytes': len(stream), 'results': []}
+    for read_size in read_sizes:
+        reads = socket_reads(stream, read_size)
+        old = measure(old_loop, reads, len(stream), repeat)
+        new = measure(new_loop, reads, len(stream), repeat)
+        assert old['blocks'] == new['blocks'] == length // BLOCK_SIZE
+        result = {
+            'read_size': read_size,
+            'old': old,
+            'new': new,
+            'speedup': old['cpu_seconds'] / new['cpu_seconds'] if new['cpu_seconds'] else None,
+        }
+        print('[Framing] {:6} byte reads: old {:8.1f} MB/s, new {:8.1f} MB/s per core, {:.2f}x'.format(
+            read_size, old['mb_per_s_per_core'], new['mb_per_s_per_core'], result['speedup']))
+        report['results'].append(result)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.framing [--size=64] [--read-sizes=16384,65536] [--repeat=5] [--out=framing.json]
+    # Size of the stream in MiB
+    main(
+        int(arg('size', '64')) * MiB,
+        [int(size) for size in arg('read-sizes', '16384,65536').split(',')],
+        int(arg('repeat', '5')),
+        out=arg('out', None),
+    )
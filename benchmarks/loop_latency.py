@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+from bench import MiB, arg, machine_info
+from benchmarks.startup import write_torrent
+from benchmarks.throttled_disk import ThrottledDisk
+from file_saver import FileSaver
+from torrent import Torrent
+
+
+async def probe(lags: list, interval: float):
+    """
+    Sleeps for the interval over and over, keeping how late every wake up is
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+async def write_on_loop(file_saver: FileSaver, pieces: list):
+    """
+    Writer before the disk I/O threads: every piece is written by the coroutine itself, on the event loop
+    """
+    disk = file_saver.disk
+    for offset, data, piece in pieces:
+        await asyncio.sleep(0)  # The old writer awaited its queue between pieces
+        disk._write(file_saver.segments(offset, len(data)), data)
+        piece.flush()
+
+
+async def write_on_threads(file_saver: FileSaver, pieces: list):
+    """
+    Writer since the disk I/O threads: pieces are queued to the FileSaver, which hands them to its threads
+    """
+    written = asyncio.Event()
+    remaining = len(pieces)
+
+    def on_piece_written(piece_idx: int):
+        nonlocal remaining
+        remaining -= 1
+        if not remaining:
+            written.set()
+
+    file_saver.on_piece_written = on_piece_written
+    for piece in pieces:
+        file_saver.received_pieces_queue.put_nowait(piece)
+    await written.wait()
+
+
+async def measure(writer, torrent: Torrent, outdir: str, disk_rate: int, interval: float) -> dict:
+    """
+    Writes every piece of the torrent with a writer while the probe measures how late the event loop is
+    """
+    file_saver = FileSaver(outdir, torrent, disk=ThrottledDisk(outdir, disk_rate))
+    layout = torrent.layout
+    pieces = []
+    for piece_idx in range(torrent.number_of_pieces):
+        offset, length = layout.piece_range(piece_idx)
+        pieces.append((offset, bytearray(os.urandom(length)), SimpleNamespace(index=piece_idx, flush=lambda: None)))
+
+    lags = []
+    probing = asyncio.ensure_future(probe(lags, interval))
+    await asyncio.sleep(interval * 10)
+    start = time.monotonic()
+    try:
+        await writer(file_saver, pieces)
+        seconds = time.monotonic() - start
+    finally:
+        probing.cancel()
+        file_saver.get_received_pieces_queue().put_nowait(None)
+        await file_saver.writing
+        file_saver.disk.close()
+
+    lags.sort()
+    return {
+        'seconds': seconds,
+        'mb_per_s': layout.total_length / MiB / seconds,
+        'wakeups': len(lags),
+        'lag_p50_ms': lags[len(lags) // 2] * 1000,
+        'lag_p99_ms': lags[len(lags) * 99 // 100] * 1000,
+        'lag_max_ms': lags[-1] * 1000,
+    }
+
+
+async def main(size: int, piece_length: int, disk_rates: list, interval: float, out: str = None) -> dict:
+    """
+    Loop latency while writing with the writer on the loop and with the disk I/O threads, onto every disk rate
+    """
+    report = {'machine': machine_info(), 'bytes': size, 'piece_length': piece_length, 'results': []}
+    workdir = tempfile.mkdtemp(prefix='bittorpy-loop-latency-')
+    try:
+        torrent_file = os.path.join(workdir, 'latency.torrent')
+        write_torrent(torrent_file, size // piece_length, piece_length)
+        torrent = Torrent(torrent_file)
+        for disk_rate in disk_rates:
+            for name, writer in (('before', write_on_loop), ('after', write_on_threads)):
+                outdir = os.path.join(workdir, name)
+                result = await measure(writer, torrent, outdir, disk_rate, interval)
+                result.update({'writer': name, 'disk_mb_per_s': disk_rate / MiB})
+                print('[Loop latency] {}'.format(json.dumps(result)))
+                report['results'].append(result)
+                shutil.rmtree(outdir, ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.loop_latency [--size=256] [--piece-length=1024] [--disk-rates=0,64] [--interval=1]
+    #                                   [--out=loop-latency.json]
+    # Size in MiB, piece length in KiB, disk rates in MB/s with 0 for an unthrottled disk, probe interval in ms
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(
+        int(arg('size', '256')) * MiB,
+        int(arg('piece-length', '1024')) * 1024,
+        [int(float(rate) * MiB) for rate in arg('disk-rates', '0,64').split(',')],
+        float(arg('interval', '1')) / 1000,
+        out=arg('out', None),
+    ))
+    loop.close()
@@ -0,0 +1,142 @@
+import json
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import bitstring
+
+from bench import arg, machine_info
+from piece_picker import PiecePicker
+
+
+def peer_bitfields(number_of_pieces: int, peers: int, seeds: int) -> list:
+    """
+    Bitfields of a swarm: a few seeds and peers holding a random half of the pieces each
+    """
+    rand = random.Random(number_of_pieces)
+    bitfields = [bitstring.BitArray(length=number_of_pieces) for _ in range(peers)]
+    for index, bitfield in enumerate(bitfields):
+        if index < seeds:
+            bitfield.set(True)
+        else:
+            bitfield.set(True, rand.sample(range(number_of_pieces), number_of_pieces // 2))
+    return bitfields
+
+
+class OldPicker:
+    """
+    Piece selection before PiecePicker: every piece is materialized and scanned in order on each pick, skipping
+    the pieces received or in progress
+    """
+    def __init__(self, number_of_pieces: int):
+        self.pieces = [SimpleNamespace(index=piece_idx) for piece_idx in range(number_of_pieces)]
+        self.received_pieces = set()
+        self.pieces_in_progress = {}
+
+    def take(self, piece_idx: int):
+        self.received_pieces.add(piece_idx)
+
+    def pick(self, have_pieces):
+        for piece in self.pieces:
+            if piece.index in self.received_pieces or piece.index in self.pieces_in_progress:
+                continue
+            if have_pieces[piece.index]:
+                self.pieces_in_progress[piece.index] = piece
+                return piece.index
+        return None
+
+
+def timed_picks(picker, bitfields: list, picks: int) -> float:
+    """
+    Microseconds per pick, peers asking in turn
+    """
+    start = time.perf_counter()
+    for count in range(picks):
+        picker.pick(bitfields[count % len(bitfields)])
+    return (time.perf_counter() - start) / picks * 1e6
+
+
+def measure(number_of_pieces: int, peers: int, seeds: int, picks: int, checkpoints: list, old: bool) -> dict:
+    """
+    Bookkeeping costs of the picker with a swarm of peers, and the cost of a pick as the download progresses
+    """
+    bitfields = peer_bitfields(number_of_pieces, peers, seeds)
+    result = {'pieces': number_of_pieces, 'peers': peers, 'seeds': seeds}
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    picker = PiecePicker(number_of_pieces)
+    result['build_seconds'] = time.perf_counter() - start
+    result['picker_mb'] = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for bitfield in bitfields:
+        picker.add_peer(bitfield)
+    result['bitfield_ms_per_peer'] = (time.perf_counter() - start) / peers * 1e3
+
+    haves = random.Random(0).choices(range(number_of_pieces), k=100000)
+    start = time.perf_counter()
+    for piece_idx in haves:
+        picker.increment(piece_idx)
+    result['have_us'] = (time.perf_counter() - start) / len(haves) * 1e6
+
+    start = time.perf_counter()
+    picker.remove_peer(bitfields[-1])
+    result['disconnect_ms'] = (time.perf_counter() - start) * 1e3
+    picker.add_peer(bitfields[-1])
+    if seeds:
+        # A seed leaving and connecting again
+        start = time.perf_counter()
+        picker.remove_peer(bitfields[0])
+        result['seed_disconnect_ms'] = (time.perf_counter() - start) * 1e3
+        start = time.perf_counter()
+        picker.add_peer(bitfields[0])
+        result['seed_connect_ms'] = (time.perf_counter() - start) * 1e3
+
+    # The download progresses through the checkpoints, pieces are taken in a random order as rarest first does
+    order = list(range(number_of_pieces))
+    random.Random(1).shuffle(order)
+    pickers = [('pick_us', picker)]
+    if old:
+        pickers.append(('old_pick_us', OldPicker(number_of_pieces)))
+    done = 0
+    for fraction in sorted(checkpoints):
+        for piece_idx in order[done:int(number_of_pieces * fraction)]:
+            for _, each in pickers:
+                each.take(piece_idx)
+        done = max(done, int(number_of_pieces * fraction))
+        for key, each in pickers:
+            result.setdefault(key, {})['{:.0%}'.format(fraction)] = timed_picks(
+                each, bitfields, min(picks, number_of_pieces - done))
+    return result
+
+
+def main(sizes: list, peers: int, seeds: int, picks: int, checkpoints: list, old: bool, out: str = None) -> dict:
+    """
+    Measures the picker for every number of pieces
+    """
+    report = {'machine': machine_info(), 'results': []}
+    for number_of_pieces in sizes:
+        result = measure(number_of_pieces, peers, seeds, picks, checkpoints, old)
+        print('[Picker] {}'.format(json.dumps(result)))
+        report['results'].append(result)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.picker [--pieces=100000,1000000] [--peers=50] [--seeds=5] [--picks=2000]
+    #                             [--checkpoints=0,0.5,0.9,0.99] [--old=1] [--out=picker.json]
+    main(
+        [int(size) for size in arg('pieces', '100000,1000000').split(',')],
+        int(arg('peers', '50')),
+        int(arg('seeds', '5')),
+        int(arg('picks', '2000')),
+        [float(fraction) for fraction in arg('checkpoints', '0,0.5,0.9,0.99').split(',')],
+        arg('old', '1') == '1',
+        out=arg('out', None),
+    )
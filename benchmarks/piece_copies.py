@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import tracemalloc
+
+from bench import MiB, arg, machine_info
+from disk_io import pwrite_all
+from framer import MessageFramer
+from peer import BLOCK_SIZE
+from pytor import Piece
+
+
+class OldPiece:
+    """
+    Piece before the per-piece buffer: every block keeps a copy of its data, which is joined whenever the piece's
+    data is asked for, once for hashing and once for the writer
+    """
+    def __init__(self, index: int, length: int):
+        self.index = index
+        self.length = length
+        self.blocks = [None] * ((length + BLOCK_SIZE - 1) // BLOCK_SIZE)
+
+    def save_block(self, begin: int, data):
+        self.blocks[begin // BLOCK_SIZE] = bytes(data)
+        return True
+
+    def is_complete(self) -> bool:
+        return all(block is not None for block in self.blocks)
+
+    @property
+    def data(self) -> bytes:
+        return b''.join(self.blocks)
+
+    def flush(self):
+        self.blocks = [None] * len(self.blocks)
+
+
+def socket_reads(piece_idx: int, payload: bytes, read_size: int = 65536) -> list:
+    """
+    Piece messages of every block of a piece, cut the way reader.read hands them out
+    """
+    stream = b''.join(
+        struct.pack('>IbII', 9 + len(payload[begin:begin + BLOCK_SIZE]), 7, piece_idx, begin)
+        + payload[begin:begin + BLOCK_SIZE]
+        for begin in range(0, len(payload), BLOCK_SIZE)
+    )
+    return [stream[start:start + read_size] for start in range(0, len(stream), read_size)]
+
+
+def receive_piece(piece, reads: list, expected_hash: bytes, fd: int, offset: int):
+    """
+    Path of a piece from the socket reads to the disk: framed, assembled, hashed and written
+    """
+    framer = MessageFramer()
+    for resp in reads:
+        framer.feed(resp)
+        for msg_id, payload in framer.messages():
+            if msg_id == 7:
+                piece_idx, begin = struct.unpack_from('>II', payload)
+                piece.save_block(begin, payload[8:])
+    assert piece.is_complete()
+    assert hashlib.sha1(piece.data).digest() == expected_hash
+    pwrite_all(fd, piece.data, offset)
+    piece.flush()
+
+
+def measure(piece_class, piece_length: int, pieces: int, fd: int) -> dict:
+    """
+    Peak memory of every piece's path over what was allocated before it, and the throughput of the path
+    """
+    payload = os.urandom(piece_length)
+    expected_hash = hashlib.sha1(payload).digest()
+    reads = socket_reads(0, payload)
+
+    start = time.process_time()
+    for piece_idx in range(pieces):
+        receive_piece(piece_class(0, piece_length), reads, expected_hash, fd, piece_idx * piece_length)
+    cpu_seconds = time.process_time() - start
+
+    peaks = []
+    tracemalloc.start()
+    for piece_idx in range(pieces):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        receive_piece(piece_class(0, piece_length), reads, expected_hash, fd, piece_idx * piece_length)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    return {
+        'peak_mb': max(peaks) / MiB,
+        # Piece sized buffers alive at once at the worst point of the path
+        'peak_copies_per_piece': max(peaks) / piece_length,
+        'mb_per_s_per_core': pieces * piece_length / MiB / cpu_seconds if cpu_seconds else None,
+    }
+
+
+def main(piece_length: int, pieces: int, out: str = None) -> dict:
+    """
+    Measures the piece path with the per-piece buffer and with the joined blocks it replaced
+    """
+    report = {'machine': machine_info(), 'piece_length': piece_length, 'pieces': pieces}
+    with tempfile.TemporaryDirectory() as tmp:
+        fd = os.open(os.path.join(tmp, 'pieces'), os.O_RDWR | os.O_CREAT)
+        try:
+            for name, piece_class in (('old', OldPiece), ('new', Piece)):
+                report[name] = measure(piece_class, piece_length, pieces, fd)
+                print('[Piece copies] {} {}'.format(name, json.dumps(report[name])))
+        finally:
+            os.close(fd)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.piece_copies [--piece-length=4096] [--pieces=32] [--out=piece-copies.json]
+    # Piece length in KiB
+    main(int(arg('piece-length', '4096')) * 1024, int(arg('pieces', '32')), out=arg('out', None))
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import bencoding
+
+from bench import arg, machine_info, peak_rss_mb
+
+
+def write_torrent(path: str, pieces: int, piece_length: int):
+    """
+    Single file torrent of that many pieces, its piece hashes are random as nothing is downloaded
+    """
+    info = {
+        b'name': b'startup',
+        b'piece length': piece_length,
+        b'length': pieces * piece_length,
+        b'pieces': os.urandom(20 * pieces),
+    }
+    with open(path, 'wb') as f:
+        f.write(bencoding.bencode({b'announce': b'http://127.0.0.1:1/announce', b'info': info}))
+
+
+async def start(torrent_file: str, outdir: str) -> dict:
+    """
+    Everything download() sets up before the first peer connects, except the recheck
+    """
+    from file_saver import FileSaver
+    from pytor import DownloadSession
+    from torrent import Torrent
+
+    times = {}
+    start_time = time.perf_counter()
+    torrent = Torrent(torrent_file)
+    times['torrent_seconds'] = time.perf_counter() - start_time
+    file_saver = FileSaver(outdir, torrent)
+    session = DownloadSession(torrent, file_saver.get_received_pieces_queue(), file_saver=file_saver)
+    times['startup_seconds'] = time.perf_counter() - start_time
+
+    session.close()
+    file_saver.get_received_pieces_queue().put_nowait(None)
+    await file_saver.writing
+    file_saver.disk.close()
+    return times
+
+
+def start_main(torrent_file: str, outdir: str, conn):
+    """
+    Entry point of the measured process, modules are imported in it so their memory counts toward the baseline
+    """
+    import pytor  # noqa: F401
+    baseline = peak_rss_mb()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(start(torrent_file, outdir))
+    finally:
+        loop.close()
+    result['baseline_rss_mb'] = baseline
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['rss_growth_mb'] = result['peak_rss_mb'] - baseline
+    conn.send(result)
+
+
+def measure(pieces: int, piece_length: int, workdir: str) -> dict:
+    """
+    Starts a download of a torrent with that many pieces in a fresh process
+    """
+    rundir = tempfile.mkdtemp(dir=workdir)
+    torrent_file = os.path.join(rundir, 'startup.torrent')
+    write_torrent(torrent_file, pieces, piece_length)
+
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=start_main, args=(torrent_file, os.path.join(rundir, 'downloads'), child_conn))
+    process.start()
+    child_conn.close()
+    result = conn.recv()
+    process.join()
+    shutil.rmtree(rundir, ignore_errors=True)
+    result.update({'pieces': pieces, 'piece_length': piece_length})
+    return result
+
+
+def main(sizes: list, piece_length: int, out: str = None) -> dict:
+    """
+    Startup time and memory of torrents of every number of pieces
+    """
+    report = {'machine': machine_info(), 'results': []}
+    workdir = tempfile.mkdtemp(prefix='bittorpy-startup-')
+    try:
+        for pieces in sizes:
+            result = measure(pieces, piece_length, workdir)
+            print('[Startup] {}'.format(json.dumps(result)))
+            report['results'].append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.startup [--pieces=10000,100000,1000000] [--piece-length=16] [--out=startup.json]
+    # Piece length in KiB, the files are sparse
+    main(
+        [int(pieces) for pieces in arg('pieces', '10000,100000,1000000').split(',')],
+        int(arg('piece-length', '16')) * 1024,
+        out=arg('out', None),
+    )
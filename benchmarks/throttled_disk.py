@@ -0,0 +1,170 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from bench import FakeTracker, MiB, Seeder, SyntheticTorrent, arg, machine_info, peak_rss_mb
+from disk_io import DiskIO
+from file_saver import FileSaver
+from memory_budget import MemoryBudget
+from pytor import DownloadSession
+from swarm import Swarm
+from torrent import Torrent
+
+
+class ThrottledDisk(DiskIO):
+    """
+    Disk I/O engine writing no faster than a set rate over all of its threads, like a slow or busy disk
+    """
+    def __init__(self, root: str, rate: int):
+        super().__init__(root)
+        self.rate = rate  # Bytes per second, 0 for no limit
+        self.lock = threading.Lock()
+
+    def _write(self, segments: list, data):
+        super()._write(segments, data)
+        if self.rate:
+            with self.lock:
+                time.sleep(len(data) / self.rate)
+
+
+async def leech(torrent_file: str, outdir: str, disk_rate: int, memory: int, timeout: float) -> dict:
+    """
+    Downloads a torrent onto the throttled disk, pieces queue up in memory for it up to the memory budget
+    """
+    torrent = Torrent(torrent_file)
+    file_saver = FileSaver(outdir, torrent, disk=ThrottledDisk(outdir, disk_rate))
+    budget = MemoryBudget(memory)
+    session = DownloadSession(torrent, file_saver.get_received_pieces_queue(), file_saver=file_saver, memory=budget)
+    file_saver.on_piece_written = session.on_piece_written
+    file_saver.on_piece_failed = session.on_piece_failed
+
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(Swarm(session, torrent).run(), timeout)
+        while session.unwritten:
+            await asyncio.sleep(0.01)
+        completed = session.is_complete()
+    except asyncio.TimeoutError:
+        completed = False
+    finally:
+        session.close()
+        file_saver.get_received_pieces_queue().put_nowait(None)
+        await file_saver.writing
+        file_saver.disk.close()
+
+    return {
+        'completed': completed,
+        'seconds': time.monotonic() - start,
+        'written_pieces': len(session.written_pieces),
+        'budget_peak_mb': budget.peak / MiB,
+    }
+
+
+def leech_main(torrent_file: str, outdir: str, disk_rate: int, memory: int, timeout: float, log_path: str, conn):
+    """
+    Entry point of the downloading process, its peak RSS is the download's alone
+    """
+    sys.stdout = open(log_path, 'w')
+    baseline = peak_rss_mb()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(leech(torrent_file, outdir, disk_rate, memory, timeout))
+    finally:
+        loop.close()
+    result['baseline_rss_mb'] = baseline
+    result['peak_rss_mb'] = peak_rss_mb()
+    conn.send(result)
+
+
+async def run(torrent: SyntheticTorrent, disk_rate: int, memory: int, seeders: int, timeout: float) -> dict:
+    """
+    One download from fast local seeders onto a disk writing at disk_rate, in a fresh process and directory
+    """
+    peers = [Seeder(torrent) for _ in range(seeders)]
+    for seeder in peers:
+        await seeder.start()
+    tracker = FakeTracker([('127.0.0.1', seeder.port) for seeder in peers])
+    await tracker.start()
+
+    rundir = tempfile.mkdtemp(prefix='throttled-disk-')
+    torrent_file = os.path.join(rundir, 'bench.torrent')
+    torrent.write(torrent_file, tracker.url)
+    outdir = os.path.join(rundir, 'downloads')
+    os.makedirs(outdir)
+
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=leech_main, args=(
+        torrent_file, outdir, disk_rate, memory, timeout, os.path.join(rundir, 'client.log'), child_conn
+    ))
+    loop = asyncio.get_event_loop()
+    try:
+        process.start()
+        child_conn.close()
+        if await loop.run_in_executor(None, conn.poll, timeout + 60):
+            result = conn.recv()
+        else:
+            result = {'completed': False, 'error': 'no result from the downloading process'}
+        await loop.run_in_executor(None, process.join, 10)
+        if process.is_alive():
+            process.terminate()
+    finally:
+        await tracker.close()
+        for seeder in peers:
+            await seeder.close()
+        shutil.rmtree(rundir, ignore_errors=True)
+
+    result.update({
+        'disk_mb_per_s': disk_rate / MiB,
+        'budget_mb': memory / MiB,
+        'bytes': len(torrent.payload),
+        'piece_length': torrent.piece_length,
+    })
+    if result.get('completed'):
+        # Memory the download took on top of the started process, against the budget it was given
+        result['rss_growth_mb'] = result['peak_rss_mb'] - result['baseline_rss_mb']
+        result['mb_per_s'] = len(torrent.payload) / MiB / result['seconds']
+    return result
+
+
+async def main(disk_rates: list, budgets: list, size: int, piece_length: int, seeders: int, timeout: float,
+               out: str = None) -> dict:
+    """
+    Downloads the same torrent with every memory budget onto a disk writing at every rate
+    """
+    torrent = SyntheticTorrent('throttled', 1, size, piece_length)
+    report = {'machine': machine_info(), 'results': []}
+    for disk_rate in disk_rates:
+        for memory in budgets:
+            print('[Throttled disk] {} MB/s disk, {} MiB budget'.format(disk_rate / MiB or 'unlimited', memory // MiB))
+            result = await run(torrent, disk_rate, memory, seeders, timeout)
+            print('[Throttled disk] {}'.format(json.dumps(result)))
+            report['results'].append(result)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.throttled_disk [--disk-rates=0,16] [--budgets=32,128] [--size=128] [--piece-length=1024]
+    #                                     [--seeders=4] [--timeout=300] [--out=throttled-disk.json]
+    # Rates in MB/s, 0 for an unthrottled disk, budgets and size in MiB, piece length in KiB
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(
+        [int(float(rate) * MiB) for rate in arg('disk-rates', '0,16').split(',')],
+        [int(budget) * MiB for budget in arg('budgets', '32,128').split(',')],
+        int(arg('size', '128')) * MiB,
+        int(arg('piece-length', '1024')) * 1024,
+        int(arg('seeders', '4')),
+        float(arg('timeout', '300')),
+        out=arg('out', None),
+    ))
+    loop.close()
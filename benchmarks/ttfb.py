@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bench import PROFILES, SHAPES, FakeTracker, Seeder, SyntheticTorrent, arg, machine_info
+
+
+async def fetch(torrent_file: str, outdir: str, offset: int, length: int, prioritized: bool, timeout: float) -> dict:
+    """
+    Starts a download into an empty directory and reads a byte range of the torrent right away
+    :param prioritized: move the range to the front of the picker, as read() does, otherwise the range comes
+    whenever rarest first gets to it, as before the range reader
+    """
+    from file_saver import FileSaver
+    from pytor import DownloadSession
+    from swarm import Swarm
+    from torrent import Torrent
+
+    torrent = Torrent(torrent_file)
+    file_saver = FileSaver(outdir, torrent)
+    session = DownloadSession(torrent, file_saver.get_received_pieces_queue(), file_saver=file_saver)
+    if not prioritized:
+        session.seek = lambda *args: None
+
+    start = time.monotonic()
+    swarming = asyncio.ensure_future(Swarm(session, torrent, port=0).run())
+    try:
+        data = await asyncio.wait_for(session.read(offset, length), timeout)
+        result = {
+            'completed': True,
+            'seconds': time.monotonic() - start,
+            'sha1': hashlib.sha1(data).hexdigest(),
+        }
+    except asyncio.TimeoutError:
+        result = {'completed': False, 'seconds': time.monotonic() - start}
+    finally:
+        result.update({
+            'pieces_received': len(session.received_pieces),
+            'downloaded': session.downloaded,
+        })
+        swarming.cancel()
+        try:
+            await swarming
+        except asyncio.CancelledError:
+            pass
+        session.close()
+        file_saver.get_received_pieces_queue().put_nowait(None)
+        await file_saver.writing
+        file_saver.disk.close()
+    return result
+
+
+def fetch_main(torrent_file: str, outdir: str, offset: int, length: int, prioritized: bool, timeout: float,
+               log_path: str, conn):
+    """
+    Entry point of the reading process, a fresh one for every read
+    """
+    sys.stdout = open(log_path, 'w')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(fetch(torrent_file, outdir, offset, length, prioritized, timeout))
+    finally:
+        loop.close()
+    conn.send(result)
+
+
+async def measure(torrent: SyntheticTorrent, torrent_file: str, workdir: str, offset: int, length: int,
+                  prioritized: bool, timeout: float) -> dict:
+    """
+    Time from the start of a download to the read of a byte range returning
+    """
+    rundir = tempfile.mkdtemp(dir=workdir)
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=fetch_main, args=(
+        torrent_file, os.path.join(rundir, 'downloads'), offset, length, prioritized, timeout,
+        os.path.join(rundir, 'client.log'), child_conn
+    ))
+    loop = asyncio.get_event_loop()
+    try:
+        process.start()
+        child_conn.close()
+        # Margin over the read timeout for startup and shutdown, a stuck process is not waited for forever
+        if await loop.run_in_executor(None, conn.poll, timeout + 60):
+            result = conn.recv()
+        else:
+            result = {'completed': False, 'error': 'no result from the reading process'}
+        await loop.run_in_executor(None, process.join, 10)
+    except EOFError:
+        await loop.run_in_executor(None, process.join, 10)
+        result = {'completed': False, 'error': 'reading process exited with {}'.format(process.exitcode)}
+    finally:
+        if process.is_alive():
+            process.terminate()
+            process.join(10)
+        if process.is_alive():
+            process.kill()  # Terminating does nothing to a stopped process
+            process.join()
+        shutil.rmtree(rundir, ignore_errors=True)
+
+    if result['completed']:
+        expected = hashlib.sha1(torrent.payload[offset:offset + length]).hexdigest()
+        result['verified'] = result.pop('sha1') == expected
+    result.update({
+        'read': 'prioritized' if prioritized else 'rarest-first',
+        'offset': offset,
+        'length': length,
+        'pieces': len(torrent.info[b'pieces']) // 20,
+    })
+    return result
+
+
+async def main(shape: str, profile: str, seeders: int, positions: list, length: int, timeout: float,
+               scale: float = 1.0, out: str = None) -> dict:
+    """
+    Time to first byte of reads at every position of the torrent, with the range reader moving the range to the
+    front of the picker and without
+    :param positions: where the reads start, as fractions of the torrent's length
+    """
+    files, total_length, piece_length = SHAPES[shape]
+    torrent = SyntheticTorrent(shape, files, int(total_length * scale), piece_length)
+    peers = [Seeder(torrent, **PROFILES[profile]) for _ in range(seeders)]
+    for seeder in peers:
+        await seeder.start()
+    tracker = FakeTracker([('127.0.0.1', seeder.port) for seeder in peers])
+    await tracker.start()
+
+    report = {
+        'machine': machine_info(),
+        'shape': shape,
+        'profile': profile,
+        'seeders': seeders,
+        'bytes': len(torrent.payload),
+        'piece_length': piece_length,
+        'results': [],
+    }
+    workdir = tempfile.mkdtemp(prefix='bittorpy-ttfb-')
+    try:
+        torrent_file = os.path.join(workdir, 'ttfb.torrent')
+        torrent.write(torrent_file, tracker.url)
+        for position in positions:
+            offset = min(int(len(torrent.payload) * position), len(torrent.payload) - length)
+            for prioritized in (False, True):
+                result = await measure(torrent, torrent_file, workdir, offset, length, prioritized, timeout)
+                result['position'] = position
+                print('[TTFB] {}'.format(json.dumps(result)))
+                report['results'].append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        await tracker.close()
+        for seeder in peers:
+            await seeder.close()
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.ttfb [--shape=single] [--profile=wan] [--seeders=4] [--positions=0,0.5,0.95]
+    #                           [--length=64] [--scale=1] [--timeout=300] [--out=ttfb.json]
+    # Positions as fractions of the torrent, read length in KiB
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(
+        arg('shape', 'single'),
+        arg('profile', 'wan'),
+        int(arg('seeders', '4')),
+        [float(position) for position in arg('positions', '0,0.5,0.95').split(',')],
+        int(arg('length', '64')) * 1024,
+        float(arg('timeout', '300')),
+        scale=float(arg('scale', '1')),
+        out=arg('out', None),
+    ))
+    loop.close()
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from bench import FakeTracker, MiB, SyntheticTorrent, arg, machine_info, peak_rss_mb
+from framer import MessageFramer
+from peer import BLOCK_SIZE, PROTOCOL
+
+
+class Leecher:
+    """
+    Local peer downloading every block of a synthetic torrent from the seeder in a random order, with a fixed
+    number of requests outstanding, checking every block it gets
+    """
+    def __init__(self, torrent: SyntheticTorrent, depth: int = 64):
+        self.torrent = torrent
+        self.payload = memoryview(torrent.payload)
+        self.depth = depth
+        self.peer_id = b'-LEECH-' + os.urandom(13)
+        self.received = 0
+        self.corrupt = 0
+
+    def blocks(self) -> list:
+        """
+        Every (piece index, begin, length) of the torrent, pieces in a random order
+        """
+        piece_length = self.torrent.piece_length
+        total_length = len(self.payload)
+        pieces = list(range((total_length + piece_length - 1) // piece_length))
+        random.shuffle(pieces)
+        return [
+            (piece_idx, begin, min(BLOCK_SIZE, total_length - piece_idx * piece_length - begin))
+            for piece_idx in pieces
+            for begin in range(0, min(piece_length, total_length - piece_idx * piece_length), BLOCK_SIZE)
+        ]
+
+    async def run(self, port: int):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(struct.pack('>B19s8x20s20s', 19, PROTOCOL, self.torrent.info_hash, self.peer_id))
+        writer.write(struct.pack('>Ib', 1, 2))  # Interested
+        await reader.readexactly(68)
+
+        wanted = self.blocks()
+        outstanding = set()
+        unchoked = False
+        framer = MessageFramer()
+        try:
+            while wanted or outstanding:
+                if unchoked:
+                    while wanted and len(outstanding) < self.depth:
+                        piece_idx, begin, length = wanted.pop()
+                        outstanding.add((piece_idx, begin))
+                        writer.write(struct.pack('>IbIII', 13, 6, piece_idx, begin, length))
+                    await writer.drain()
+
+                data = await reader.read(65536)
+                if not data:
+                    return
+                framer.feed(data)
+                for msg_id, payload in framer.messages():
+                    if msg_id == 0:
+                        # Requests are dropped by a choking seeder, asked again once unchoked
+                        unchoked = False
+                        piece_length = self.torrent.piece_length
+                        wanted.extend(
+                            (piece_idx, begin, min(BLOCK_SIZE, len(self.payload) - piece_idx * piece_length - begin))
+                            for piece_idx, begin in outstanding
+                        )
+                        outstanding.clear()
+                    elif msg_id == 1:
+                        unchoked = True
+                    elif msg_id == 7:
+                        piece_idx, begin = struct.unpack_from('>II', payload)
+                        if (piece_idx, begin) not in outstanding:
+                            continue
+                        outstanding.discard((piece_idx, begin))
+                        offset = piece_idx * self.torrent.piece_length + begin
+                        if payload[8:] != self.payload[offset:offset + len(payload) - 8]:
+                            self.corrupt += 1
+                        self.received += len(payload) - 8
+        finally:
+            writer.close()
+
+
+async def seed(torrent_file: str, outdir: str, conn):
+    """
+    Seeds the torrent from the download location until told to stop
+    """
+    from file_saver import FileSaver
+    from pytor import DownloadSession
+    from swarm import Swarm
+    from torrent import Torrent
+
+    torrent = Torrent(torrent_file)
+    file_saver = FileSaver(outdir, torrent)
+    session = DownloadSession(torrent, file_saver.get_received_pieces_queue(), file_saver=file_saver)
+    session.restore(bytearray(b'\x01' * torrent.number_of_pieces))
+    swarm = Swarm(session, torrent, port=0)
+    await swarm.listen()
+    # Every address family gets its own port when listening on port 0, the leechers connect over IPv4
+    conn.send(next(
+        sock.getsockname()[1] for sock in swarm.server.sockets if sock.family == socket.AF_INET
+    ))
+
+    loop = asyncio.get_event_loop()
+    seeding = asyncio.ensure_future(swarm.run(seed=True))
+    cpu = time.process_time()
+    try:
+        await loop.run_in_executor(None, conn.recv)
+    finally:
+        seeding.cancel()
+        try:
+            await seeding
+        except asyncio.CancelledError:
+            pass
+        session.close()
+        file_saver.get_received_pieces_queue().put_nowait(None)
+        await file_saver.writing
+        file_saver.disk.close()
+    return {
+        'uploaded': session.uploaded,
+        'cpu_seconds': time.process_time() - cpu,
+        'read_cache': file_saver.read_cache.stats(),
+    }
+
+
+def seed_main(torrent_file: str, outdir: str, log_path: str, conn):
+    """
+    Entry point of the seeding process, measured on its own
+    """
+    sys.stdout = open(log_path, 'w')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(seed(torrent_file, outdir, conn))
+    finally:
+        loop.close()
+    result['peak_rss_mb'] = peak_rss_mb()
+    conn.send(result)
+
+
+async def run(torrent: SyntheticTorrent, leechers: int, depth: int, timeout: float) -> dict:
+    """
+    One upload of the whole torrent to every leecher at once
+    """
+    tracker = FakeTracker([])
+    await tracker.start()
+    rundir = tempfile.mkdtemp(prefix='bittorpy-upload-')
+    torrent_file = os.path.join(rundir, 'upload.torrent')
+    torrent.write(torrent_file, tracker.url)
+    outdir = os.path.join(rundir, 'downloads')
+    offset = 0
+    for path, length in zip(torrent.paths, torrent.lengths):
+        os.makedirs(os.path.dirname(os.path.join(outdir, path)), exist_ok=True)
+        with open(os.path.join(outdir, path), 'wb') as f:
+            f.write(torrent.payload[offset:offset + length])
+        offset += length
+
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    process = context.Process(target=seed_main, args=(
+        torrent_file, outdir, os.path.join(rundir, 'seeder.log'), child_conn
+    ))
+    loop = asyncio.get_event_loop()
+    peers = [Leecher(torrent, depth) for _ in range(leechers)]
+    try:
+        process.start()
+        child_conn.close()
+        port = await loop.run_in_executor(None, conn.recv)
+        start = time.monotonic()
+        cpu = time.process_time()
+        try:
+            await asyncio.wait_for(asyncio.gather(*[peer.run(port) for peer in peers]), timeout)
+            completed = True
+        except asyncio.TimeoutError:
+            completed = False
+        seconds = time.monotonic() - start
+        leecher_cpu_seconds = time.process_time() - cpu
+        conn.send('stop')
+        result = await loop.run_in_executor(None, conn.recv)
+        await loop.run_in_executor(None, process.join, 10)
+    finally:
+        if process.is_alive():
+            process.terminate()
+        await tracker.close()
+        shutil.rmtree(rundir, ignore_errors=True)
+
+    received = sum(peer.received for peer in peers)
+    result.update({
+        'completed': completed and received == leechers * len(torrent.payload),
+        'leechers': leechers,
+        'depth': depth,
+        'bytes': len(torrent.payload),
+        'piece_length': torrent.piece_length,
+        'received': received,
+        'corrupt_blocks': sum(peer.corrupt for peer in peers),
+        'seconds': seconds,
+        'mb_per_s': received / MiB / seconds,
+        'cpu_seconds_per_mb': result['cpu_seconds'] / (received / MiB) if received else None,
+        # The leechers share this process, when it is as busy as the seeder they are what limits the rate
+        'leecher_cpu_seconds': leecher_cpu_seconds,
+    })
+    return result
+
+
+async def main(size: int, piece_length: int, leechers: list, depth: int, timeout: float, out: str = None) -> dict:
+    """
+    Upload throughput to every number of leechers
+    """
+    torrent = SyntheticTorrent('upload', 1, size, piece_length)
+    report = {'machine': machine_info(), 'results': []}
+    for count in leechers:
+        result = await run(torrent, count, depth, timeout)
+        print('[Upload] {}'.format(json.dumps(result)))
+        report['results'].append(result)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.upload [--size=64] [--piece-length=256] [--leechers=1,4] [--depth=64] [--timeout=300]
+    #                             [--out=upload.json]
+    # Size in MiB, piece length in KiB
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(
+        int(arg('size', '64')) * MiB,
+        int(arg('piece-length', '256')) * 1024,
+        [int(count) for count in arg('leechers', '1,4').split(',')],
+        int(arg('depth', '64')),
+        float(arg('timeout', '300')),
+        out=arg('out', None),
+    ))
+    loop.close()
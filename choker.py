@@ -0,0 +1,113 @@
+import asyncio
+import random
+import time
+
+
+class Choker:
+    """
+    Upload slot scheduler over the peers of a download session, tit for tat
+    Every interval the interested peers sending us data the fastest get the upload slots, and once the download is
+    complete the peers taking our data the fastest do. One more slot rotates every optimistic interval among the
+    choked peers, so peers we never traded with get a chance to prove themselves
+    """
+    # Seconds a peer is considered new, new peers are three times as likely to be picked optimistically
+    NEW_PEER_AGE = 60
+
+    def __init__(self, session, upload_slots: int = 4, interval: float = 10, optimistic_interval: float = 30):
+        self.session = session
+        self.upload_slots = upload_slots
+        self.interval = interval
+        self.optimistic_interval = optimistic_interval
+
+        self.optimistic = None  # Peer holding the optimistic slot
+        self.rates = {}  # Peer -> bytes per second over the last interval, the ones ranking it
+        self._counters = {}  # Peer -> (downloaded, uploaded) at the last rechoke
+        self._last_rechoke = time.monotonic()
+
+    def update_rates(self):
+        """
+        Rates of every connected peer since the last rechoke, download rates while downloading and upload rates
+        once seeding
+        """
+        now = time.monotonic()
+        elapsed = max(now - self._last_rechoke, 1e-3)
+        self._last_rechoke = now
+        seeding = self.session.is_complete()
+
+        counters = {}
+        rates = {}
+        for peer in self.session.peers:
+            downloaded, uploaded = self._counters.get(peer, (0, 0))
+            counters[peer] = (peer.downloaded, peer.uploaded)
+            if seeding:
+                rates[peer] = (peer.uploaded - uploaded) / elapsed
+            else:
+                rates[peer] = (peer.downloaded - downloaded) / elapsed
+        self._counters = counters
+        self.rates = rates
+
+    def pick_optimistic(self, choked: list):
+        """
+        Random choked peer, weighted towards new peers which have nothing to show yet
+        """
+        if not choked:
+            return None
+        now = time.monotonic()
+        weights = [3 if now - peer.connected_at < self.NEW_PEER_AGE else 1 for peer in choked]
+        return random.choices(choked, weights)[0]
+
+    def rechoke(self, rotate_optimistic: bool = False):
+        """
+        Hands the upload slots out again
+        :param rotate_optimistic: move the optimistic slot to another peer
+        """
+        self.update_rates()
+        seeding = self.session.is_complete()
+        interested = [peer for peer in self.session.peers if peer.peer_interested]
+        interested.sort(key=lambda peer: self.rates.get(peer, 0), reverse=True)
+        # Peers snubbing us don't earn a regular slot, they can still get the optimistic one
+        unchoked = set([peer for peer in interested if seeding or not peer.snubbed][:self.upload_slots])
+
+        if rotate_optimistic or self.optimistic not in self.session.peers or self.optimistic in unchoked:
+            self.optimistic = self.pick_optimistic([peer for peer in interested if peer not in unchoked])
+        if self.optimistic:
+            unchoked.add(self.optimistic)
+
+        for peer in list(self.session.peers):
+            if peer in unchoked:
+                peer.unchoke()
+            else:
+                peer.choke()
+
+    def on_interested(self, peer):
+        """
+        Unchokes a peer which became interested right away if a slot is free, instead of on the next rechoke
+        """
+        in_use = sum(
+            1 for other in self.session.peers
+            if other is not peer and other.peer_interested and not other.am_choking
+        )
+        if in_use < self.upload_slots + 1:
+            peer.unchoke()
+
+    def on_peer_gone(self, peer):
+        """
+        Forgets a disconnected peer, its slot is given away on the next rechoke
+        """
+        self.rates.pop(peer, None)
+        self._counters.pop(peer, None)
+        if self.optimistic is peer:
+            self.optimistic = None
+
+    async def run(self):
+        """
+        Rechokes every interval, rotating the optimistic slot every optimistic interval
+        """
+        last_rotation = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            rotate = now - last_rotation >= self.optimistic_interval
+            if rotate:
+                last_rotation = now
+            self.rechoke(rotate)
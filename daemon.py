@@ -0,0 +1,372 @@
+import asyncio
+import itertools
+import json
+import sys
+
+import aiohttp
+
+from disk_io import DiskIO, PieceCache
+from file_saver import FileSaver
+from hasher import PieceHasher
+from memory_budget import MemoryBudget
+from peer import Peer
+from piece_picker import HIGH, LOW, NORMAL, SKIP
+from pytor import DownloadSession, Tee
+from ratelimit import RateLimiter
+from resume import ResumeData
+from swarm import ConnectionBudget, Swarm
+from torrent import Torrent
+from tracker import Announcer
+from udp_tracker import UDPTrackerClient
+
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+SEEDING = 'seeding'
+PAUSED = 'paused'
+PRIORITIES = {'skip': SKIP, 'low': LOW, 'normal': NORMAL, 'high': HIGH}
+
+
+class Job:
+    """
+    A torrent hosted by the daemon
+    Only running torrents hold a session, queued and paused ones are just their metadata and get their progress
+    back from the resume data when started again
+    """
+    def __init__(self, daemon, torrent_file: str, priority: int = 0):
+        self.daemon = daemon
+        self.torrent_file = torrent_file
+        self.torrent = Torrent(torrent_file)
+        self.info_hash = self.torrent.info_hash
+        self.priority = priority  # Higher priorities are started first
+        self.order = next(daemon.counter)  # Ties go to the torrent added first
+        self.state = QUEUED
+        self.session = None
+        self.swarm = None
+        self.task = None
+        self.stopping = False  # Its task is cancelled and winding down, it is not cancelled again
+        self.rates = (0, 0)  # Download and upload caps of the torrent, kept while it is not running
+        self.file_priorities = None  # Priority of every file, None for all at NORMAL
+
+    async def run(self):
+        """
+        Downloads, then seeds until paused or removed
+        """
+        daemon = self.daemon
+        file_saver = FileSaver(
+            daemon.download_location, self.torrent, disk=daemon.disk, read_cache=daemon.read_cache,
+            file_priorities=self.file_priorities
+        )
+        session = DownloadSession(
+            self.torrent, file_saver.get_received_pieces_queue(), hasher=daemon.hasher, file_saver=file_saver,
+            limiter=daemon.limiter, memory=daemon.memory
+        )
+        session.limiter.set_rates(*self.rates)
+        if self.file_priorities:
+            session.set_file_priorities(self.file_priorities)
+        file_saver.on_piece_written = session.on_piece_written
+        file_saver.on_piece_failed = session.on_piece_failed
+        self.session = session
+
+        resume = ResumeData(self.torrent, daemon.download_location)
+        saving = None
+        try:
+            session.restore(await asyncio.get_event_loop().run_in_executor(None, resume.load_or_recheck))
+            saving = asyncio.ensure_future(resume.run(session))
+            self.swarm = Swarm(
+                session, self.torrent, daemon.max_connections_per_torrent, daemon.port,
+                announcer=daemon.announcer(self.torrent), budget=daemon.budget
+            )
+            self.swarm.on_complete = self.on_complete
+            if session.is_complete():
+                self.on_complete()
+            await self.swarm.run(seed=True)
+        finally:
+            if saving:
+                saving.cancel()
+            session.close()
+            file_saver.get_received_pieces_queue().put_nowait(None)
+            # Pieces counted as written are on disk, and no write changes the files' mtimes after the save
+            await file_saver.writing
+            await asyncio.get_event_loop().run_in_executor(None, resume.save, session.written_pieces)
+            self.swarm = None
+            self.session = None
+
+    def on_complete(self):
+        if self.state == DOWNLOADING:
+            print('[Daemon] {} complete'.format(self.name))
+            self.state = SEEDING
+            self.daemon.schedule()
+
+    @property
+    def name(self) -> str:
+        return self.torrent.name.decode(errors='replace')
+
+    def status(self) -> dict:
+        session = self.session
+        return {
+            'info_hash': self.info_hash.hex(),
+            'name': self.name,
+            'state': self.state,
+            'priority': self.priority,
+            'size': self.torrent.layout.total_length,
+            'left': session.left if session else None,
+            'downloaded': session.downloaded if session else 0,
+            'uploaded': session.uploaded if session else 0,
+            'peers': len(session.peers) if session else 0,
+        }
+
+
+class Daemon:
+    """
+    Hosts many torrents on one event loop
+    Torrents share the connection budget, the listening port, the tracker sockets, the disk threads with their
+    file descriptors, the read cache, the hashing threads, the memory budget of piece buffers and the global rate
+    limits, so only the state of the torrents actually running grows with their number. At most max_active
+    torrents download at once, by priority; complete torrents keep seeding without taking a download slot.
+    Controlled through a local JSON lines API, see handle()
+    """
+    def __init__(self, download_location: str, port: int = 6881, control_port: int = 6880, max_active: int = 5,
+                 max_connections: int = 500, max_connections_per_torrent: int = 50):
+        self.download_location = download_location
+        self.port = port
+        self.control_port = control_port
+        self.max_active = max_active
+        self.max_connections_per_torrent = max_connections_per_torrent
+
+        self.jobs = {}  # Info hash -> Job
+        self.counter = itertools.count()
+        self.budget = ConnectionBudget(max_connections)
+        self.disk = DiskIO(download_location, workers=8, max_open_files=256)
+        self.read_cache = PieceCache(256 * 1024 * 1024)
+        self.hasher = PieceHasher(workers=4)
+        self.memory = MemoryBudget(1024 * 1024 * 1024)
+        self.limiter = RateLimiter()
+        self.udp = UDPTrackerClient()
+        self.http = None
+        self.servers = []
+        self.closing = False  # Shutting down, no torrent is started anymore
+
+    def announcer(self, torrent) -> Announcer:
+        return Announcer(torrent, self.port, udp=self.udp, http=self.http)
+
+    def schedule(self):
+        """
+        Starts queued torrents by priority while download slots are free
+        """
+        if self.closing:
+            return
+        downloading = sum(1 for job in self.jobs.values() if job.state == DOWNLOADING)
+        queued = sorted(
+            (job for job in self.jobs.values() if job.state == QUEUED),
+            key=lambda job: (-job.priority, job.order)
+        )
+        for job in queued[:max(0, self.max_active - downloading)]:
+            self.start(job)
+
+    def start(self, job: Job):
+        job.state = DOWNLOADING
+        job.stopping = False
+        job.task = asyncio.ensure_future(job.run())
+        job.task.add_done_callback(lambda task: self.on_job_done(job, task))
+
+    def on_job_done(self, job: Job, task):
+        if not task.cancelled() and task.exception():
+            print('[Daemon] {} failed\n{}'.format(job.name, task.exception()))
+            job.state = PAUSED
+        job.task = None
+        self.schedule()
+
+    async def stop(self, job: Job):
+        if job.task:
+            # A second cancel would interrupt the job's cleanup, its writes and resume data
+            if not job.stopping:
+                job.stopping = True
+                job.task.cancel()
+            await asyncio.wait([job.task])
+
+    def add(self, torrent_file: str, priority: int = 0, paused: bool = False) -> Job:
+        job = Job(self, torrent_file, priority)
+        if job.info_hash in self.jobs:
+            raise ValueError('{} is added already'.format(job.name))
+        self.jobs[job.info_hash] = job
+        if paused:
+            job.state = PAUSED
+        self.schedule()
+        return job
+
+    async def pause(self, job: Job):
+        job.state = PAUSED
+        await self.stop(job)
+
+    def resume(self, job: Job):
+        if job.state == PAUSED:
+            job.state = QUEUED
+            self.schedule()
+
+    async def remove(self, job: Job):
+        """
+        Forgets a torrent, its files stay on disk
+        """
+        del self.jobs[job.info_hash]
+        job.state = PAUSED
+        await self.stop(job)
+
+    def set_priority(self, job: Job, priority: int):
+        job.priority = priority
+        self.schedule()
+
+    def set_file_priorities(self, job: Job, priorities: list):
+        """
+        Changes which files of a torrent are downloaded, a complete torrent downloads the files it skipped
+        """
+        priorities = [PRIORITIES[priority] if isinstance(priority, str) else int(priority) for priority in priorities]
+        if len(priorities) != len(job.torrent.layout):
+            raise ValueError('{} has {} files'.format(job.name, len(job.torrent.layout)))
+        job.file_priorities = priorities
+        if job.session:
+            job.session.set_file_priorities(priorities)
+            if job.state == SEEDING and not job.session.is_complete():
+                job.state = DOWNLOADING
+
+    def set_rates(self, job: Job = None, download_rate: int = None, upload_rate: int = None):
+        """
+        Changes the global limits, or those of a torrent
+        """
+        if job is None:
+            self.limiter.set_rates(download_rate, upload_rate)
+            return
+        job.rates = (
+            job.rates[0] if download_rate is None else download_rate,
+            job.rates[1] if upload_rate is None else upload_rate
+        )
+        if job.session:
+            job.session.limiter.set_rates(download_rate, upload_rate)
+
+    async def on_incoming(self, reader, writer):
+        """
+        Hands an incoming peer connection to the swarm of the torrent its handshake is for
+        """
+        try:
+            handshake = await asyncio.wait_for(reader.readexactly(68), timeout=5)
+        except Exception:
+            writer.close()
+            return
+        job = self.jobs.get(Peer.parse_handshake(handshake))
+        if not job or not job.swarm:
+            writer.close()
+            return
+        job.swarm.accept(reader, writer)
+
+    def get_job(self, command: dict) -> Job:
+        job = self.jobs.get(bytes.fromhex(command.get('info_hash', '')))
+        if not job:
+            raise KeyError('Unknown torrent {}'.format(command.get('info_hash')))
+        return job
+
+    async def handle(self, command: dict) -> dict:
+        """
+        Runs one control command
+        {"cmd": "add", "torrent": path, "priority": 0, "paused": false} -> {"info_hash": hex}
+        {"cmd": "list"} -> {"torrents": [status of every torrent]}
+        {"cmd": "pause" | "resume" | "remove", "info_hash": hex}
+        {"cmd": "priority", "info_hash": hex, "priority": int}
+        {"cmd": "limits", "download_rate": bytes/s, "upload_rate": bytes/s}, for one torrent with "info_hash"
+        {"cmd": "files", "info_hash": hex, "priorities": ["skip" | "low" | "normal" | "high", ...]}
+        """
+        cmd = command.get('cmd')
+        if cmd == 'add':
+            job = self.add(command['torrent'], command.get('priority', 0), command.get('paused', False))
+            return {'info_hash': job.info_hash.hex()}
+        if cmd == 'list':
+            return {'torrents': [job.status() for job in self.jobs.values()]}
+        if cmd == 'pause':
+            await self.pause(self.get_job(command))
+        elif cmd == 'resume':
+            self.resume(self.get_job(command))
+        elif cmd == 'remove':
+            await self.remove(self.get_job(command))
+        elif cmd == 'priority':
+            self.set_priority(self.get_job(command), command['priority'])
+        elif cmd == 'files':
+            self.set_file_priorities(self.get_job(command), command['priorities'])
+        elif cmd == 'limits':
+            job = self.get_job(command) if 'info_hash' in command else None
+            self.set_rates(job, command.get('download_rate'), command.get('upload_rate'))
+        else:
+            raise ValueError('Unknown command {}'.format(cmd))
+        return {}
+
+    async def on_control(self, reader, writer):
+        """
+        Control connection, one JSON command per line answered by one JSON reply per line
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                try:
+                    reply = await self.handle(json.loads(line))
+                    reply['ok'] = True
+                except Exception as e:
+                    reply = {'ok': False, 'error': str(e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def run(self):
+        """
+        Serves peers and the control API until cancelled
+        """
+        self.http = aiohttp.ClientSession()
+        self.servers = [
+            await asyncio.start_server(self.on_incoming, port=self.port),
+            await asyncio.start_server(self.on_control, host='127.0.0.1', port=self.control_port),
+        ]
+        print('[Daemon] Peers on port {}, control on 127.0.0.1:{}'.format(self.port, self.control_port))
+        watching = asyncio.ensure_future(self.hasher.watch_loop())
+        try:
+            await asyncio.get_event_loop().create_future()
+        finally:
+            self.closing = True
+            watching.cancel()
+            for server in self.servers:
+                server.close()
+            for job in list(self.jobs.values()):
+                await self.stop(job)
+            await self.http.close()
+            self.udp.close()
+            # Every job has waited for its writer, nothing is in flight on the shared disk threads
+            self.disk.close()
+
+
+async def control(command: dict, port: int = 6880) -> dict:
+    """
+    Sends one command to a running daemon
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(json.dumps(command).encode() + b'\n')
+        return json.loads(await reader.readline())
+    finally:
+        writer.close()
+
+
+if __name__ == '__main__':
+    # python daemon.py run [download location]
+    # python daemon.py add <torrent file> [priority] | list
+    # python daemon.py pause <info hash> | resume <info hash> | remove <info hash>
+    loop = asyncio.get_event_loop()
+    if sys.argv[1] == 'run':
+        sys.stdout = Tee(sys.stdout, open('logfile', 'w'))
+        loop.run_until_complete(Daemon(sys.argv[2] if len(sys.argv) > 2 else './downloads').run())
+    else:
+        command = {'cmd': sys.argv[1]}
+        if sys.argv[1] == 'add':
+            command['torrent'] = sys.argv[2]
+            command['priority'] = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        elif len(sys.argv) > 2:
+            command['info_hash'] = sys.argv[2]
+        print(json.dumps(loop.run_until_complete(control(command)), indent=2))
+    loop.close()
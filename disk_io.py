@@ -0,0 +1,212 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileHandleCache:
+    """
+    Least recently used cache of open file descriptors, bounded so torrents with thousands of files do not run
+    out of descriptors while still avoiding an open/close pair per write.
+    Shared by the disk threads: a descriptor is pinned between acquire() and release() and never evicted while
+    pinned, so the cache may briefly grow past its bound when every descriptor is in use
+    """
+    def __init__(self, root: str, max_open: int = 64):
+        self.root = root
+        self.max_open = max_open
+        self.fds = OrderedDict()  # Relative path -> fd, least recently used first
+        self.pins = {}  # Relative path -> number of threads using its fd
+        self.lock = threading.Lock()
+
+    def acquire(self, path: str) -> int:
+        """
+        Returns an open descriptor for a path relative to the root, opening (and creating) the file if needed
+        """
+        with self.lock:
+            fd = self.fds.get(path)
+            if fd is None:
+                fd = os.open(os.path.join(self.root, path), os.O_RDWR | os.O_CREAT)
+                self.fds[path] = fd
+                self._evict()
+            else:
+                self.fds.move_to_end(path)
+            self.pins[path] = self.pins.get(path, 0) + 1
+            return fd
+
+    def release(self, path: str):
+        """
+        Unpins a descriptor returned by acquire()
+        """
+        with self.lock:
+            self.pins[path] -= 1
+            if not self.pins[path]:
+                del self.pins[path]
+            self._evict()
+
+    def _evict(self):
+        for path in list(self.fds):
+            if len(self.fds) <= self.max_open:
+                return
+            if path not in self.pins:
+                os.close(self.fds.pop(path))
+
+    def close(self):
+        """
+        Closes every cached descriptor
+        """
+        with self.lock:
+            while self.fds:
+                _, fd = self.fds.popitem()
+                os.close(fd)
+            self.pins.clear()
+
+
+def pread_into(fd: int, buffer: memoryview, offset: int):
+    """
+    Positional read filling the whole buffer, looping over short reads
+    """
+    read = 0
+    while read < len(buffer):
+        count = os.preadv(fd, [buffer[read:]], offset + read)
+        if not count:
+            raise OSError('Unexpected end of file at {}'.format(offset + read))
+        read += count
+
+
+def pwrite_all(fd: int, data, offset: int):
+    """
+    Positional write of the whole buffer, looping over short writes
+    """
+    written = 0
+    while written < len(data):
+        written += os.pwrite(fd, data[written:], offset + written)
+
+
+class DiskIO:
+    """
+    Disk I/O engine running blocking file operations on a pool of threads, so the event loop only ever awaits them.
+    Operations on different regions of the torrent run in parallel; an operation on a region with a write still
+    in flight waits for that write first, which is the only ordering pieces need. When torrents share the engine
+    their regions may collide on offsets, which only orders them needlessly
+    """
+    def __init__(self, root: str, workers: int = 4, max_open_files: int = 64):
+        self.files = FileHandleCache(root, max_open_files)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='disk-io')
+        self.workers = workers
+        self.pending_writes = {}  # Absolute offset of a region -> future of the write in flight
+
+    def _write(self, segments: list, data):
+        for segment in segments:
+            fd = self.files.acquire(segment.path)
+            try:
+                pwrite_all(fd, data[segment.begin:segment.begin + segment.length], segment.offset)
+            finally:
+                self.files.release(segment.path)
+
+    def _read(self, segments: list, length: int) -> bytearray:
+        data = bytearray(length)
+        with memoryview(data) as view:
+            for segment in segments:
+                fd = self.files.acquire(segment.path)
+                try:
+                    pread_into(fd, view[segment.begin:segment.begin + segment.length], segment.offset)
+                finally:
+                    self.files.release(segment.path)
+        return data
+
+    async def read(self, offset: int, length: int, segments: list) -> bytearray:
+        """
+        Reads a region of the torrent into a new buffer, one positional read per file segment, on a disk thread
+        :param offset: absolute offset of the region, a write of the same region in flight is waited for
+        :param length: region length
+        :param segments: file segments of the region from FileLayout.map
+        """
+        while offset in self.pending_writes:
+            await asyncio.wait([self.pending_writes[offset]])
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self._read, segments, length)
+
+    async def write(self, offset: int, data, segments: list):
+        """
+        Writes a region of the torrent, one positional write per file segment, on a disk thread
+        :param offset: absolute offset of the region, which identifies it
+        :param data: region data, has to stay untouched until the write completes
+        :param segments: file segments of the region from FileLayout.map
+        """
+        while offset in self.pending_writes:
+            await asyncio.wait([self.pending_writes[offset]])
+
+        future = asyncio.get_event_loop().run_in_executor(self.executor, self._write, segments, data)
+        self.pending_writes[offset] = future
+        try:
+            await future
+        finally:
+            if self.pending_writes.get(offset) is future:
+                del self.pending_writes[offset]
+
+    async def wait_writes(self, offsets):
+        """
+        Waits until none of the regions at offsets has a write in flight
+        """
+        while True:
+            pending = [self.pending_writes[offset] for offset in offsets if offset in self.pending_writes]
+            if not pending:
+                return
+            await asyncio.wait(pending)
+
+    async def exclusive(self, offsets, function, *args):
+        """
+        Runs a blocking operation touching the regions at offsets on a disk thread, reads and writes of those
+        regions wait for it like for a write. The regions are taken before the first suspension, callers wait for
+        their writes in flight with wait_writes first
+        """
+        future = asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+        for offset in offsets:
+            self.pending_writes[offset] = future
+        try:
+            return await future
+        finally:
+            for offset in offsets:
+                if self.pending_writes.get(offset) is future:
+                    del self.pending_writes[offset]
+
+    def close(self):
+        """
+        Waits for the disk threads and closes all files
+        """
+        self.executor.shutdown(wait=True)
+        self.files.close()
+
+
+class PieceCache:
+    """
+    Least recently used cache of whole pieces read from disk, bounded by bytes. Peers ask for the blocks of a
+    piece one after the other, so the piece is read once and its following blocks are served from memory
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.pieces = OrderedDict()  # (info hash, piece index) -> piece data, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        data = self.pieces.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pieces.move_to_end(key)
+        return data
+
+    def put(self, key: tuple, data):
+        if key in self.pieces or len(data) > self.max_bytes:
+            return
+        self.pieces[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        return {'pieces': len(self.pieces), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
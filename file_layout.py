@@ -0,0 +1,77 @@
+import bisect
+import os
+from collections import namedtuple
+
+# A contiguous run of bytes inside one file: file index in the torrent, path relative to the download location,
+# offset inside the file, length, and where the run begins inside the mapped byte range
+Segment = namedtuple('Segment', ['file_index', 'path', 'offset', 'length', 'begin'])
+
+
+class FileLayout:
+    """
+    Mapping between the torrent's contiguous byte space and the files it is made of
+    Files are located by bisecting their cumulative end offsets, so mapping a byte range costs O(log files) plus
+    one step per file the range touches
+    """
+    def __init__(self, torrent):
+        self.piece_length: int = torrent._piece_length
+        self.total_length: int = torrent._total_length
+        if torrent.mode == 'multiple':
+            root = torrent.name.decode()
+            self.paths = [os.path.join(root, *[part.decode() for part in file[b'path']]) for file in torrent.files]
+            self.lengths = [file[b'length'] for file in torrent.files]
+            self.ends = list(torrent.fractures)
+        else:
+            self.paths = [torrent.name.decode()]
+            self.lengths = [self.total_length]
+            self.ends = [self.total_length]
+        self.starts = [end - length for end, length in zip(self.ends, self.lengths)]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def map(self, offset: int, length: int) -> list:
+        """
+        Maps an absolute byte range of the torrent onto the files it spans
+        :param offset: absolute offset of the range
+        :param length: length of the range
+        :return: list of Segment, in file order
+        """
+        segments = []
+        file_index = bisect.bisect_right(self.ends, offset)
+        begin = 0
+        while begin < length and file_index < len(self.paths):
+            file_offset = offset + begin - self.starts[file_index]
+            run = min(length - begin, self.lengths[file_index] - file_offset)
+            if run > 0:  # Zero length files never hold any bytes
+                segments.append(Segment(file_index, self.paths[file_index], file_offset, run, begin))
+                begin += run
+            file_index += 1
+        return segments
+
+    def piece_range(self, piece_idx: int) -> tuple:
+        """
+        Absolute offset and length of a piece, the last piece is usually shorter
+        """
+        offset = piece_idx * self.piece_length
+        return offset, min(self.piece_length, self.total_length - offset)
+
+    def piece_segments(self, piece_idx: int) -> list:
+        """
+        Segments of the files a piece is stored in
+        """
+        return self.map(*self.piece_range(piece_idx))
+
+    def file_range(self, file_index: int) -> tuple:
+        """
+        Absolute offset and length of a file
+        """
+        return self.starts[file_index], self.lengths[file_index]
+
+    def file_pieces(self, file_index: int) -> range:
+        """
+        Indexes of the pieces holding bytes of a file, empty for zero length files
+        """
+        if not self.lengths[file_index]:
+            return range(0)
+        return range(self.starts[file_index] // self.piece_length, (self.ends[file_index] - 1) // self.piece_length + 1)
@@ -1,29 +1,201 @@
 import asyncio
 import os
 
+from disk_io import DiskIO, PieceCache, pwrite_all
 
-class FileSaver:
+
+def parts_file(torrent) -> str:
+    """
+    Path of the sparse file holding the bytes of files which are not created, relative to the download location
+    """
+    return '.{}.parts'.format(torrent.info_hash.hex())
+
+
+def map_segments(layout, created_files, parts_path: str, offset: int, length: int) -> list:
+    """
+    File segments of a byte range of the torrent, segments of files which are not created are redirected to the
+    parts file at their offset in the torrent
+    :param created_files: one flag per file, set for files which exist
     """
-    # TODO Implement async write and replace Queue worker with just callback to producer task completions
-    File saver worker(consumer) to pop pieces(topics) and write them synchronously
+    return [
+        segment if created_files[segment.file_index]
+        else segment._replace(path=parts_path, offset=offset + segment.begin)
+        for segment in layout.map(offset, length)
+    ]
+
+
+class PieceReader:
+    """
+    Reads written pieces back through a read cache, a whole piece at a time, to serve the blocks peers request.
+    Bytes of files which are not created are read from the parts file
     """
-    def __init__(self, outdir, torrent):
+    def __init__(self, outdir, torrent, disk: DiskIO, read_cache: PieceCache, created_files: bytearray):
         self.torrent = torrent
+        self.outdir = outdir
+        self.disk = disk
+        self.read_cache = read_cache
+        self.reading = {}  # Piece index -> future of the read in flight, shared by concurrent requests
+        self.parts_path = parts_file(torrent)  # Relative to outdir, like the file paths
+        self.created_files = created_files  # Files pieces are written to
+
+    def segments(self, offset: int, length: int) -> list:
+        """
+        File segments of a byte range of the torrent, segments of files which are not created are redirected to
+        the parts file at their offset in the torrent
+        """
+        return map_segments(self.torrent.layout, self.created_files, self.parts_path, offset, length)
+
+    async def read_piece(self, piece_idx: int) -> bytearray:
+        """
+        Reads a written piece through the read cache, concurrent reads of the same piece share one disk read
+        """
+        key = (self.torrent.info_hash, piece_idx)
+        data = self.read_cache.get(key)
+        if data is not None:
+            return data
+
+        if piece_idx not in self.reading:
+            offset, length = self.torrent.layout.piece_range(piece_idx)
+            self.reading[piece_idx] = asyncio.ensure_future(
+                self.disk.read(offset, length, self.segments(offset, length)))
+        future = self.reading[piece_idx]
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            if future.done() and self.reading.get(piece_idx) is future:
+                del self.reading[piece_idx]
+        self.read_cache.put(key, data)
+        return data
+
+    async def read_block(self, piece_idx: int, begin: int, length: int) -> memoryview:
+        """
+        Block of a written piece, to be sent to a peer
+        """
+        data = await self.read_piece(piece_idx)
+        return memoryview(data)[begin:begin + length]
+
+
+class FileSaver(PieceReader):
+    """
+    File saver worker(consumer) to pop pieces(topics) and hand them to the disk I/O engine, which writes them on
+    its threads. Completed writes are reported through on_piece_written, failed ones through on_piece_failed.
+    Blocks requested by peers are read back as by a PieceReader.
+    The disk I/O engine and the read cache can be shared by the savers of several torrents.
+    Skipped files are not created. The bytes of pieces shared with wanted files which fall into skipped files go to
+    a sparse parts file at their offset in the torrent instead, and are moved over if the file is created later
+    """
+    def __init__(self, outdir, torrent, disk_workers=4, max_open_files=64, read_cache_size=64 * 1024 * 1024,
+                 disk: DiskIO = None, read_cache: PieceCache = None, file_priorities: list = None):
+        # Files from a previous run are kept in use even if skipped now
+        created_files = bytearray(os.path.exists(os.path.join(outdir, path)) for path in torrent.layout.paths)
+        super().__init__(outdir, torrent, disk or DiskIO(outdir, disk_workers, max_open_files),
+                         read_cache or PieceCache(read_cache_size), created_files)
         self.file_path = os.path.join(outdir, torrent.name.decode())
-        self.file_name = ""
-        if self.torrent.mode == 'multiple':
-            if not os.path.isdir(self.file_path):
-                print("Creating dir", self.file_path)
-                os.mkdir(self.file_path)
-                # Name in multiple mode becomes directory name, so created that directory if it does not exist
-
-        else:
-            # single file mode
-            self.fd = os.open(self.file_path,
-                              os.O_RDWR | os.O_CREAT)  # File_Path is the File_Name in the single file mode
+        self.on_piece_written = None  # Callback taking the index of a piece once it is on disk
+        self.on_piece_failed = None  # Callback taking the index of a piece which could not be written
+
+        layout = self.torrent.layout
+        self.create_files([
+            file_index for file_index in range(len(layout))
+            if (file_priorities is None or file_priorities[file_index]) and not self.created_files[file_index]
+        ])
 
         self.received_pieces_queue = asyncio.Queue()
-        asyncio.ensure_future(self.write())
+        # Pieces handed to the disk threads at once, more would only wait in the executor's queue
+        self.max_writes_in_flight = 2 * self.disk.workers
+        self.writes_in_flight = asyncio.Semaphore(self.max_writes_in_flight)
+        self.writing = asyncio.ensure_future(self.write())  # Done once the poison pill's predecessors are written
+
+    def create_files(self, file_indexes: list):
+        """
+        Sets files up for writing while no write is running, moving over bytes of theirs which were stored in the
+        parts file
+        """
+        self.make_dirs(file_indexes)
+        self.move_all_parts(file_indexes)
+        for file_index in file_indexes:
+            self.created_files[file_index] = 1
+
+    def make_dirs(self, file_indexes: list):
+        """
+        Creates the directories of files, only zero length files and single files are created right away, the
+        others when first written to
+        """
+        layout = self.torrent.layout
+        has_parts = os.path.exists(os.path.join(self.outdir, self.parts_path))
+        file_dirs = set()
+        for file_index in file_indexes:
+            path = os.path.join(self.outdir, layout.paths[file_index])
+            # Name in multiple mode becomes directory name, files may be nested in sub directories of it
+            file_dir = os.path.dirname(path)
+            if file_dir not in file_dirs and not os.path.isdir(file_dir):
+                print("Creating dir", file_dir)
+                os.makedirs(file_dir, exist_ok=True)
+            file_dirs.add(file_dir)
+
+            if not has_parts and (not layout.lengths[file_index] or self.torrent.mode == 'single'):
+                # Zero length files are never touched by a piece
+                os.close(os.open(path, os.O_RDWR | os.O_CREAT))
+
+    def move_all_parts(self, file_indexes: list):
+        """
+        Moves the bytes of files stored in the parts file over to the files
+        """
+        parts_path = os.path.join(self.outdir, self.parts_path)
+        if not os.path.exists(parts_path):
+            return
+        parts = os.open(parts_path, os.O_RDONLY)
+        try:
+            for file_index in file_indexes:
+                self.move_parts(file_index, parts, os.path.join(self.outdir, self.torrent.layout.paths[file_index]))
+        finally:
+            os.close(parts)
+
+    def move_parts(self, file_index: int, parts: int, path: str):
+        """
+        Copies the bytes of a file from the parts file into the file, only its first and last pieces can have been
+        downloaded while it was skipped
+        """
+        layout = self.torrent.layout
+        start, length = layout.file_range(file_index)
+        pieces = layout.file_pieces(file_index)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            for piece_idx in sorted({pieces[0], pieces[-1]} if pieces else ()):
+                offset, piece_length = layout.piece_range(piece_idx)
+                begin, end = max(offset, start), min(offset + piece_length, start + length)
+                data = os.pread(parts, end - begin, begin)
+                if data.strip(b'\x00'):
+                    pwrite_all(fd, data, begin - start)
+        finally:
+            os.close(fd)
+
+    async def set_file_priorities(self, priorities: list):
+        """
+        Creates the files which are not skipped anymore, while pieces are being written
+        Only the first and last pieces of a file can have bytes in the parts file. Writes in flight of those pieces
+        go to the parts file and are waited for, then the files are flagged created so later writes go to them,
+        and the move runs as a disk operation on those pieces' regions which their reads and writes wait for
+        """
+        file_indexes = [
+            file_index for file_index, priority in enumerate(priorities)
+            if priority and not self.created_files[file_index]
+        ]
+        if not file_indexes:
+            return
+        await asyncio.get_event_loop().run_in_executor(None, self.make_dirs, file_indexes)
+
+        layout = self.torrent.layout
+        offsets = set()
+        for file_index in file_indexes:
+            pieces = layout.file_pieces(file_index)
+            if pieces:
+                offsets.update(layout.piece_range(piece_idx)[0] for piece_idx in (pieces[0], pieces[-1]))
+        await self.disk.wait_writes(offsets)
+        # Nothing runs on the loop between the wait and the move taking over the regions
+        for file_index in file_indexes:
+            self.created_files[file_index] = 1
+        await self.disk.exclusive(offsets, self.move_all_parts, file_indexes)
 
     def get_received_pieces_queue(self):
         """
@@ -34,58 +206,42 @@ class FileSaver:
 
     async def write(self):
         """
-        # TODO Separate out worker and writing corouting
-           And handle errors by requeuing the piece and not performing cleanups, if cleaned up, update piece DL status
-        Piece writing coroutine with an infinite blocking worker
+        Piece writing coroutine with an infinite worker, dispatching each piece to the disk threads
         """
         while True:
-            piece = await asyncio.wait_for(self.received_pieces_queue.get(), timeout=5)
+            piece = await self.received_pieces_queue.get()
             if not piece:
                 print("Poison pill. Exiting")
+                for _ in range(self.max_writes_in_flight):
+                    # Every write in flight holds the semaphore until it is done
+                    await self.writes_in_flight.acquire()
+                return
+
+            await self.writes_in_flight.acquire()
+            asyncio.ensure_future(self.write_piece(*piece))
+
+    async def write_piece(self, piece_abs_location, piece_data, piece_instance):
+        """
+        Writes one piece over the file segments it spans
+        :param piece_abs_location: absolute offset of the piece in the torrent
+        :param piece_data: piece data
+        :param piece_instance: Piece being written
+        """
+        try:
+            segments = self.segments(piece_abs_location, len(piece_data))
+            print("Writing Piece {} at {} over {} file(s)".format(
+                piece_instance.index, piece_abs_location, len(segments)))  # Don't print piece_data for readability
+            await self.disk.write(piece_abs_location, piece_data, segments)
+        except OSError as e:
+            print("Failed writing Piece {}\n{}".format(piece_instance.index, e))
+            piece_instance.flush()
+            if self.on_piece_failed:
+                self.on_piece_failed(piece_instance.index)
+            return
+        finally:
+            self.writes_in_flight.release()
 
-            piece_abs_location, file_idx, piece_data, in_conflict, fracture, file_name, piece_instance = piece
-            # piece_abs_location to be changed to file's index
-            print("Writing a Piece")
-            print("Name: {} Conflicted: {} PIECE ABS LOCATION: {} FRACTURE POINT: {} LOCATION IN FILE: {}".format(
-                file_name, in_conflict, piece_abs_location, fracture,
-                file_idx))  # Don't print piece_data for the sake of readability
-
-            # HANDLE THE SINGLE FILE CASE SEPARATELY FROM NON CONFLICT
-            if self.torrent.mode == 'single':
-                os.lseek(self.fd, piece_abs_location, os.SEEK_SET)
-                # Piece index is the File index in case of single file
-                os.write(self.fd, piece_data)
-                piece_instance.flush()  # Remove from RAM after writing to disk
-                print("Piece {} WR".format(piece_instance.index))
-            else:
-                if not in_conflict:
-                    self.file_name = os.path.join(self.file_path, file_name)
-                    # File_name won't change so created beforehand
-                    self.fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT)
-                    os.lseek(self.fd, file_idx, os.SEEK_SET)  # FIND FILE INDEX FOR THE PIECE IN ITS FILE
-                    os.write(self.fd, piece_data)
-                    piece_instance.flush()  # Remove from RAM after writing to disk
-                    os.close(self.fd)
-                    print("Piece {} WR".format(piece_instance.index))
-                else:
-                    print("Writing a fractured piece")
-                    current_file, next_file = file_name.split('|')
-                    print(current_file, next_file)
-                    # File names are changing, so creation on the fly
-
-                    # FIRST FRAGMENT
-                    self.fd = os.open(os.path.join(self.file_path, current_file), os.O_RDWR | os.O_CREAT)
-                    os.lseek(self.fd, file_idx, os.SEEK_SET)  # Go to the File index for the piece
-                    os.write(self.fd, piece_data[:(fracture - piece_abs_location)])
-                    # Write first fragment of the piece from beg upto length of \
-                    # first fragment (fracture point - piece_abs_location)
-                    os.close(self.fd)
-                    # SECOND FRAGMENT
-                    self.fd = os.open(os.path.join(self.file_path, next_file), os.O_RDWR | os.O_CREAT)
-                    os.lseek(self.fd, 0, os.SEEK_SET)  # Go to beginning of the next file
-                    os.write(self.fd, piece_data[(fracture - piece_abs_location):])
-                    # Write second fragment of the piece from fracture point to end
-                    piece_instance.flush()  # Remove from RAM after writing to disk
-                    os.close(self.fd)
-                    print("Piece {} WR".format(piece_instance.index))
-                    # Two fragments for one piece therefore only logged as written once
+        piece_instance.flush()  # Remove from RAM after writing to disk
+        print("Piece {} WR".format(piece_instance.index))
+        if self.on_piece_written:
+            self.on_piece_written(piece_instance.index)
@@ -0,0 +1,58 @@
+import struct
+
+
+class MessageFramer:
+    """
+    Incremental decoder for length prefixed peer wire messages
+    Received bytes are appended to a single bytearray and every message is handed out as a memoryview into it,
+    so message payloads are never re-sliced or copied between the socket and their handler
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0  # Start of the first message not consumed yet
+
+    def feed(self, data: bytes):
+        """
+        Appends data read from the socket to the buffer, dropping already consumed messages first
+        :param data: bytes read from the peer
+        """
+        if self.offset:
+            # Only the tail of a partially received message is moved, which is at most one message per read
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def __len__(self):
+        return len(self.buffer) - self.offset
+
+    def messages(self):
+        """
+        Generator of complete messages in the buffer as (message id, payload) tuples, message id is None for
+        a keep alive. A payload is a memoryview which is released as soon as the next message is requested,
+        handlers have to copy whatever they want to keep
+        """
+        view = memoryview(self.buffer)
+        try:
+            while True:
+                available = len(self.buffer) - self.offset
+                if available < 4:
+                    return
+
+                length, = struct.unpack_from('>I', self.buffer, self.offset)
+                if available < 4 + length:
+                    return
+
+                start = self.offset + 4
+                self.offset = start + length
+
+                if length == 0:
+                    yield None, None
+                    continue
+
+                payload = view[start + 1:start + length]
+                try:
+                    yield self.buffer[start], payload
+                finally:
+                    payload.release()
+        finally:
+            view.release()
@@ -0,0 +1,74 @@
+import asyncio
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def sha1_timed(data) -> tuple:
+    """
+    SHA1 digest of data along with the seconds it took, runs in a hashing worker
+    """
+    start = time.perf_counter()
+    digest = hashlib.sha1(data).digest()
+    return digest, time.perf_counter() - start
+
+
+class PieceHasher:
+    """
+    Piece verification off the event loop
+    hashlib releases the GIL while hashing large buffers, so a thread pool already hashes on several cores without
+    copying the piece; a process pool can be used instead at the cost of pickling every piece
+    """
+    def __init__(self, workers: int = 2, processes: bool = False):
+        self.processes = processes
+        if processes:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher')
+
+        self.hashed_pieces = 0
+        self.hashed_bytes = 0
+        self.hash_seconds = 0.0  # Time spent hashing, summed over workers
+        self.loop_stall = 0.0  # Last measured lateness of the event loop
+        self.max_loop_stall = 0.0
+
+    async def verify(self, data, expected_hash: bytes) -> bool:
+        """
+        Checks piece data against its expected SHA1 digest on a worker
+        :param data: piece data, has to stay untouched until verified
+        :param expected_hash: digest from the torrent metadata
+        :return: True if the digests match
+        """
+        if self.processes:
+            data = bytes(data)  # Views can't be pickled
+        digest, seconds = await asyncio.get_event_loop().run_in_executor(self.executor, sha1_timed, data)
+        self.hashed_pieces += 1
+        self.hashed_bytes += len(data)
+        self.hash_seconds += seconds
+        return digest == expected_hash
+
+    @property
+    def throughput(self) -> float:
+        """
+        Hashing throughput of a single worker in bytes per second
+        """
+        return self.hashed_bytes / self.hash_seconds if self.hash_seconds else 0.0
+
+    async def watch_loop(self, interval: float = 0.1):
+        """
+        Measures how late the event loop wakes up from a sleep, which is how long something blocked it
+        """
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            self.loop_stall = max(0.0, time.monotonic() - start - interval)
+            self.max_loop_stall = max(self.max_loop_stall, self.loop_stall)
+
+    def stats(self) -> dict:
+        return {
+            'hashed pieces': self.hashed_pieces,
+            'hashed bytes': self.hashed_bytes,
+            'hash throughput': self.throughput,
+            'loop stall': self.loop_stall,
+            'max loop stall': self.max_loop_stall,
+        }
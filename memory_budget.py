@@ -0,0 +1,39 @@
+import weakref
+
+
+class MemoryBudget:
+    """
+    Bytes of piece buffers held in memory, shared by the sessions of a process
+    A piece's length is reserved when it is picked and released once it is written, or dropped after a failed hash
+    check or by its peer, so the budget covers pieces in progress, pieces being verified and the write queue alike.
+    While it is exhausted peers only finish the pieces they have, and they are woken up as writes drain
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self.full = False
+        self.sessions = weakref.WeakSet()  # Sessions whose peers are woken up when memory is released
+
+    def has_room(self, length: int) -> bool:
+        """
+        True if a new piece fits, a single piece always does
+        """
+        if self.used and self.used + length > self.max_bytes:
+            self.full = True
+            return False
+        return True
+
+    def reserve(self, length: int):
+        self.used += length
+        self.peak = max(self.peak, self.used)
+
+    def release(self, length: int):
+        self.used -= length
+        if self.full:
+            self.full = False
+            for session in list(self.sessions):
+                session.wake_peers()
+
+    def stats(self) -> dict:
+        return {'max': self.max_bytes, 'used': self.used, 'peak': self.peak}
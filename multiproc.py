@@ -0,0 +1,710 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+from multiprocessing import shared_memory
+
+import bitstring
+
+from choker import Choker
+from disk_io import DiskIO, PieceCache
+from file_saver import FileSaver, PieceReader
+from hasher import PieceHasher
+from piece_picker import is_seed
+from pytor import DownloadSession, Piece, PieceSet, Tee
+from ratelimit import RateLimiter
+from resume import ResumeData
+from swarm import Swarm
+from torrent import Torrent
+from tracker import Announcer
+
+# Messages between the coordinator and its workers are tuples of a kind and its arguments, sent over a pipe.
+# Worker -> coordinator:
+#   ('increment', piece index), ('add_peer', bitfield), ('remove_peer', bitfield)  availability of the worker's peers
+#   ('lease', key, bitfield, count)  asks for pieces a peer has, answered with 'leased'
+#   ('return', [piece index])  leased pieces none of the worker's peers has anymore
+#   ('verified', piece index, slot)  a verified piece waits in a slot of the worker's shared memory
+#   ('stats', downloaded, uploaded, connections)
+# Coordinator -> worker:
+#   ('leased', key, [piece index], exhausted), ('free', slot) once the piece in the slot is written,
+#   ('have', piece index), ('wanted',) when pieces went back to the picker, ('peers', [(host, port)]), ('complete',)
+
+
+class RemotePicker:
+    """
+    Availability side of the piece picker in a worker, forwarded to the coordinator's picker
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def increment(self, piece_idx: int):
+        """
+        A peer announced a piece with HAVE
+        """
+        self.session.send('increment', piece_idx)
+
+    def on_have(self, have_pieces, piece_idx: int):
+        """
+        A peer announced a piece with HAVE, a peer completing its bitfield is moved over to the coordinator's seeds
+        as PiecePicker.on_have does
+        """
+        if is_seed(have_pieces):
+            previous = have_pieces.copy()
+            previous[piece_idx] = False
+            self.remove_peer(previous)
+            self.add_peer(have_pieces)
+        else:
+            self.increment(piece_idx)
+
+    def add_peer(self, have_pieces):
+        """
+        Counts every piece of a peer's bitfield, nothing is sent for peers having nothing
+        """
+        if have_pieces.any(1):
+            self.session.send('add_peer', have_pieces.tobytes())
+
+    def remove_peer(self, have_pieces):
+        """
+        Uncounts every piece of a peer's bitfield
+        """
+        if have_pieces.any(1):
+            self.session.send('remove_peer', have_pieces.tobytes())
+
+
+class WorkerSession:
+    """
+    Stand in for a DownloadSession in a worker process, serving the worker's peers
+    Pieces are leased from the coordinator a few at a time and downloaded straight into slots of a shared memory
+    slab, then verified on the worker's own hashing threads. The coordinator writes verified pieces from the slab
+    and frees their slots, no piece data goes through the pipe
+    """
+    LEASE_SIZE = 2  # Pieces asked for at once
+
+    def __init__(self, torrent: Torrent, reader: PieceReader, conn, slab: shared_memory.SharedMemory, slots: int,
+                 written_bitfield: bytes, download_rate: int = 0, upload_rate: int = 0):
+        self.torrent = torrent
+        self.info_hash = torrent.info_hash
+        self.piece_size = torrent.layout.piece_length
+        self.number_of_pieces = torrent.number_of_pieces
+        self.conn = conn
+        self.slab = slab
+        self.free_slots = list(range(slots))
+        self.slots = {}  # Piece index -> slot holding its data
+
+        self.picker = RemotePicker(self)
+        self.pieces = {}  # Pieces in progress or partially downloaded, with a slot each
+        self.pieces_in_progress = {}
+        self.leased = []  # Pieces leased and not started yet
+        self.partial = []  # Released pieces with some blocks downloaded, started first
+        self.leasing = set()  # Keys of the lease requests in flight
+        self.exhausted = False  # The coordinator has nothing left to lease, the worker may go into endgame
+        self.endgame = False
+        self.complete = False
+        self.swarm = None
+
+        self.written_pieces = PieceSet(self.number_of_pieces)
+        for piece_idx in range(self.number_of_pieces):
+            if written_bitfield[piece_idx >> 3] & (0x80 >> (piece_idx & 7)):
+                self.written_pieces.add(piece_idx)
+
+        self.peers = set()
+        self.choker = Choker(self)
+        self.limiter = RateLimiter(download_rate, upload_rate)
+        self.peer_rates = (0, 0)
+        self.hasher = PieceHasher()
+        self.verifying = set()  # Hashing tasks, each holding a view of its piece's slot
+        self.file_saver = reader  # Reads blocks for uploads, the coordinator does the writing
+        self.downloaded = 0
+        self.uploaded = 0
+        self.left = torrent.layout.total_length  # Trackers are announced to by the coordinator
+
+    def send(self, *message):
+        """
+        Sends a message to the coordinator
+        """
+        self.conn.send(message)
+
+    def is_complete(self) -> bool:
+        """
+        True once the coordinator has every piece on disk, which ends the worker
+        """
+        return self.complete
+
+    def start_piece(self, piece_idx: int):
+        """
+        Piece in progress of an index, in a free slot unless it has one already
+        """
+        piece = self.pieces.get(piece_idx)
+        if piece is None:
+            if not self.free_slots:
+                return None
+            slot = self.free_slots.pop()
+            piece = Piece(piece_idx, self.torrent.layout.piece_range(piece_idx)[1])
+            piece.buffer = self.slab.buf[slot * self.piece_size:slot * self.piece_size + piece.length]
+            self.slots[piece_idx] = slot
+            self.pieces[piece_idx] = piece
+        self.pieces_in_progress[piece_idx] = piece
+        return piece
+
+    def get_piece_request(self, have_pieces, exclude=()):
+        """
+        Next piece for a peer: partial pieces, then leased ones, then endgame once the coordinator is out of pieces
+        """
+        for pieces in (self.partial, self.leased):
+            for position, piece_idx in enumerate(pieces):
+                if have_pieces[piece_idx]:
+                    piece = self.start_piece(piece_idx)
+                    if piece is None:
+                        return None  # Out of slots until the coordinator writes some
+                    del pieces[position]
+                    return piece
+
+        self.request_lease(have_pieces)
+        if self.exhausted:
+            return self.get_endgame_piece(have_pieces, exclude)
+        return None
+
+    def request_lease(self, have_pieces):
+        """
+        Asks the coordinator for pieces a peer has, unless the leased pieces already fill the free slots
+        The bitfield's id tells the answers apart, at most one lease per peer is in flight
+        """
+        key = id(have_pieces)
+        if self.exhausted or key in self.leasing or len(self.free_slots) <= len(self.leased):
+            return
+        self.leasing.add(key)
+        self.send('lease', key, have_pieces.tobytes(), self.LEASE_SIZE)
+
+    def get_endgame_piece(self, have_pieces, exclude=()):
+        """
+        Endgame among the worker's own pieces in progress
+        """
+        candidates = [
+            piece for piece_idx, piece in self.pieces_in_progress.items()
+            if piece_idx not in exclude and have_pieces[piece_idx] and not piece.is_complete()
+        ]
+        if not candidates:
+            return None
+        self.endgame = True
+        return max(candidates, key=lambda piece: piece.downloaded_blocks.count(False))
+
+    def on_block_received(self, piece_idx: int, begin: int, data, peer=None):
+        """
+        Saves a block into its piece's slot, and verifies the piece once complete
+        """
+        if piece_idx not in self.pieces_in_progress:
+            return
+        piece = self.pieces_in_progress[piece_idx]
+        if not piece.save_block(begin, data):
+            return
+        self.downloaded += len(data)
+
+        if self.endgame:
+            for other in self.peers:
+                if other is not peer:
+                    other.cancel(piece_idx, begin, len(data))
+
+        if piece.is_complete():
+            verifying = asyncio.ensure_future(self.verify_piece(piece))
+            self.verifying.add(verifying)
+            verifying.add_done_callback(self.verifying.discard)
+
+    async def verify_piece(self, piece: Piece):
+        """
+        Checks a complete piece against its hash, a valid piece is handed to the coordinator in its slot and a
+        corrupt one is downloaded again by this worker
+        """
+        piece_idx = piece.index
+        is_valid = await self.hasher.verify(piece.data, self.torrent.get_piece_hash(piece_idx))
+        self.pieces.pop(piece_idx, None)
+        self.pieces_in_progress.pop(piece_idx, None)
+        self.release_buffer(piece)
+        slot = self.slots.pop(piece_idx)
+
+        if not is_valid:
+            print('Hash check failed for Piece {}'.format(piece_idx))
+            self.free_slots.append(slot)
+            self.leased.insert(0, piece_idx)
+            self.wake_peers()
+            return
+        # The slot stays taken until the coordinator wrote the piece
+        self.send('verified', piece_idx, slot)
+
+    def release_pieces(self, piece_indexes):
+        """
+        Takes pieces back from a peer which is gone or choked us, pieces none of the other peers has go back to
+        the coordinator, even partially downloaded ones
+        """
+        released = 0
+        returned = []
+        for piece_idx in piece_indexes:
+            piece = self.pieces_in_progress.get(piece_idx)
+            if not piece or piece.is_complete():
+                continue
+            del self.pieces_in_progress[piece_idx]
+            released += 1
+            if not self.can_download(piece_idx):
+                self.drop_piece(piece_idx)
+                returned.append(piece_idx)
+            elif any(piece.downloaded_blocks):
+                self.partial.append(piece_idx)
+            else:
+                self.drop_piece(piece_idx)
+                self.leased.insert(0, piece_idx)
+
+        if returned:
+            self.send('return', returned)
+        if released:
+            self.endgame = False
+            self.wake_peers()
+
+    def can_download(self, piece_idx: int) -> bool:
+        """
+        True if one of the connected peers has the piece
+        """
+        return any(peer.have_pieces[piece_idx] for peer in self.peers)
+
+    def drop_piece(self, piece_idx: int):
+        """
+        Forgets the blocks of a piece and frees its slot
+        """
+        piece = self.pieces.pop(piece_idx, None)
+        if piece is not None:
+            self.release_buffer(piece)
+            self.free_slots.append(self.slots.pop(piece_idx))
+
+    @staticmethod
+    def release_buffer(piece: Piece):
+        """
+        Releases a piece's view of its slot, a peer's block generator may keep the piece around for a while
+        """
+        piece.buffer.release()
+        piece.buffer = None
+
+    def wake_peers(self):
+        """
+        Lets every connected peer request blocks again
+        """
+        for peer in list(self.peers):
+            peer.wake()
+
+    def on_messages(self):
+        """
+        Handles the messages waiting in the pipe
+        """
+        while self.conn.poll():
+            try:
+                kind, *args = self.conn.recv()
+            except EOFError:
+                # Coordinator is gone
+                asyncio.get_event_loop().remove_reader(self.conn.fileno())
+                self.complete = True
+                return
+
+            if kind == 'leased':
+                key, pieces, exhausted = args
+                self.leasing.discard(key)
+                self.leased.extend(pieces)
+                self.exhausted = exhausted and not pieces
+                self.wake_peers()
+            elif kind == 'free':
+                self.free_slots.append(args[0])
+                self.wake_peers()
+            elif kind == 'have':
+                self.written_pieces.add(args[0])
+                for peer in list(self.peers):
+                    peer.send_have(args[0])
+            elif kind == 'wanted':
+                self.exhausted = False
+                self.wake_peers()
+            elif kind == 'peers':
+                self.swarm.add_candidates(args[0])
+                self.swarm.connect_peers()
+            elif kind == 'complete':
+                self.complete = True
+
+    async def report(self, interval: float = 1):
+        """
+        Sends transfer totals to the coordinator, and returns the pieces waiting to be started which none of the
+        peers has anymore, partially downloaded ones included, or the coordinator would never lease them again
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.send('stats', self.downloaded, self.uploaded, len(self.peers))
+            orphans = [
+                piece_idx for piece_idx in self.leased + self.partial if not self.can_download(piece_idx)
+            ]
+            if orphans:
+                self.leased = [piece_idx for piece_idx in self.leased if piece_idx not in orphans]
+                self.partial = [piece_idx for piece_idx in self.partial if piece_idx not in orphans]
+                for piece_idx in orphans:
+                    self.drop_piece(piece_idx)
+                self.send('return', orphans)
+                self.wake_peers()
+
+    async def close(self):
+        """
+        Releases every view of the slab, so it can be closed: hashing is cancelled and its threads waited for,
+        the pieces left get their views released
+        """
+        for verifying in self.verifying:
+            verifying.cancel()
+        await asyncio.gather(*self.verifying, return_exceptions=True)
+        # A cancelled hash goes on in its thread, reading the piece's view
+        self.hasher.executor.shutdown(wait=True)
+        for peer in self.peers:
+            peer.blocks = None
+        for piece in self.pieces.values():
+            self.release_buffer(piece)
+        self.pieces = {}
+        self.pieces_in_progress = {}
+
+
+async def run_worker(torrent_file: str, outdir: str, conn, slab_name: str, slots: int, peer_id: bytes,
+                     written_bitfield: bytes, created_files: bytes, read_cache_size: int, max_connections: int,
+                     port: int, download_rate: int, upload_rate: int):
+    """
+    Serves a share of the peers until the coordinator has every piece
+    """
+    torrent = Torrent(torrent_file)
+    torrent.peer_id = peer_id  # One client to the swarm, whichever process a peer talks to
+    slab = shared_memory.SharedMemory(name=slab_name)
+    # Only reads for uploads, a small disk pool is enough
+    reader = PieceReader(outdir, torrent, DiskIO(outdir, 2, 16), PieceCache(read_cache_size), bytearray(created_files))
+    session = WorkerSession(torrent, reader, conn, slab, slots, written_bitfield, download_rate, upload_rate)
+    announcer = Announcer(torrent, port)
+    announcer.trackers = []  # Peers come from the coordinator
+    session.swarm = Swarm(session, torrent, max_connections, port, announcer=announcer)
+
+    loop = asyncio.get_event_loop()
+    loop.add_reader(conn.fileno(), session.on_messages)
+    await session.swarm.listen(reuse_port=True)
+    reporting = asyncio.ensure_future(session.report())
+    try:
+        await session.swarm.run()
+    finally:
+        reporting.cancel()
+        loop.remove_reader(conn.fileno())
+        try:
+            session.send('stats', session.downloaded, session.uploaded, 0)
+        except OSError:
+            pass  # Coordinator is gone
+        reader.disk.close()
+        await session.close()
+        slab.close()
+
+
+def worker_main(*args):
+    """
+    Entry point of a worker process
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run_worker(*args))
+    finally:
+        loop.close()
+
+
+class SharedPiece:
+    """
+    Verified piece waiting in a worker's slot, handed to the writer like a Piece
+    """
+    __slots__ = ('index', 'length', 'buffer', 'on_flush')
+
+    def __init__(self, index: int, length: int, buffer: memoryview, on_flush):
+        self.index = index
+        self.length = length
+        self.buffer = buffer
+        self.on_flush = on_flush
+
+    @property
+    def data(self) -> memoryview:
+        """
+        View of the piece in the worker's shared memory
+        """
+        return self.buffer
+
+    def flush(self):
+        """
+        The piece is written, its slot goes back to the worker
+        """
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+            self.on_flush()
+
+
+class Worker:
+    """
+    Coordinator's handle of a worker process
+    """
+    def __init__(self, index: int, process, conn, slab: shared_memory.SharedMemory):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.slab = slab
+        self.leased = set()  # Pieces the worker holds, handed back to the picker if it dies
+        self.downloaded = 0
+        self.uploaded = 0
+        self.connections = 0
+        self.alive = True
+
+    def send(self, *message):
+        """
+        Sends a message to the worker, unless it exited
+        """
+        if self.alive:
+            try:
+                self.conn.send(message)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # Exited meanwhile, the end of its messages tells the coordinator
+
+
+class Coordinator:
+    """
+    Multi-process download engine
+    Worker processes each run their own event loop with a share of the peer connections, and do the framing,
+    block bookkeeping and hashing for them. The coordinator owns the piece picker, the trackers and the disk
+    writer: it leases pieces to workers, spreads the peers found by the trackers over them and writes verified
+    pieces straight out of the workers' shared memory. Workers share the listening port, the kernel spreads
+    incoming connections over them
+    """
+    def __init__(self, torrent_file: str, download_location: str, workers: int = None,
+                 max_connections: int = 30, memory: int = 256 * 1024 * 1024, download_rate: int = 0,
+                 upload_rate: int = 0, port: int = 6881, read_cache_size: int = 64 * 1024 * 1024):
+        self.torrent_file = torrent_file
+        self.download_location = download_location
+        self.worker_count = workers or os.cpu_count()
+        self.max_connections = max_connections  # Per worker
+        self.memory = memory  # Bytes of shared memory over all workers
+        self.read_cache_size = read_cache_size  # Bytes of the workers' read caches together
+        self.rates = (download_rate // self.worker_count, upload_rate // self.worker_count)
+        self.port = port
+
+        self.workers = []
+        self.known = set()  # Peers handed to a worker already
+        self.next_worker = 0
+        self.session = None
+
+    def start_workers(self, torrent: Torrent):
+        """
+        Spawns the workers, each with a slab of shared memory of the coordinator's memory budget
+        """
+        context = multiprocessing.get_context('spawn')
+        piece_size = torrent.layout.piece_length
+        slots = max(4, self.memory // (self.worker_count * piece_size))
+        for index in range(self.worker_count):
+            conn, child_conn = context.Pipe()
+            slab = shared_memory.SharedMemory(create=True, size=slots * piece_size)
+            process = context.Process(target=worker_main, daemon=True, args=(
+                self.torrent_file, self.download_location, child_conn, slab.name, slots, torrent.peer_id,
+                bytes(self.session.written_pieces.bitfield), bytes(self.session.file_saver.created_files),
+                max(self.read_cache_size // self.worker_count, piece_size), self.max_connections, self.port,
+                *self.rates
+            ))
+            process.start()
+            child_conn.close()
+            worker = Worker(index, process, conn, slab)
+            asyncio.get_event_loop().add_reader(conn.fileno(), self.on_messages, worker)
+            self.workers.append(worker)
+        print('[Coordinator] {} workers with {} slots of shared memory each'.format(self.worker_count, slots))
+
+    def broadcast(self, *message):
+        """
+        Sends a message to every worker
+        """
+        for worker in self.workers:
+            worker.send(*message)
+
+    def bitarray(self, bitfield: bytes):
+        """
+        BitArray of a bitfield sent by a worker
+        """
+        return bitstring.BitArray(bytes=bitfield, length=self.session.number_of_pieces)
+
+    def on_messages(self, worker: Worker):
+        """
+        Handles the messages a worker sent
+        """
+        session = self.session
+        while worker.alive and worker.conn.poll():
+            try:
+                kind, *args = worker.conn.recv()
+            except (EOFError, ConnectionResetError):
+                # Reset when it exits with messages of ours unread
+                self.on_worker_lost(worker)
+                return
+
+            if kind == 'increment':
+                session.picker.increment(args[0])
+            elif kind == 'add_peer':
+                session.picker.add_peer(self.bitarray(args[0]))
+            elif kind == 'remove_peer':
+                session.picker.remove_peer(self.bitarray(args[0]))
+            elif kind == 'lease':
+                key, bitfield, count = args
+                have_pieces = self.bitarray(bitfield)
+                pieces = []
+                while len(pieces) < count:
+                    piece_idx = session.picker.pick(have_pieces)
+                    if piece_idx is None:
+                        break
+                    pieces.append(piece_idx)
+                worker.leased.update(pieces)
+                worker.send('leased', key, pieces, not session.picker.has_wanted())
+            elif kind == 'return':
+                for piece_idx in args[0]:
+                    worker.leased.discard(piece_idx)
+                    session.picker.release(piece_idx)
+                self.broadcast('wanted')
+            elif kind == 'verified':
+                piece_idx, slot = args
+                worker.leased.discard(piece_idx)
+                length = session.torrent.layout.piece_range(piece_idx)[1]
+                start = slot * session.piece_size
+                session.on_piece_verified(SharedPiece(
+                    piece_idx, length, worker.slab.buf[start:start + length],
+                    lambda worker=worker, slot=slot: worker.send('free', slot)
+                ))
+            elif kind == 'stats':
+                worker.downloaded, worker.uploaded, worker.connections = args
+                session.downloaded = sum(worker.downloaded for worker in self.workers)
+                session.uploaded = sum(worker.uploaded for worker in self.workers)
+
+    def on_worker_lost(self, worker: Worker):
+        """
+        Takes the pieces of a worker which exited back into the picker
+        """
+        print('[Coordinator] Worker {} exited'.format(worker.index))
+        worker.alive = False
+        asyncio.get_event_loop().remove_reader(worker.conn.fileno())
+        for piece_idx in worker.leased:
+            self.session.picker.release(piece_idx)
+        worker.leased.clear()
+        self.broadcast('wanted')
+
+    def on_piece_written(self, piece_idx: int):
+        """
+        A piece is on disk, the workers announce it to their peers
+        """
+        self.session.on_piece_written(piece_idx)
+        self.broadcast('have', piece_idx)
+
+    def on_piece_failed(self, piece_idx: int):
+        """
+        A piece could not be written, it is back up for picking and the workers ask for leases again
+        """
+        self.session.on_piece_failed(piece_idx)
+        self.broadcast('wanted')
+
+    def add_candidates(self, addresses):
+        """
+        Spreads new peers over the workers, round robin
+        """
+        shares = {}
+        alive = [worker for worker in self.workers if worker.alive]
+        for address in addresses:
+            address = tuple(address)
+            if address in self.known or not alive:
+                continue
+            self.known.add(address)
+            worker = alive[self.next_worker % len(alive)]
+            self.next_worker += 1
+            shares.setdefault(worker, []).append(address)
+        for worker, share in shares.items():
+            worker.send('peers', share)
+
+    async def announce(self, announcer: Announcer, starving: bool):
+        """
+        Asks the trackers for peers, spreading them over the workers as each tracker answers
+        """
+        session = self.session
+        async for peers in announcer.announce(session.uploaded, session.downloaded, session.left, starving=starving):
+            self.add_candidates(peers)
+
+    async def run(self) -> bool:
+        """
+        Downloads the torrent with the workers, until every piece is on disk
+        :return: True once complete, False if every worker exited before
+        """
+        torrent = Torrent(self.torrent_file)
+        file_saver = FileSaver(self.download_location, torrent)
+        self.session = session = DownloadSession(torrent, file_saver.get_received_pieces_queue(), file_saver=file_saver)
+        file_saver.on_piece_written = self.on_piece_written
+        file_saver.on_piece_failed = self.on_piece_failed
+
+        resume = ResumeData(torrent, self.download_location)
+        session.restore(await asyncio.get_event_loop().run_in_executor(None, resume.load_or_recheck))
+        saving = asyncio.ensure_future(resume.run(session))
+
+        self.start_workers(torrent)
+        announcer = Announcer(torrent, self.port)
+        announcing = None
+        try:
+            # Done once every piece is on disk, the workers' slots are in use until then
+            while not session.is_complete() or session.unwritten:
+                if not any(worker.alive for worker in self.workers):
+                    print('[Coordinator] All workers exited')
+                    return False
+                connections = sum(worker.connections for worker in self.workers)
+                starving = connections < self.max_connections * self.worker_count // 2
+                if (announcing is None or announcing.done()) and announcer.is_due(starving):
+                    announcing = asyncio.ensure_future(self.announce(announcer, starving))
+                await asyncio.sleep(1)
+
+            for tracker in announcer.trackers:
+                tracker.next_announce = 0
+            await self.announce(announcer, False)
+            print("received", len(session.received_pieces))
+            return True
+        finally:
+            if announcing:
+                announcing.cancel()
+            saving.cancel()
+            self.broadcast('complete')
+            await announcer.close()
+            # Messages are still handled while the workers exit, their last stats come in meanwhile
+            await asyncio.get_event_loop().run_in_executor(None, self.join_workers)
+            for worker in self.workers:
+                if worker.alive:
+                    self.on_messages(worker)
+                if worker.alive:
+                    worker.alive = False
+                    asyncio.get_event_loop().remove_reader(worker.conn.fileno())
+            session.close()
+            # Pieces on their way to disk are views into the slabs, which stay mapped until they are written
+            file_saver.get_received_pieces_queue().put_nowait(None)
+            await file_saver.writing
+            file_saver.disk.close()
+            for worker in self.workers:
+                self.close_slab(worker)
+            resume.save(session.written_pieces)
+
+    def join_workers(self, timeout: float = 10):
+        """
+        Waits for the workers to exit, terminating those which don't
+        """
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+
+    @staticmethod
+    def close_slab(worker: Worker):
+        """
+        Frees the shared memory of a worker which exited
+        """
+        worker.slab.close()
+        worker.slab.unlink()
+
+
+if __name__ == '__main__':
+    # python multiproc.py <torrent file> [workers]
+    sys.stdout = Tee(sys.stdout, open('logfile', 'w'))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(Coordinator(
+        sys.argv[1], './downloads', workers=int(sys.argv[2]) if len(sys.argv) > 2 else None
+    ).run())
+    loop.close()
@@ -1,28 +1,154 @@
 import asyncio
+import math
 import struct
+import time
+from collections import deque
 
 import bitstring
 
+from framer import MessageFramer
+from ratelimit import RateLimiter
+
+BLOCK_SIZE = 16384
+MAX_REQUEST_LENGTH = 131072  # Largest block a peer may ask us for
+MAX_UPLOAD_QUEUE = 256  # Requests of a peer queued for upload at most
+PROTOCOL = b'BitTorrent protocol'
+KEEP_ALIVE_TIMEOUT = 150  # Idle peers send a keep alive every two minutes
+KEEP_ALIVE_INTERVAL = 90  # Seconds without sending anything before we send a keep alive, peers drop us at two minutes
+CHECK_INTERVAL = 5  # Seconds between checks of the outstanding requests of an idle connection
+SNUB_TIMEOUT = 60  # Seconds without a block while requests are outstanding before a peer counts as snubbing us
+
+
+class RequestPipeline:
+    """
+    Book keeping of the block requests outstanding to a single peer
+    The number of requests kept in flight follows the bandwidth delay product of the peer, its measured download
+    rate times the lowest round trip time seen, doubled so the queue keeps probing for more bandwidth
+    """
+    MIN_DEPTH = 2
+    MAX_DEPTH = 250
+    RATE_WINDOW = 1.0  # Seconds of received data per download rate sample
+    MIN_BLOCK_TIMEOUT = 20
+    DEFAULT_BLOCK_TIMEOUT = 60  # Until the peer's rate is known
+
+    def __init__(self):
+        self.outstanding = {}  # (piece index, begin) -> time the request was sent
+        self.depth = self.MIN_DEPTH
+        self.rate = 0.0  # Bytes per second
+        self.min_rtt = None
+
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def is_full(self) -> bool:
+        """
+        True when the peer already has as many requests as its queue depth allows
+        """
+        return len(self.outstanding) >= self.depth
+
+    def on_request(self, piece_idx: int, begin: int):
+        """
+        Records a REQUEST sent to the peer
+        """
+        self.outstanding[(piece_idx, begin)] = time.monotonic()
+
+    def on_block(self, piece_idx: int, begin: int, length: int):
+        """
+        Records a received block, updating the rate and round trip estimates and the queue depth
+        :return: False if the block was never requested from this peer
+        """
+        now = time.monotonic()
+        sent_at = self.outstanding.pop((piece_idx, begin), None)
+        if sent_at is not None:
+            rtt = now - sent_at
+            if self.min_rtt is None or rtt < self.min_rtt:
+                self.min_rtt = rtt
+
+        self._window_bytes += length
+        elapsed = now - self._window_start
+        if elapsed >= self.RATE_WINDOW:
+            sample = self._window_bytes / elapsed
+            self.rate = sample if not self.rate else 0.7 * self.rate + 0.3 * sample
+            self._window_start = now
+            self._window_bytes = 0
+            self._update_depth()
+
+        return sent_at is not None
+
+    def _update_depth(self):
+        if not self.min_rtt:
+            return
+        bdp = self.rate * self.min_rtt / BLOCK_SIZE
+        self.depth = max(self.MIN_DEPTH, min(self.MAX_DEPTH, math.ceil(2 * bdp) + self.MIN_DEPTH))
+
+    @property
+    def block_timeout(self) -> float:
+        """
+        Seconds after which a request counts as lost, a few times what the whole queue should take at the
+        current rate
+        """
+        if not self.rate:
+            return self.DEFAULT_BLOCK_TIMEOUT
+        return max(self.MIN_BLOCK_TIMEOUT, 3 * (self.depth * BLOCK_SIZE / self.rate + (self.min_rtt or 0)))
+
+    def expired(self, now: float) -> list:
+        """
+        Outstanding requests older than the block timeout
+        :return: list of (piece index, begin)
+        """
+        deadline = now - self.block_timeout
+        return [request for request, sent_at in self.outstanding.items() if sent_at < deadline]
+
+    def reset(self):
+        """
+        Drops all outstanding requests, called when the connection is gone and none of them can be answered
+        """
+        self.outstanding.clear()
+
 
 class Peer:
     """
     # TODO Move peer wire protocol implementation out of this class
     # TODO Understand struct thoroughly
-    # TODO Implement seeding spec as well
-    Representation of a peer and implementation of peer wire protocol
+    Representation of a peer and implementation of peer wire protocol, downloading from the peer and serving
+    its requests for the pieces we have on disk
     """
-    def __init__(self, session, host, port):
+    def __init__(self, session, host, port, reader=None, writer=None):
         self.host = host
         self.port = port
         self.session = session
+        # Streams of an incoming connection, handshake already exchanged
+        self.reader = reader
+        self.writer = writer
+        self.incoming = reader is not None
 
         self.have_pieces = bitstring.BitArray(
             bin='0' * self.session.number_of_pieces
         )
-        self.piece_in_progress = None
+        self.pieces_in_progress = set()  # Pieces the picker handed to this peer
         self.blocks = None
 
-        self.inflight_requests = 0
+        self.pipeline = RequestPipeline()
+        self.peer_choke = True
+        self.snubbed = False  # Requests outstanding but nothing delivered for SNUB_TIMEOUT
+        self.unchoked_at = 0.0
+        self.last_block_at = 0.0
+        self.peer_interested = False
+        self.am_choking = True
+
+        self.upload_queue = deque()  # (piece index, begin, length) requested by the peer
+        self.upload_ready = asyncio.Event()
+        self.uploaded = 0  # Payload bytes sent to the peer
+        self.downloaded = 0  # Payload bytes received from the peer
+        self.connected_at = None
+        # Optional caps of this peer, under the session's limits
+        self.limiter = RateLimiter(*session.peer_rates, parent=session.limiter)
+        self.drain_lock = asyncio.Lock()
+        self.last_sent = time.monotonic()  # Of the last message written to the peer
+        self.closing = False  # Set by close(), the message loop ends on its next turn
 
     def handshake(self):
         """
@@ -32,21 +158,83 @@ class Peer:
         return struct.pack(
             '>B19s8x20s20s',
             19,
-            b'BitTorrent protocol',
+            PROTOCOL,
             self.session.info_hash,
-            "a1b2c3d4e5f6g7h8i9j0".encode()
+            self.session.torrent.peer_id
         )
 
     @staticmethod
-    async def send_interested(writer):
+    def parse_handshake(handshake: bytes):
+        """
+        Info hash of a peer's handshake
+        :return: info hash, or None if it is not a BitTorrent handshake
+        """
+        if len(handshake) != 68 or handshake[0] != 19 or handshake[1:20] != PROTOCOL:
+            return None
+        return handshake[28:48]
+
+    def send(self, message: bytes):
+        """
+        Queues a message on the connection, it goes out with the next drain
+        """
+        self.writer.write(message)
+        self.last_sent = time.monotonic()
+
+    async def drain(self):
+        """
+        Flow control on the connection, the upload task and the message loop both write to it
+        """
+        async with self.drain_lock:
+            await self.writer.drain()
+
+    def close(self):
+        """
+        Ends the connection from outside its task: the message loop stops on its next turn and a pending read
+        returns at once, as a cancel alone can be lost when the read completes in the same loop iteration
+        """
+        self.closing = True
+        if self.writer:
+            self.writer.close()
+
+    async def send_interested(self):
         """
         Peer wire protocol setting interested to 1
         """
         msg = struct.pack('>Ib', 1, 2)
-        writer.write(msg)
-        # print("\nBefore draining writer in send interested for {}\n".format(self.host))
-        await writer.drain()
-        # print("\nAfter draining writer in send interested for {}\n".format(self.host))
+        self.send(msg)
+        await self.drain()
+
+    def send_bitfield(self):
+        """
+        Peer wire protocol advertising the pieces we have on disk, skipped while we have none
+        """
+        written = self.session.written_pieces
+        if len(written):
+            self.send(struct.pack('>Ib', 1 + len(written.bitfield), 5) + written.bitfield)
+
+    def send_have(self, piece_idx: int):
+        """
+        Peer wire protocol announcing a piece we just wrote, the message goes out with the next drain
+        """
+        if self.writer and not self.have_pieces[piece_idx]:
+            self.send(struct.pack('>IbI', 5, 4, piece_idx))
+
+    def choke(self):
+        """
+        Peer wire protocol to stop serving the peer, its queued requests are dropped
+        """
+        if self.writer and not self.am_choking:
+            self.am_choking = True
+            self.upload_queue.clear()
+            self.send(struct.pack('>Ib', 1, 0))
+
+    def unchoke(self):
+        """
+        Peer wire protocol to start serving the peer
+        """
+        if self.writer and self.am_choking:
+            self.am_choking = False
+            self.send(struct.pack('>Ib', 1, 1))
 
     def get_blocks_generator(self):
         """
@@ -55,202 +243,348 @@ class Peer:
         :return: blocks generator
         """
         def _blocks():
+            visited = set()  # Endgame pieces already gone through by this generator
             while True:
-                try:
-                    piece = self.session.get_piece_request(self.have_pieces)
-                    print('[{}] Generating blocks for Piece: {}'.format(self, piece))
-                    for block in piece.blocks:
-                        yield block
-                except Exception:
+                piece = self.session.get_piece_request(self.have_pieces, exclude=visited)
+                if not piece:
                     print("No piece available from this peer")
                     return
+                if self.session.endgame:
+                    visited.add(piece.index)
+                else:
+                    self.pieces_in_progress.add(piece.index)
+                print('[{}] Generating blocks for Piece: {}'.format(self, piece))
+                for block_idx, block in enumerate(piece.blocks):
+                    # Partial and endgame pieces only need their missing blocks, and never twice from one peer
+                    if piece.downloaded_blocks[block_idx] or (block.piece, block.begin) in self.pipeline.outstanding:
+                        continue
+                    yield block
 
         if not self.blocks:
             self.blocks = _blocks()
         return self.blocks
 
-    async def request_a_piece(self, writer):
+    @property
+    def inflight_requests(self) -> int:
+        return len(self.pipeline)
+
+    def queue_requests(self) -> int:
         """
-        Peer wire protocol to request a piece
+        Peer wire protocol to request blocks, tops the pipeline up to its current depth
+        :return: number of requests written
         """
-        if self.inflight_requests > 1:
-            print('ALERT!', self.inflight_requests)
-            return
+        if self.peer_choke:
+            return 0
         blocks_generator = self.get_blocks_generator()
-        block = next(blocks_generator)
-        if not block:
-            print("No blocks generated")
+        sent = 0
+        # A snubbing peer gets a single request at a time, so it can't hold more than one block hostage
+        while not self.pipeline.is_full() and not (self.snubbed and self.pipeline.outstanding):
+            block = next(blocks_generator, None)
+            if not block:
+                # Exhausted, a fresh generator is created on the next call in case new pieces became available
+                self.blocks = None
+                break
+
+            msg = struct.pack('>IbIII', 13, 6, block.piece, block.begin, block.length)
+            self.send(msg)
+            self.pipeline.on_request(block.piece, block.begin)
+            sent += 1
+        return sent
+
+    async def request_pieces(self):
+        """
+        Requests blocks up to the pipeline depth and drains once
+        """
+        if self.queue_requests():
+            await self.drain()
+
+    def wake(self):
+        """
+        Requests blocks outside of the message loop, when pieces became available without the peer saying
+        anything. The requests go out with the next drain
+        """
+        if self.writer and not self.pipeline.is_full() and not self.snubbed:
+            self.queue_requests()
+
+    def cancel(self, piece_idx: int, begin: int, length: int):
+        """
+        Peer wire protocol to cancel an outstanding block request, the message goes out with the next drain
+        """
+        if not self.writer or (piece_idx, begin) not in self.pipeline.outstanding:
             return
+        del self.pipeline.outstanding[(piece_idx, begin)]
+        self.send(struct.pack('>IbIII', 13, 8, piece_idx, begin, length))
 
-        msg = struct.pack('>IbIII', 13, 6, block.piece, block.begin, block.length)
-        writer.write(msg)
-        self.inflight_requests += 1
-        # print("\nBefore draining writer in request a piece for {}\n".format(self.host))
-        await writer.drain()
-        # print("\nAfter draining writer in request a piece for {}\n".format(self.host))
+    def release(self, piece_indexes):
+        """
+        Hands pieces this peer was downloading back to the session, cancelling their outstanding blocks, so other
+        peers can finish them
+        """
+        piece_indexes = set(piece_indexes) & self.pieces_in_progress
+        if not piece_indexes:
+            return
+        for piece_idx, begin in list(self.pipeline.outstanding):
+            if piece_idx in piece_indexes:
+                self.cancel(piece_idx, begin, self.block_length(piece_idx, begin))
+        self.pieces_in_progress -= piece_indexes
+        self.blocks = None
+        self.session.release_pieces(piece_indexes)
 
-    async def download(self):
+    def block_length(self, piece_idx: int, begin: int) -> int:
+        return min(BLOCK_SIZE, self.session.torrent.layout.piece_range(piece_idx)[1] - begin)
+
+    def on_choke(self):
         """
-        Peer wire protocol to download a piece
+        The peer discards our requests when it chokes us, their pieces go back to the session right away
         """
-        retries = 0
-        while retries < 5:
-            retries += 1
-            try:
-                # print("\nBefore awaiting self._download for {}\n".format(self.host))
-                await asyncio.wait_for(self._download(), timeout=30)
-                # print("\nAfter awaiting self._download for {}\n".format(self.host))
-            except Exception:
-                print('\nError downloading: {}\n'.format(self.host))
-                self.inflight_requests -= 1
-                # traceback.print_exc()
+        self.peer_choke = True
+        self.pipeline.outstanding.clear()
+        self.release(self.pieces_in_progress)
+
+    def on_unchoke(self):
+        self.peer_choke = False
+        self.unchoked_at = time.monotonic()
 
-    async def _download(self):
+    def check_requests(self):
         """
-        Peer wire protocol implementation
+        Times out lost requests, and releases every piece of a peer which stopped delivering
         """
-        try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(self.host, self.port),
-                timeout=5
-            )
+        if not self.pipeline.outstanding:
+            return
+        now = time.monotonic()
+        if not self.snubbed and now - max(self.last_block_at, self.unchoked_at) > SNUB_TIMEOUT:
+            print('{} is snubbing us'.format(self))
+            self.snubbed = True
+            self.release(self.pieces_in_progress)
+
+        expired = self.pipeline.expired(now)
+        if not expired:
+            return
+        print('{} {} requests timed out'.format(self, len(expired)))
+        for piece_idx, begin in expired:
+            self.cancel(piece_idx, begin, self.block_length(piece_idx, begin))
+        self.release(piece_idx for piece_idx, _ in expired)
 
-        except Exception:
-            print('\nFailed to connect to Peer {}\n'.format(self.host))
-            self.inflight_requests -= 1
-            # traceback.print_exc()
+    def on_request(self, piece_idx: int, begin: int, length: int):
+        """
+        Queues a block the peer asked for, if we are serving it and have the piece on disk
+        """
+        if self.am_choking or len(self.upload_queue) >= MAX_UPLOAD_QUEUE:
+            return
+        if piece_idx >= self.session.number_of_pieces or piece_idx not in self.session.written_pieces:
+            print('{} requested Piece {} which we do not have'.format(self, piece_idx))
             return
+        if not 0 < length <= MAX_REQUEST_LENGTH or begin + length > self.session.torrent.layout.piece_range(
+                piece_idx)[1]:
+            print('{} sent an invalid request {} {} {}'.format(self, piece_idx, begin, length))
+            return
+        self.upload_queue.append((piece_idx, begin, length))
+        self.upload_ready.set()
 
-        print('{} Sending handshake'.format(self.host))
-        writer.write(self.handshake())
-        # print("\nBefore draining writer for {}\n".format(self.host))
-        await writer.drain()
-        # print("\nAfter draining writer for {}\n".format(self.host))
+    async def upload(self):
+        """
+        Serves queued requests one after the other, reading blocks through the file saver's cache
+        """
+        while True:
+            await self.upload_ready.wait()
+            self.upload_ready.clear()
+            while self.upload_queue:
+                piece_idx, begin, length = self.upload_queue.popleft()
+                try:
+                    data = await self.session.file_saver.read_block(piece_idx, begin, length)
+                except OSError as e:
+                    print('{} Failed reading Piece {}\n{}'.format(self, piece_idx, e))
+                    continue
+                await self.limiter.consume_upload(length)
+                if self.am_choking:
+                    # Choked while the block was being read or throttled
+                    continue
+                self.send(struct.pack('>IbII', 9 + length, 7, piece_idx, begin))
+                self.send(data)
+                self.uploaded += length
+                self.session.uploaded += length
+                await self.drain()
 
+    async def download(self):
+        """
+        Peer wire protocol to download pieces and serve requests, for as long as the connection lives
+        """
+        uploading = None
         try:
-            handshake = await asyncio.wait_for(reader.read(68), timeout=5)
+            if await self.connect():
+                uploading = asyncio.ensure_future(self.upload())
+                await self.run()
         except Exception:
-            print('\nFailed at handshake to Peer {}\n'.format(self.host))
-            self.inflight_requests -= 1
+            print('\nError downloading: {}\n'.format(self.host))
             # traceback.print_exc()
-            return
+        finally:
+            # Whatever was in flight on this connection is lost with it, and so is its share of availability
+            if uploading:
+                uploading.cancel()
+            self.session.peers.discard(self)
+            self.session.choker.on_peer_gone(self)
+            if self.writer:
+                self.writer.close()
+            self.writer = None
+            self.pipeline.reset()
+            self.upload_queue.clear()
+            self.session.picker.remove_peer(self.have_pieces)
+            self.have_pieces = bitstring.BitArray(self.session.number_of_pieces)
+            self.session.release_pieces(self.pieces_in_progress)
+            self.pieces_in_progress = set()
+            self.blocks = None  # The generator holds its piece, and the peer in a cycle with it
+
+    async def connect(self) -> bool:
+        """
+        Opens the connection and exchanges handshakes, incoming connections did so already
+        :return: True once the peer is ready for messages
+        """
+        if not self.incoming:
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port),
+                    timeout=5
+                )
+            except Exception:
+                print('\nFailed to connect to Peer {}\n'.format(self.host))
+                # traceback.print_exc()
+                return False
+
+            print('{} Sending handshake'.format(self.host))
+            self.send(self.handshake())
+            await self.drain()
+
+            try:
+                handshake = await asyncio.wait_for(self.reader.readexactly(68), timeout=5)
+            except Exception:
+                print('\nFailed at handshake to Peer {}\n'.format(self.host))
+                # traceback.print_exc()
+                return False
+
+            if self.parse_handshake(handshake) != self.session.info_hash:
+                print('\nHandshake from Peer {} is for another torrent\n'.format(self.host))
+                return False
+
+        self.connected_at = time.monotonic()
+        self.session.peers.add(self)
+        self.send_bitfield()
 
         try:
-            await self.send_interested(writer)
+            await self.send_interested()
         except Exception:
             print('\nFailed at sending interested to Peer {}\n'.format(self.host))
-            self.inflight_requests -= 1
             # traceback.print_exc()
-            return
+            return False
+        return True
 
-        buf = b''
-        while True:
+    async def run(self):
+        """
+        Peer wire protocol message loop
+        """
+        framer = MessageFramer()
+        last_received = time.monotonic()
+        task = asyncio.current_task()
+        # wait_for returns the read's result instead of raising when both happen in the same loop iteration, a
+        # cancelled task must see it was cancelled by itself
+        cancelling = getattr(task, 'cancelling', lambda: 0)
+        while not self.closing and not cancelling():
             try:
-                resp = await asyncio.wait_for(reader.read(16384), timeout=10)
+                resp = await asyncio.wait_for(self.reader.read(65536), timeout=CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                if time.monotonic() - last_received > KEEP_ALIVE_TIMEOUT:
+                    print('\nPeer {} went silent\n'.format(self.host))
+                    return
+                resp = None
             except Exception:
                 print('\nFailed at Reading data from Peer {}\n'.format(self.host))
-                self.inflight_requests -= 1
                 # traceback.print_exc()
                 return
 
-            buf += resp
-
-            if not buf and not resp:
-                return
-
-            while True:
-                if len(buf) < 4:
-                    break
-
-                length = struct.unpack('>I', buf[0:4])[0]
-
-                if not len(buf) >= length:
-                    break
-
-                def consume(buffer):
-                    return buffer[4 + length:]
-
-                def get_data(buffer):
-                    return buffer[:4 + length]
-
-                if length == 0:
+            if resp is not None:
+                if not resp:
+                    return
+                last_received = time.monotonic()
+                framer.feed(resp)
+                # The next read waits for the data to be paid for, meanwhile the socket fills up and TCP slows
+                # the peer down
+                await self.limiter.consume_download(len(resp))
+
+            for msg_id, payload in framer.messages():
+                if msg_id is None:
                     print('[Message] Keep Alive')
-                    buf = consume(buf)
-                    data = get_data(buf)
-                    # print('[DATA]', data)
                     continue
 
-                if len(buf) < 5:
-                    # print('Buffer is less than 5... breaking')
-                    break
-
-                msg_id = struct.unpack('>b', buf[4:5])[0]  # 5th byte is the ID
-
                 if msg_id == 0:
                     print('[Message] CHOKE')
-                    data = get_data(buf)
-                    buf = consume(buf)
-                    # print('[DATA]', data)
+                    self.on_choke()
 
                 elif msg_id == 1:
-                    data = get_data(buf)
-                    buf = consume(buf)
                     print('[Message] UNCHOKE')
-                    self.peer_choke = False
+                    self.on_unchoke()
 
                 elif msg_id == 2:
-                    data = get_data(buf)
-                    buf = consume(buf)
                     print('[Message] Interested')
-                    pass
+                    self.peer_interested = True
+                    self.session.choker.on_interested(self)
 
                 elif msg_id == 3:
-                    data = get_data(buf)
-                    buf = consume(buf)
                     print('[Message] Not Interested')
-                    pass
+                    self.peer_interested = False
 
                 elif msg_id == 4:
-                    buf = buf[5:]
-                    data = get_data(buf)
-                    buf = consume(buf)
                     print('[Message] Have')
-                    pass
+                    piece_idx, = struct.unpack_from('>I', payload)
+                    if piece_idx < len(self.have_pieces) and not self.have_pieces[piece_idx]:
+                        self.have_pieces[piece_idx] = True
+                        self.session.picker.on_have(self.have_pieces, piece_idx)
 
                 elif msg_id == 5:
-                    bitfield = buf[5: 5 + length - 1]
-                    self.have_pieces = bitstring.BitArray(bitfield)
-                    buf = buf[4 + length:]
-                    await self.send_interested(writer)
+                    self.session.picker.remove_peer(self.have_pieces)
+                    self.have_pieces = bitstring.BitArray(
+                        bytes=bytes(payload), length=self.session.number_of_pieces
+                    )
+                    self.session.picker.add_peer(self.have_pieces)
+                    await self.send_interested()
 
-                elif msg_id == 7:
-                    self.inflight_requests -= 1
-                    data = get_data(buf)
-                    buf = consume(buf)
+                elif msg_id == 6:
+                    self.on_request(*struct.unpack_from('>III', payload))
 
-                    payload = struct.unpack('>I', data[:4])[0]
-                    try:
-                        parts = struct.unpack('>IbII' + str(payload - 9) + 's', data[:length + 4])
-                        piece_idx, begin, data = parts[2], parts[3], parts[4]
-                        self.session.on_block_received(piece_idx, begin, data)
-                    except struct.error:
+                elif msg_id == 7:
+                    if len(payload) < 8:
                         print('error decoding piece')
                         return
+                    piece_idx, begin = struct.unpack_from('>II', payload)
+                    self.pipeline.on_block(piece_idx, begin, len(payload) - 8)
+                    self.downloaded += len(payload) - 8
+                    self.last_block_at = time.monotonic()
+                    self.snubbed = False
+                    # Block data stays a view into the framer's buffer, the session copies it where it belongs
+                    self.session.on_block_received(piece_idx, begin, payload[8:], self)
+
+                elif msg_id == 8:
+                    try:
+                        self.upload_queue.remove(struct.unpack_from('>III', payload))
+                    except ValueError:
+                        pass  # Served already
+
+                elif msg_id in (9, 20):
+                    pass  # DHT port and extension protocol messages are not supported
 
                 else:
                     print('unknown ID {}'.format(msg_id))
-                    self.inflight_requests -= 1
-                    if msg_id == 159:
-                        exit(1)
                     return
 
-                try:
-                    await self.request_a_piece(writer)
-                except Exception:
-                    print('\n{} Failed at requesting a piece\n'.format(self.host))
-                    self.inflight_requests -= 1
-                    # traceback.print_exc()
-                    return
+            self.check_requests()
+            try:
+                await self.request_pieces()
+                if time.monotonic() - self.last_sent > KEEP_ALIVE_INTERVAL:
+                    # Nothing to exchange, the connection is kept open for when there is
+                    self.send(struct.pack('>I', 0))
+                    await self.drain()
+            except Exception:
+                print('\n{} Failed at requesting a piece\n'.format(self.host))
+                # traceback.print_exc()
+                return
 
     def __repr__(self):
         return '[Peer {}:{}]'.format(self.host, self.port)
@@ -0,0 +1,235 @@
+import random
+from array import array
+
+# Piece and file priorities, skipped pieces are never picked
+SKIP = 0
+LOW = 1
+NORMAL = 2
+HIGH = 3
+
+# Positions of the set bits of every byte value, most significant bit first as in bitfields
+SET_BITS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+
+
+def set_bits(have_pieces):
+    """
+    Indexes of the pieces set in a peer's bitfield, read a byte at a time as BitArray.findall is slow on the
+    bitfields of torrents with many pieces
+    :param have_pieces: BitArray of the peer's pieces
+    """
+    for byte_idx, byte in enumerate(have_pieces.tobytes()):
+        if byte:
+            first = byte_idx * 8
+            for bit in SET_BITS[byte]:
+                yield first + bit
+
+
+def is_seed(have_pieces) -> bool:
+    """
+    True for the bitfield of a peer having every piece, compared a byte at a time as BitArray.all is slow on the
+    bitfields of torrents with many pieces
+    :param have_pieces: BitArray of the peer's pieces
+    """
+    data = have_pieces.tobytes()
+    if not data:
+        return False
+    last = (0xff << (len(data) * 8 - len(have_pieces))) & 0xff
+    return data[-1] == last and data.count(0xff, 0, len(data) - 1) == len(data) - 1
+
+
+class PiecePicker:
+    """
+    Rarest first piece selection, by priority
+    Pieces still to be picked live in buckets indexed by their priority and their availability, the number of
+    connected peers having them. Higher priorities are picked first and rarest first within a priority. A piece
+    moves between neighbouring buckets in O(1) on every HAVE, and is placed at a random position of its bucket so
+    that peers asking at the same time spread over equally rare pieces.
+    Seeds add one to every piece, which changes no piece's rank, so they are only counted in seeds and connecting
+    or leaving costs them no move. A piece is available from availability[piece] + seeds peers
+    """
+    def __init__(self, number_of_pieces: int):
+        self.number_of_pieces = number_of_pieces
+        self.availability = array('I', bytes(4 * number_of_pieces))  # Peers having the piece, seeds aside
+        self.seeds = 0  # Peers having every piece
+        self.position = array('I', range(number_of_pieces))  # Index of a piece inside its bucket
+        self.wanted = bytearray(b'\x01' * number_of_pieces)  # 1 while a piece is waiting to be picked
+        self.partial = set()  # Released pieces with some blocks already downloaded
+        self.priority = bytearray([NORMAL]) * number_of_pieces
+        self.window = range(0)  # Pieces picked in order before any other, ahead of a streaming reader
+
+        # Nobody has anything yet, pieces get shuffled as they are announced and move up
+        self.buckets = [[] for _ in range(HIGH + 1)]  # Priority -> availability -> pieces
+        self.buckets[NORMAL].append(array('I', range(number_of_pieces)))
+
+    def _remove(self, piece_idx: int):
+        bucket = self.buckets[self.priority[piece_idx]][self.availability[piece_idx]]
+        pos = self.position[piece_idx]
+        last = bucket.pop()
+        if last != piece_idx:
+            bucket[pos] = last
+            self.position[last] = pos
+
+    def _insert(self, piece_idx: int):
+        count = self.availability[piece_idx]
+        buckets = self.buckets[self.priority[piece_idx]]
+        while len(buckets) <= count:
+            buckets.append(array('I'))
+        bucket = buckets[count]
+        bucket.append(piece_idx)
+        # Swap with a random member so ties are broken randomly
+        pos = random.randrange(len(bucket))
+        other = bucket[pos]
+        bucket[pos], bucket[-1] = piece_idx, other
+        self.position[other] = len(bucket) - 1
+        self.position[piece_idx] = pos
+
+    def increment(self, piece_idx: int):
+        """
+        A peer announced a piece with HAVE
+        """
+        if self.wanted[piece_idx]:
+            self._remove(piece_idx)
+            self.availability[piece_idx] += 1
+            self._insert(piece_idx)
+        else:
+            self.availability[piece_idx] += 1
+
+    def decrement(self, piece_idx: int):
+        """
+        A peer having the piece went away
+        """
+        if not self.availability[piece_idx]:
+            return
+        if self.wanted[piece_idx]:
+            self._remove(piece_idx)
+            self.availability[piece_idx] -= 1
+            self._insert(piece_idx)
+        else:
+            self.availability[piece_idx] -= 1
+
+    def add_peer(self, have_pieces):
+        """
+        Counts every piece of a peer's bitfield, a seed is counted once
+        :param have_pieces: BitArray of the peer's pieces
+        """
+        if is_seed(have_pieces):
+            self.seeds += 1
+            return
+        for piece_idx in set_bits(have_pieces):
+            self.increment(piece_idx)
+
+    def remove_peer(self, have_pieces):
+        """
+        Uncounts every piece of a peer's bitfield
+        :param have_pieces: BitArray of the peer's pieces
+        """
+        if is_seed(have_pieces):
+            self.seeds = max(self.seeds - 1, 0)
+            return
+        for piece_idx in set_bits(have_pieces):
+            self.decrement(piece_idx)
+
+    def on_have(self, have_pieces, piece_idx: int):
+        """
+        A peer announced a piece with HAVE. A peer which now has every piece is counted as a seed from then on, so
+        whether a bitfield counts as a seed only ever depends on whether it is full
+        :param have_pieces: BitArray of the peer's pieces, the piece already set
+        """
+        if is_seed(have_pieces):
+            previous = have_pieces.copy()
+            previous[piece_idx] = False
+            self.remove_peer(previous)
+            self.add_peer(have_pieces)
+        else:
+            self.increment(piece_idx)
+
+    def available(self, piece_idx: int) -> int:
+        """
+        Number of connected peers having a piece
+        """
+        return self.availability[piece_idx] + self.seeds
+
+    def pick(self, have_pieces, partial_only: bool = False):
+        """
+        Picks the next piece to download from a peer, partially downloaded pieces first and then the rarest
+        piece the peer has. The picked piece is taken out of the picker until it is released
+        :param have_pieces: BitArray of the peer's pieces
+        :param partial_only: only pick partially downloaded pieces
+        :return: piece index or None
+        """
+        if not partial_only:
+            for piece_idx in self.window:
+                if self.wanted[piece_idx] and have_pieces[piece_idx]:
+                    self.take(piece_idx)
+                    return piece_idx
+
+        for piece_idx in self.partial:
+            if have_pieces[piece_idx]:
+                self.take(piece_idx)
+                return piece_idx
+        if partial_only:
+            return None
+
+        # Pieces no other peer has are only worth a look when seeds have them
+        first = 0 if self.seeds else 1
+        for priority in range(HIGH, SKIP, -1):
+            for bucket in self.buckets[priority][first:]:
+                for piece_idx in bucket:
+                    if have_pieces[piece_idx]:
+                        self.take(piece_idx)
+                        return piece_idx
+        return None
+
+    def take(self, piece_idx: int):
+        """
+        Marks a piece as not wanted anymore, it is in progress or already downloaded
+        """
+        if self.wanted[piece_idx]:
+            self._remove(piece_idx)
+            self.wanted[piece_idx] = 0
+        self.partial.discard(piece_idx)
+
+    def release(self, piece_idx: int, partial: bool = False):
+        """
+        Puts a piece back up for picking, after a failed hash check or when its peer dropped it
+        :param piece_idx: piece index
+        :param partial: True if some of the piece's blocks are already downloaded
+        """
+        if not self.priority[piece_idx]:
+            return
+        if not self.wanted[piece_idx]:
+            self.wanted[piece_idx] = 1
+            self._insert(piece_idx)
+        if partial:
+            self.partial.add(piece_idx)
+        else:
+            self.partial.discard(piece_idx)
+
+    def set_priority(self, piece_idx: int, priority: int):
+        """
+        Changes the priority of a piece, a piece no longer skipped has to be released by the caller unless it is
+        already downloaded or in progress
+        """
+        if self.wanted[piece_idx]:
+            self._remove(piece_idx)
+            self.priority[piece_idx] = priority
+            if priority:
+                self._insert(piece_idx)
+            else:
+                self.wanted[piece_idx] = 0
+                self.partial.discard(piece_idx)
+        else:
+            self.priority[piece_idx] = priority
+
+    def set_window(self, first: int, last: int):
+        """
+        Makes the pieces in [first, last) be picked in order, before partial pieces and regardless of rarity
+        """
+        self.window = range(max(first, 0), min(last, self.number_of_pieces))
+
+    def has_wanted(self) -> bool:
+        """
+        True while some piece any connected peer has is still waiting to be picked
+        """
+        first = 0 if self.seeds else 1
+        return any(any(buckets[first:]) for buckets in self.buckets)
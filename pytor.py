@@ -1,38 +1,53 @@
 import asyncio
 import hashlib
-import os
 import sys
-from pprint import pformat, pprint
+from pprint import pformat
 from typing import Dict
 
 import bitstring
-import math
-from tqdm import tqdm
 
+from choker import Choker
 from file_saver import FileSaver
-from peer import Peer
+from hasher import PieceHasher
+from memory_budget import MemoryBudget
+from peer import BLOCK_SIZE
+from piece_picker import NORMAL, PiecePicker
+from ratelimit import RateLimiter
+from resume import ResumeData
+from swarm import Swarm
 from torrent import Torrent
 
 
 class Piece:
     """
     Representation of a File's piece
+    Only pieces being downloaded exist as objects, their blocks follow from the piece length.
+    Block data is written straight into one buffer of the piece's length, allocated when the first block arrives.
+    The piece's length is reserved in the memory budget until the piece is flushed
     """
-    def __init__(self, index: int, blocks: list, file_name: str, file_idx: int, in_conflict: bool, fracture_idx: int):
+    __slots__ = ('index', 'length', 'blocks', 'downloaded_blocks', 'buffer', 'memory')
+
+    def __init__(self, index: int, length: int, memory: MemoryBudget = None):
         self.index: int = index
-        self.blocks: list = blocks
-        self.downloaded_blocks: bitstring.BitArray = bitstring.BitArray(bin='0' * len(blocks))
-        self.in_conflict: bool = in_conflict
-        self.fracture_idx: int = fracture_idx
-        self.file_name: str = file_name
-        self.file_idx: int = file_idx
+        self.length: int = length
+        self.memory: MemoryBudget = memory
+        if memory:
+            memory.reserve(length)
+        self.blocks: list = [
+            Block(index, begin, min(BLOCK_SIZE, length - begin))
+            for begin in range(0, length, BLOCK_SIZE)
+        ]
+        self.downloaded_blocks: bitstring.BitArray = bitstring.BitArray(bin='0' * len(self.blocks))
+        self.buffer: bytearray = None
 
     def flush(self):
         """
-        Releasing a Piece from memory by releasing all child block's memory
+        Releasing a Piece from memory by dropping its buffer
         """
-        for block in self.blocks:
-            block.flush()
+        self.buffer = None
+        if self.memory:
+            self.memory.release(self.length)
+            self.memory = None
 
     def is_complete(self) -> bool:
         """
@@ -42,57 +57,57 @@ class Piece:
 
     def save_block(self, begin: int, data: bytes):
         """
-        # TODO Move to Block class
-        Writes block 'data' into block object
+        Copies block 'data' into the piece buffer at its offset
         :param begin: Index where a the block begins
-        :param data: Block data to be saved
+        :param data: Block data to be saved, a view into the peer's receive buffer
+        :return: True if the block was new to the piece
         """
-        for block_idx, block in enumerate(self.blocks):
-            if block.begin == begin:
-                block.data = data
-                self.downloaded_blocks[block_idx] = True
+        block_idx = begin // BLOCK_SIZE
+        if begin % BLOCK_SIZE or block_idx >= len(self.blocks) or len(data) != self.blocks[block_idx].length:
+            print('Invalid block {} {} for Piece {}'.format(begin, len(data), self.index))
+            return False
+        if self.downloaded_blocks[block_idx]:
+            return False
+
+        if self.buffer is None:
+            self.buffer = bytearray(self.length)
+        self.buffer[begin:begin + len(data)] = data
+        self.downloaded_blocks[block_idx] = True
+        return True
 
     @property
-    def data(self) -> bytes:
+    def data(self) -> memoryview:
         """
-        Returns Piece data
+        Returns Piece data as a view of the piece buffer
         """
-        return b''.join([block.data for block in self.blocks])
+        return memoryview(self.buffer)
 
     @property
     def hash(self):
         """
         SHA1 hash value for the piece
         """
-        return hashlib.sha1(self.data)
+        return hashlib.sha1(self.buffer)
 
     def __repr__(self):
-        return '<Piece: {} Blocks: {} In Conflict: {} File Index: {} File Name: {} Fracture Point {}>'.format(
+        return '<Piece: {} Length: {} Blocks: {}>'.format(
             self.index,
-            len(self.blocks),
-            self.in_conflict,
-            self.file_idx,
-            self.file_name,
-            self.fracture_idx
+            self.length,
+            len(self.blocks)
         )
 
 
 class Block:
     """
     Representation of a block
-    A Block belongs to a Piece
+    A Block belongs to a Piece, its data lives in the piece buffer
     """
+    __slots__ = ('piece', 'begin', 'length')
+
     def __init__(self, piece, begin, length):
         self.piece = piece
         self.begin = begin
         self.length = length
-        self.data = None
-
-    def flush(self):
-        """
-        Release Block memory
-        """
-        self.data = None
 
     def __repr__(self):
         return '[Block ({}, {}, {})]'.format(
@@ -102,162 +117,459 @@ class Block:
         )
 
 
+class PieceSet:
+    """
+    Set of piece indexes backed by one byte per piece of the torrent, along with its BITFIELD message payload
+    """
+    def __init__(self, number_of_pieces: int):
+        self.flags = bytearray(number_of_pieces)
+        self.bitfield = bytearray((number_of_pieces + 7) // 8)
+        self.count = 0
+
+    def add(self, piece_idx: int):
+        if not self.flags[piece_idx]:
+            self.flags[piece_idx] = 1
+            self.bitfield[piece_idx >> 3] |= 0x80 >> (piece_idx & 7)
+            self.count += 1
+
+    def discard(self, piece_idx: int):
+        if self.flags[piece_idx]:
+            self.flags[piece_idx] = 0
+            self.bitfield[piece_idx >> 3] &= ~(0x80 >> (piece_idx & 7))
+            self.count -= 1
+
+    def __contains__(self, piece_idx: int) -> bool:
+        return bool(self.flags[piece_idx])
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (piece_idx for piece_idx, flag in enumerate(self.flags) if flag)
+
+
 class DownloadSession(object):
     """
     Representation of a torrent download
     """
 
-    def __init__(self, torrent: Torrent, writer: asyncio.Queue = None):
+    def __init__(self, torrent: Torrent, writer: asyncio.Queue = None, hasher: PieceHasher = None,
+                 file_saver: FileSaver = None, upload_slots: int = 4, limiter: RateLimiter = None,
+                 memory: MemoryBudget = None):
         self.torrent: Torrent = torrent
+        self.file_saver: FileSaver = file_saver  # Reads back written pieces for peers requesting them
         self.piece_size: int = self.torrent.metaData[b'info'][b'piece length']
         self.number_of_pieces: int = self.torrent.number_of_pieces
-        if self.torrent.mode == 'multiple':
-            self.fractures = self.torrent.fractures
-            print("DLSESSION", self.torrent.mode, self.fractures)
-            self.file_names = [os.path.join(*file[b'path']).decode() for file in self.torrent.files]
-            # Files list for popping in order, then processed path key to get final name
 
-        self.pieces: list = self.get_pieces()
+        self.pieces: Dict[int, Piece] = {}  # Materialized pieces, in progress or partially downloaded
+        self.picker: PiecePicker = PiecePicker(self.number_of_pieces)
         self.pieces_in_progress: Dict[int, Piece] = {}
-        self.received_pieces: Dict[int, Piece] = {}
+        self.received_pieces: PieceSet = PieceSet(self.number_of_pieces)
+        self.written_pieces: PieceSet = PieceSet(self.number_of_pieces)
+        self.peers: set = set()  # Connected peers
+        self.choker: Choker = Choker(self, upload_slots)  # Decides which peers we upload to
+        self.limiter: RateLimiter = RateLimiter(parent=limiter)  # Caps of this torrent, under the global limits
+        self.peer_rates: tuple = (0, 0)  # Download and upload caps of every peer, 0 for none
+        self.memory: MemoryBudget = memory or MemoryBudget()  # Bounds the piece buffers held in memory
+        self.memory.sessions.add(self)
+        self.downloaded: int = 0  # Payload bytes received, reported to trackers
+        self.uploaded: int = 0  # Payload bytes sent, reported to trackers
+        self.received_bytes: int = 0  # Bytes of the verified pieces
+        self.file_priorities: list = [NORMAL] * len(torrent.layout)
+        self.missing_pieces: int = self.number_of_pieces  # Wanted pieces not received yet
+        self.missing_bytes: int = torrent.layout.total_length
+        self.endgame: bool = False
+        self.unwritten: Dict[int, Piece] = {}  # Verified pieces on their way to disk
+        self.piece_waiters: Dict[int, asyncio.Future] = {}  # Piece index -> future of a reader waiting for it
+        self.stream_window: int = 0  # Bytes downloaded in order ahead of the read cursor, 0 when not streaming
         self.received_pieces_queue: asyncio.Queue = writer
         self.info_hash = self.torrent.info_hash
+        self.watching = None  # Loop stall watch of the session's own hasher, a shared hasher is watched by its owner
+        if not hasher:
+            hasher = PieceHasher()
+            self.watching = asyncio.ensure_future(hasher.watch_loop())
+        self.hasher: PieceHasher = hasher
 
-    def on_block_received(self, piece_idx: int, begin: int, data):
+    def on_block_received(self, piece_idx: int, begin: int, data, peer=None):
         """
         Task performed after receiving a block
         :param piece_idx: index of the piece, the block belongs to
         :param begin: Block begin index
         :param data: Block data received
+        :param peer: Peer the block came from
         """
-        piece = self.pieces[piece_idx]
-        piece.save_block(begin, data)
+        if piece_idx not in self.pieces_in_progress:
+            # Late duplicate of a piece which is already complete
+            return
+
+        piece = self.pieces_in_progress[piece_idx]
+        if not piece.save_block(begin, data):
+            return
+        self.downloaded += len(data)
+
+        if self.endgame:
+            # First copy of the block is in, the duplicate requests to other peers are cancelled
+            for other in self.peers:
+                if other is not peer:
+                    other.cancel(piece_idx, begin, len(data))
 
         # Verify all blocks in the Piece have been downloaded
         if not piece.is_complete():
             # print('Piece not complete')
             return
 
-        piece_data = piece.data
+        # Hashing runs on the hasher's workers, blocks keep coming in meanwhile
+        asyncio.ensure_future(self.verify_piece(piece))
 
-        res_hash = hashlib.sha1(piece_data).digest()
-        exp_hash = self.torrent.get_piece_hash(piece.index)
+    async def verify_piece(self, piece: Piece):
+        """
+        Checks a complete piece against its hash, then queues it to the writer or starts it over
+        :param piece: complete piece, stays in progress while it is being verified
+        """
+        piece_idx = piece.index
+        is_valid = await self.hasher.verify(piece.data, self.torrent.get_piece_hash(piece_idx))
 
-        if res_hash != exp_hash:
+        # Either way the piece object is done, a retry starts from a fresh one
+        if self.pieces.get(piece_idx) is piece:
+            del self.pieces[piece_idx]
+        if self.pieces_in_progress.get(piece_idx) is piece:
             del self.pieces_in_progress[piece_idx]  # Not in progress anymore
-            print('Hash check failed for Piece {}'.format(piece.index))
+
+        if not is_valid:
+            print('Hash check failed for Piece {}'.format(piece_idx))
+            piece.flush()
+            self.picker.release(piece_idx)
+            return
+
+        print('Piece {} hash is valid'.format(piece_idx))
+        self.on_piece_verified(piece)
+
+    def on_piece_verified(self, piece):
+        """
+        Marks a verified piece as received and queues it to the writer
+        :param piece: Piece, or any object with an index, a length, its data and a flush() called once written
+        """
+        piece_idx = piece.index
+        if piece_idx in self.received_pieces:
             piece.flush()
             return
-        else:
-            self.received_pieces[piece_idx] = piece
-            print('Piece {} hash is valid'.format(piece.index))
-            print('Piece {} DL'.format(piece.index))
-
-        # Only runs when a piece is complete
-        # Double braces because one set is for the tuple being sent
-        del self.pieces_in_progress[piece_idx]  # Not in progress anymore
-        # Queue it to the writer
-        # TODO Structure piece topic properly
-        self.received_pieces_queue.put_nowait((piece.index * self.piece_size, piece.file_idx, piece_data,
-                                               piece.in_conflict, piece.fracture_idx, piece.file_name, piece))
-
-    def get_pieces(self) -> list:
-        """
-        Generates list of pieces and their blocks
-        """
-        # FILE_ITER is the file's number
-        # FILE_IDX is the piece's index inside its file
-        pieces = []
-        blocks_per_piece = math.ceil(self.piece_size / 16384)
-        file_idx = 0
-        file_iter = 0
-        fracture = 0
-        for piece_idx in tqdm(range(self.number_of_pieces)):
-            file_name = ""
-            blocks = []
-            outcome = False
-            # brkpt()
-            if self.torrent.mode == 'multiple':
-                piece_end = piece_idx * self.piece_size + self.piece_size
-                piece_beg = piece_idx * self.piece_size
-                file_idx = piece_beg - fracture
-                # Piece's absolute index - previous fracture point i.e previous files' length
-                if len(self.fractures) > 1:  # Probably not needed, TEST this
-                    if self.fractures[file_iter] <= piece_end:
-                        if self.fractures[file_iter] >= piece_beg:
-                            # Piece ends after fracture point and also starts before fracture point,
-                            # therefore the piece is in conflict
-                            print('Fracture found in piece {} at {}'.format(piece_idx, fracture))
-                            outcome = True
-                            file_name = self.file_names[file_iter] + '|' + self.file_names[file_iter + 1]
-                            # Assigning file names for both files, existing in the piece in conflict,
-                            # concatenated with a '|' pipe
-                            fracture = self.fractures[file_iter]
-                            file_iter += 1
-                        else:
-                            # Piece ends after fracture point but does not start before fracture,
-                            # therefore belongs to a future file and getting here is an ANOMALY
-                            print("[ERROR] FUTURE FILE PIECE ANOMALY")
-                    else:
-                        # Piece ends before fracture point, going in order, so belongs to current file
-                        file_name = self.file_names[file_iter]
-                elif len(self.fractures) == 1:
-                    print('Last fracture is at the end of data.')
-                    print('Last fracture:', self.fractures[-1])
-                else:
-                    print('No fractures left in the list')
-
-            for block_idx in range(blocks_per_piece):
-                is_last_block = (blocks_per_piece - 1) == block_idx
-                block_length = (
-                    (self.piece_size % 16384) or 16384
-                    if is_last_block
-                    else 16384
-                )
-                blocks.append(
-                    Block(
-                        piece_idx,
-                        block_length * block_idx,
-                        block_length
-                    )
-                )
-
-            this_piece = Piece(piece_idx, blocks, file_name, file_idx, outcome, fracture)
-            # print(this_piece)
-            pieces.append(this_piece)
-        return pieces
-
-    def get_piece_request(self, have_pieces):
+
+        # The piece may have been handed back to the picker while it was being verified
+        self.picker.take(piece_idx)
+        self.received_pieces.add(piece_idx)
+        self.received_bytes += piece.length
+        if self.picker.priority[piece_idx]:
+            self.missing_pieces -= 1
+            self.missing_bytes -= piece.length
+        print('Piece {} DL'.format(piece_idx))
+
+        # Queue it to the writer as (absolute offset, data, piece), the writer maps the offset onto files
+        self.unwritten[piece_idx] = piece
+        self.received_pieces_queue.put_nowait((piece_idx * self.piece_size, piece.data, piece))
+
+        waiter = self.piece_waiters.pop(piece_idx, None)
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    def on_piece_written(self, piece_idx: int):
+        """
+        Task performed once the writer has a verified piece on disk
+        :param piece_idx: index of the written piece
+        """
+        self.written_pieces.add(piece_idx)
+        self.unwritten.pop(piece_idx, None)
+        # Peers can request it from now on
+        for peer in list(self.peers):
+            peer.send_have(piece_idx)
+
+    def on_piece_failed(self, piece_idx: int):
+        """
+        Gives back a verified piece the writer could not put on disk, it is downloaded again instead of leaving a
+        hole in a download which looks complete
+        :param piece_idx: index of the piece
+        """
+        if piece_idx not in self.received_pieces or piece_idx in self.written_pieces:
+            return
+        self.received_pieces.discard(piece_idx)
+        self.unwritten.pop(piece_idx, None)
+        length = self.torrent.layout.piece_range(piece_idx)[1]
+        self.received_bytes -= length
+        if self.picker.priority[piece_idx]:
+            self.missing_pieces += 1
+            self.missing_bytes += length
+        self.picker.release(piece_idx)
+        self.endgame = False
+        self.wake_peers()
+
+    def set_peer_rates(self, download_rate: int = None, upload_rate: int = None):
+        """
+        Changes the caps of every peer at runtime, None keeps a cap as it is and 0 lifts it
+        """
+        self.peer_rates = (
+            self.peer_rates[0] if download_rate is None else download_rate,
+            self.peer_rates[1] if upload_rate is None else upload_rate
+        )
+        for peer in list(self.peers):
+            peer.limiter.set_rates(download_rate, upload_rate)
+
+    def restore(self, pieces_on_disk: bytearray):
+        """
+        Marks pieces found on disk by a previous run as received and written, so they are never picked
+        :param pieces_on_disk: one byte per piece, non zero for pieces on disk
+        """
+        for piece_idx, on_disk in enumerate(pieces_on_disk):
+            if on_disk:
+                self.received_pieces.add(piece_idx)
+                self.written_pieces.add(piece_idx)
+                self.picker.take(piece_idx)
+                self.received_bytes += self.torrent.layout.piece_range(piece_idx)[1]
+        self.count_missing()
+        print("Restored {} pieces from disk".format(len(self.received_pieces)))
+
+    def stream(self, window: int = 32 * 1024 * 1024):
+        """
+        Switches to sequential streaming: the pieces of the window ahead of the last read are downloaded first and
+        in order
+        :param window: bytes of the window, 0 to switch back to rarest first
+        """
+        self.stream_window = window
+        if not window:
+            self.picker.set_window(0, 0)
+
+    def seek(self, offset: int, length: int = 1):
+        """
+        Moves the window of pieces downloaded first to a byte range of the torrent, and the streaming window on
+        past it
+        """
+        first = offset // self.piece_size
+        last = (offset + max(length, 1) - 1) // self.piece_size + 1
+        ahead = -(-self.stream_window // self.piece_size)
+        self.picker.set_window(first, last + ahead)
+        self.wake_peers()
+
+    async def read_piece(self, piece_idx: int) -> bytes:
+        """
+        Data of a piece once it is verified, from memory while it is on its way to disk
+        """
+        if not self.picker.priority[piece_idx] and piece_idx not in self.received_pieces:
+            raise ValueError('Piece {} belongs to skipped files only'.format(piece_idx))
+        while piece_idx not in self.received_pieces:
+            if piece_idx not in self.piece_waiters:
+                self.piece_waiters[piece_idx] = asyncio.get_event_loop().create_future()
+            await asyncio.shield(self.piece_waiters[piece_idx])
+
+        piece = self.unwritten.get(piece_idx)
+        if piece and piece.buffer is not None:
+            return piece.buffer  # Sliced by the caller right away, before the writer drops it
+        return await self.file_saver.read_piece(piece_idx)
+
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Reads a byte range of the torrent as soon as the pieces holding it are verified, those pieces are
+        downloaded before any other
+        :param offset: absolute offset in the torrent
+        :param length: number of bytes, reads stop at the end of the torrent
+        """
+        length = max(0, min(length, self.torrent.layout.total_length - offset))
+        if not length:
+            return b''
+        self.seek(offset, length)
+
+        chunks = []
+        first = offset // self.piece_size
+        for piece_idx in range(first, (offset + length - 1) // self.piece_size + 1):
+            data = await self.read_piece(piece_idx)
+            piece_offset = piece_idx * self.piece_size
+            begin = max(offset - piece_offset, 0)
+            chunks.append(data[begin:min(offset + length - piece_offset, len(data))])
+
+        # Read ahead of the cursor meanwhile
+        if self.stream_window:
+            self.seek(offset + length)
+        return b''.join(chunks)
+
+    def count_missing(self):
+        """
+        Counts the wanted pieces and bytes which are not received yet
+        """
+        priority = self.picker.priority
+        self.missing_pieces = 0
+        self.missing_bytes = 0
+        for piece_idx in range(self.number_of_pieces):
+            if priority[piece_idx] and piece_idx not in self.received_pieces:
+                self.missing_pieces += 1
+                self.missing_bytes += self.torrent.layout.piece_range(piece_idx)[1]
+
+    def set_file_priorities(self, priorities: list):
+        """
+        Maps file priorities onto the pieces holding the files' bytes, a piece gets the highest priority of the
+        files it holds. Pieces only holding skipped files are not downloaded, pieces in progress are finished anyway
+        :param priorities: one of SKIP, LOW, NORMAL or HIGH per file of the torrent
+        """
+        layout = self.torrent.layout
+        piece_priority = bytearray(self.number_of_pieces)
+        for file_index, priority in enumerate(priorities):
+            for piece_idx in layout.file_pieces(file_index):
+                if piece_priority[piece_idx] < priority:
+                    piece_priority[piece_idx] = priority
+
+        for piece_idx, (old, new) in enumerate(zip(self.picker.priority, piece_priority)):
+            if old == new:
+                continue
+            self.picker.set_priority(piece_idx, new)
+            if not old and piece_idx not in self.received_pieces and piece_idx not in self.pieces_in_progress:
+                self.picker.release(piece_idx, partial=piece_idx in self.pieces)
+
+        self.file_priorities = list(priorities)
+        self.count_missing()
+        if self.file_saver:
+            asyncio.ensure_future(self.file_saver.set_file_priorities(priorities))
+        self.wake_peers()
+
+    def get_piece(self, piece_idx: int) -> Piece:
+        """
+        Materializes a piece and its blocks from the piece index
+        """
+        piece = self.pieces.get(piece_idx)
+        if piece:
+            return piece
+
+        piece = Piece(piece_idx, self.torrent.layout.piece_range(piece_idx)[1], self.memory)
+        self.pieces[piece_idx] = piece
+        return piece
+
+    def get_piece_request(self, have_pieces, exclude=()):
         """
         Determines next piece for downloading. Expects BitArray
         of pieces a peer can request
+        Once every remaining piece is in progress the session is in endgame, and pieces in progress are handed out
+        again so their missing blocks get requested from more than one peer
+        While the memory budget is exhausted only partially downloaded pieces are handed out, the peers stop
+        requesting until pieces are written. Partial pieces which no connected peer can finish are dropped then
+        :param exclude: endgame piece indexes the caller already went through
+        """
+        room = self.memory.has_room(self.piece_size)
+        piece_idx = self.picker.pick(have_pieces, partial_only=not room)
+        if piece_idx is None and not room and self.evict_partial_pieces():
+            room = self.memory.has_room(self.piece_size)
+            piece_idx = self.picker.pick(have_pieces, partial_only=not room)
+        if piece_idx is None:
+            if not room:
+                print("Memory budget exhausted, waiting for pieces to be written")
+                return None
+            return self.get_endgame_piece(have_pieces, exclude)
+
+        piece = self.get_piece(piece_idx)
+        self.pieces_in_progress[piece_idx] = piece
+        print("Piece {} PR".format(piece_idx))
+        return piece
+
+    def get_endgame_piece(self, have_pieces, exclude=()):
+        """
+        Picks a piece in progress with missing blocks which the peer has, preferring the one missing the most
+        """
+        if not self.pieces_in_progress or self.picker.has_wanted():
+            # Other peers still have unrequested pieces, this one just does not have any of them
+            print("No pieces left")
+            return None
+
+        if not self.endgame:
+            print("Entering endgame with {} pieces in progress".format(len(self.pieces_in_progress)))
+            self.endgame = True
+
+        candidates = [
+            piece for piece_idx, piece in self.pieces_in_progress.items()
+            if piece_idx not in exclude and have_pieces[piece_idx] and not piece.is_complete()
+        ]
+        if not candidates:
+            print("No pieces left")
+            return None
+        return max(candidates, key=lambda piece: piece.downloaded_blocks.count(False))
+
+    def evict_partial_pieces(self) -> int:
+        """
+        Drops the partially downloaded pieces which are not in progress and which no connected peer has, or which
+        got skipped. They would hold the memory budget until a peer having them shows up, their blocks are
+        downloaded again then
+        :return: number of pieces dropped
         """
-        for piece in self.pieces:  # Synchronous if available
-            # Don't create request out of pieces we already have
-            is_piece_downloaded = piece.index in self.received_pieces
-            is_piece_in_progress = piece.index in self.pieces_in_progress
+        picker = self.picker
+        evicted = [
+            piece_idx for piece_idx in self.pieces
+            if piece_idx not in self.pieces_in_progress
+            and (not picker.available(piece_idx) or not picker.priority[piece_idx])
+        ]
+        for piece_idx in evicted:
+            print("Dropping partial Piece {}, no peer has it".format(piece_idx))
+            self.pieces.pop(piece_idx).flush()
+            picker.release(piece_idx)
+        return len(evicted)
 
-            # Skip pieces we already have or are getting
-            if is_piece_downloaded or is_piece_in_progress:
-                # print('IDX {} is_piece_downloaded {}'.format(piece.index, is_piece_downloaded))
-                # print('IDX {} is_piece_in_progress {}'.format(piece.index, is_piece_in_progress))
+    def release_pieces(self, piece_indexes):
+        """
+        Hands pieces in progress back to the picker, when the peer downloading them is gone. Pieces with
+        downloaded blocks are kept to be finished first, and connected peers are woken up to pick them
+        :param piece_indexes: indexes of the pieces to release
+        """
+        released = 0
+        for piece_idx in piece_indexes:
+            piece = self.pieces_in_progress.get(piece_idx)
+            if not piece or piece.is_complete():
+                # Done already or being verified
                 continue
+            del self.pieces_in_progress[piece_idx]
+            partial = any(piece.downloaded_blocks)
+            if not partial:
+                del self.pieces[piece_idx]
+                piece.flush()
+            self.picker.release(piece_idx, partial=partial)
+            released += 1
+
+        if released:
+            self.endgame = False
+            self.wake_peers()
+
+    def close(self):
+        """
+        Drops every piece held in memory and not handed to the disk yet, their memory goes back to the budget
+        """
+        for piece in self.pieces.values():
+            piece.flush()
+        self.pieces = {}
+        self.pieces_in_progress = {}
+        while not self.received_pieces_queue.empty():
+            queued = self.received_pieces_queue.get_nowait()
+            if queued:
+                queued[2].flush()
+        self.memory.sessions.discard(self)
+        if self.watching:
+            self.watching.cancel()
+
+    def wake_peers(self):
+        """
+        Lets every connected peer request blocks again
+        """
+        for peer in list(self.peers):
+            peer.wake()
 
-            if have_pieces[piece.index]:
-                self.pieces_in_progress[piece.index] = piece
-                print("Piece {} PR".format(piece.index))
-                return piece
+    @property
+    def left(self) -> int:
+        """
+        Bytes of the wanted pieces left to download, reported to trackers
+        """
+        return self.missing_bytes
 
-        print("No pieces left")
-        # print("Pieces in progress", ' '.join(sort([piece.index for piece in pieces_in_progress])))
-        # print("Pieces downloaded", ' '.join(sort([piece.index for piece in received_pieces])))
-        # raise Exception('Not eligible for valid pieces')
+    def is_complete(self) -> bool:
+        """
+        True once every wanted piece is received
+        """
+        return not self.missing_pieces
 
     def __repr__(self):
         data = {
             'number of pieces': self.number_of_pieces,
             'piece size': self.piece_size,
-            'pieces': self.pieces[:5]
+            'pieces': list(self.pieces.values())[:5]
         }
         return pformat(data)
 
@@ -279,56 +591,69 @@ class Tee:
             file.write(obj)
 
 
-async def download(torrent_file: str, download_location: str):
+async def download(torrent_file: str, download_location: str, verify: bool = False, seed: bool = False,
+                   download_rate: int = 0, upload_rate: int = 0, file_priorities: list = None):
     """
     Download coroutine to start a download by accepting a torrent file and download location
     :param torrent_file: torrent file to be downloaded
     :param download_location: location to download it to
+    :param verify: verify existing data on disk instead of trusting the resume file
+    :param seed: keep uploading once the download is complete, until interrupted
+    :param download_rate: global download limit in bytes per second, 0 for none
+    :param upload_rate: global upload limit in bytes per second, 0 for none
+    :param file_priorities: SKIP, LOW, NORMAL or HIGH per file, every file at NORMAL by default
     """
     torrent = Torrent(torrent_file)
 
-    torrent_writer = FileSaver(download_location, torrent)
-    session = DownloadSession(torrent, torrent_writer.get_received_pieces_queue())  # FILESAVER
-
-    done_pieces = 0
-
-    while done_pieces < torrent.number_of_pieces:
-        await torrent.get_peers()
-        peers_info = list(set(torrent.peers))
-
-        seen_peers = set()
-        peers = [
-            Peer(session, host, port)
-            for host, port in peers_info
-        ]
-        seen_peers.update([str(p) for p in peers])
-
-        print('[Peers]: {} {}'.format(len(seen_peers), seen_peers))
-        for peer in peers:
-            peer.inflight_requests = 0
-
+    torrent_writer = FileSaver(download_location, torrent, file_priorities=file_priorities)
+    limiter = RateLimiter(download_rate, upload_rate)
+    session = DownloadSession(torrent, torrent_writer.get_received_pieces_queue(), file_saver=torrent_writer,
+                              limiter=limiter)
+    torrent_writer.on_piece_written = session.on_piece_written
+    torrent_writer.on_piece_failed = session.on_piece_failed
+    if file_priorities:
+        session.set_file_priorities(file_priorities)
+
+    resume = ResumeData(torrent, download_location)
+    # Pieces on disk are known before any peer connects, a recheck runs on its own threads
+    session.restore(await asyncio.get_event_loop().run_in_executor(None, resume.load_or_recheck, verify))
+    saving = asyncio.ensure_future(resume.run(session))
+
+    try:
+        swarm = Swarm(session, torrent)
+        await swarm.listen()
         print("STARTING")
-        await (asyncio.gather(*[peer.download() for peer in peers]))
+        await swarm.run(seed)
+        # The last pieces are still on their way to disk, one failing to be written leaves the download incomplete
+        while session.unwritten:
+            await asyncio.sleep(0.1)
+        if not session.is_complete():
+            print("Download incomplete, {} pieces could not be written".format(session.missing_pieces))
+            return False
 
         print("received", len(session.received_pieces))
+        print("hasher", pformat(session.hasher.stats()))
+        print("read cache", pformat(torrent_writer.read_cache.stats()))
+        print("memory", pformat(session.memory.stats()))
+    finally:
+        saving.cancel()
+        session.close()
+        # Pieces handed to the disk threads are written before the disk goes away
+        torrent_writer.get_received_pieces_queue().put_nowait(None)
+        await torrent_writer.writing
+        torrent_writer.disk.close()
+        resume.save(session.written_pieces)
+    return True
 
-        print("progress", len(session.pieces_in_progress))
-        pprint(session.pieces_in_progress)
-
-        print("resetting session.pieces_in_progress")
-        session.pieces_in_progress = {}
-
-        print("alive peers")
-        peers = [peer for peer in peers if peer.have_pieces is not None]
-
-        print("bitfields")
-        pprint([(peer, peer.have_pieces) for peer in peers])
-
-        done_pieces = len(session.received_pieces)
-        print("Done pieces:", done_pieces)
-        print("RESTARTING")
 
-    return True
+def option(name: str, default: int = 0) -> int:
+    """
+    Integer value of a --name=value command line option
+    """
+    for arg in sys.argv[2:]:
+        if arg.startswith('--{}='.format(name)):
+            return int(arg.split('=', 1)[1])
+    return default
 
 
 if __name__ == '__main__':
@@ -341,5 +666,8 @@ if __name__ == '__main__':
     # TODO 100% test coverage before adding/moding a line of code
     # TODO some GUI status update per piece/block, files -> pieces -> blocks hierarchy
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(download(sys.argv[1], './downloads'))
+    loop.run_until_complete(download(sys.argv[1], './downloads', verify='--verify' in sys.argv[2:],
+                                     seed='--seed' in sys.argv[2:],
+                                     download_rate=option('download-rate') * 1024,
+                                     upload_rate=option('upload-rate') * 1024))
     loop.close()
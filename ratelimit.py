@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket metering bytes at a rate, a rate of 0 means unlimited
+    Transfers take their tokens up front and the bucket may go into debt, the next consumer waits for the debt to
+    be paid back. Consumers wait in line on a FIFO lock, so peers sharing a bucket share its rate fairly
+    """
+    BURST = 1.0  # Seconds of tokens the bucket holds at most
+    MAX_SLEEP = 0.1  # Waits are sliced, so rate changes apply right away
+
+    def __init__(self, rate: int = 0):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def set_rate(self, rate: int):
+        """
+        Changes the rate at runtime
+        :param rate: bytes per second, 0 for unlimited
+        """
+        self._refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, rate * self.BURST)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.last_refill) * self.rate, self.rate * self.BURST)
+        self.last_refill = now
+
+    async def consume(self, amount: int):
+        """
+        Takes amount tokens, waiting until the bucket is out of debt
+        """
+        if not self.rate:
+            return
+        async with self.lock:
+            self._refill()
+            self.tokens -= amount
+            while self.tokens < 0 and self.rate:
+                await asyncio.sleep(min(-self.tokens / self.rate, self.MAX_SLEEP))
+                self._refill()
+
+
+class RateLimiter:
+    """
+    Download and upload buckets of one scope, globally, for a torrent or for a peer
+    Limiters are chained to their parent scope, a transfer waits for the buckets of every scope it belongs to
+    """
+    def __init__(self, download_rate: int = 0, upload_rate: int = 0, parent=None):
+        self.download = TokenBucket(download_rate)
+        self.upload = TokenBucket(upload_rate)
+        self.parent: RateLimiter = parent
+
+    def set_rates(self, download_rate: int = None, upload_rate: int = None):
+        """
+        Changes the limits at runtime, None keeps a limit as it is and 0 lifts it
+        """
+        if download_rate is not None:
+            self.download.set_rate(download_rate)
+        if upload_rate is not None:
+            self.upload.set_rate(upload_rate)
+
+    async def consume_download(self, amount: int):
+        limiter = self
+        while limiter:
+            await limiter.download.consume(amount)
+            limiter = limiter.parent
+
+    async def consume_upload(self, amount: int):
+        limiter = self
+        while limiter:
+            await limiter.upload.consume(amount)
+            limiter = limiter.parent
+
+    def __repr__(self):
+        return '<RateLimiter down: {} up: {}>'.format(self.download.rate, self.upload.rate)
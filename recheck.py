@@ -0,0 +1,97 @@
+import hashlib
+import mmap
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from file_saver import map_segments, parts_file
+
+
+class MappedFiles:
+    """
+    Least recently used set of read only memory maps over the files of a download, owned by one hashing thread
+    """
+    def __init__(self, outdir: str, max_maps: int = 32):
+        self.outdir = outdir
+        self.max_maps = max_maps
+        self.maps = OrderedDict()  # Relative path -> mmap, None for files which can't be mapped
+
+    def get(self, path: str):
+        """
+        Returns the map of a file, or None if it is missing or empty
+        """
+        if path in self.maps:
+            self.maps.move_to_end(path)
+            return self.maps[path]
+
+        try:
+            with open(os.path.join(self.outdir, path), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+        except (OSError, ValueError):  # ValueError for empty files
+            mapped = None
+
+        self.maps[path] = mapped
+        if len(self.maps) > self.max_maps:
+            _, evicted = self.maps.popitem(last=False)
+            if evicted is not None:
+                evicted.close()
+        return mapped
+
+    def close(self):
+        while self.maps:
+            _, mapped = self.maps.popitem()
+            if mapped is not None:
+                mapped.close()
+
+
+def hash_pieces(torrent, outdir: str, first: int, last: int, created_files: bytearray) -> list:
+    """
+    Hashes a range of pieces straight out of the page cache, segments of pieces spanning files are fed to the
+    hash one after the other without being joined
+    :param created_files: one flag per file, bytes of the files which don't exist are read from the parts file
+    :return: indexes of the valid pieces in [first, last)
+    """
+    layout = torrent.layout
+    parts_path = parts_file(torrent)
+    files = MappedFiles(outdir)
+    valid = []
+    try:
+        for piece_idx in range(first, last):
+            piece_hash = hashlib.sha1()
+            for segment in map_segments(layout, created_files, parts_path, *layout.piece_range(piece_idx)):
+                mapped = files.get(segment.path)
+                if mapped is None or len(mapped) < segment.offset + segment.length:
+                    break
+                with memoryview(mapped) as view:
+                    with view[segment.offset:segment.offset + segment.length] as part:
+                        piece_hash.update(part)  # Releases the GIL, threads hash on all cores
+            else:
+                if piece_hash.digest() == torrent.get_piece_hash(piece_idx):
+                    valid.append(piece_idx)
+    finally:
+        files.close()
+    return valid
+
+
+def recheck(torrent, outdir: str, workers: int = None, pieces_per_task: int = 64) -> bytearray:
+    """
+    Hashes every piece found on disk against the torrent, contiguous runs of pieces are spread over a pool of
+    hashing threads so a recheck is bound by the disk rather than by a single core
+    :return: one byte per piece, 1 for pieces which are on disk and valid
+    """
+    verified = bytearray(torrent.number_of_pieces)
+    # Same rule as the writer: files which exist are written to, the bytes of the others are in the parts file
+    created_files = bytearray(os.path.exists(os.path.join(outdir, path)) for path in torrent.layout.paths)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        tasks = [
+            executor.submit(hash_pieces, torrent, outdir, first, min(first + pieces_per_task, torrent.number_of_pieces),
+                            created_files)
+            for first in range(0, torrent.number_of_pieces, pieces_per_task)
+        ]
+        for task in tasks:
+            for piece_idx in task.result():
+                verified[piece_idx] = 1
+    print("Recheck found {} valid pieces".format(sum(verified)))
+    return verified
@@ -0,0 +1,99 @@
+import asyncio
+import os
+
+import bencoding
+
+from recheck import recheck
+
+
+def file_stats(outdir: str, layout) -> list:
+    """
+    Size and modification time in ns of every file of a download, empty for missing files
+    """
+    stats = []
+    for path in layout.paths:
+        try:
+            st = os.stat(os.path.join(outdir, path))
+        except OSError:
+            stats.append([])
+            continue
+        stats.append([st.st_size, st.st_mtime_ns])
+    return stats
+
+
+class ResumeData:
+    """
+    Fast resume state kept next to a download: the bitfield of pieces written to disk, and size and modification
+    time of every file when it was saved. The state is trusted on startup only if the files are untouched since
+    """
+    VERSION = 1
+
+    def __init__(self, torrent, outdir: str, interval: float = 30):
+        self.torrent = torrent
+        self.outdir = outdir
+        self.interval = interval  # Seconds between two saves at most
+        self.path = os.path.join(outdir, '.{}.resume'.format(torrent.info_hash.hex()))
+        self.saved_count = -1
+
+    def save(self, written_pieces):
+        """
+        Atomically replaces the resume file with the current state
+        :param written_pieces: PieceSet of the pieces on disk
+        """
+        state = {
+            b'version': self.VERSION,
+            b'info-hash': self.torrent.info_hash,
+            b'pieces': bytes(written_pieces.flags),
+            b'files': file_stats(self.outdir, self.torrent.layout),
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bencoding.bencode(state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.saved_count = len(written_pieces)
+
+    def load(self):
+        """
+        Reads the resume file
+        :return: bitfield of pieces on disk, one byte per piece, or None if the state can't be trusted
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                state = bencoding.bdecode(f.read())
+        except Exception as e:
+            print("No usable resume data at {}\n{}".format(self.path, e))
+            return None
+
+        if (state.get(b'version') != self.VERSION or state.get(b'info-hash') != self.torrent.info_hash or
+                len(state.get(b'pieces', b'')) != self.torrent.number_of_pieces):
+            print("Resume data at {} belongs to another torrent".format(self.path))
+            return None
+
+        if [list(stat) for stat in state[b'files']] != file_stats(self.outdir, self.torrent.layout):
+            print("Files changed since resume data was saved")
+            return None
+
+        return bytearray(state[b'pieces'])
+
+    def load_or_recheck(self, verify: bool = False) -> bytearray:
+        """
+        Pieces already on disk, from the resume file when it is still valid, or by hashing the files otherwise
+        :param verify: always hash the files, ignoring the resume file
+        """
+        pieces = None if verify else self.load()
+        if pieces is None:
+            print("Rechecking existing data")
+            pieces = recheck(self.torrent, self.outdir)
+        return pieces
+
+    async def run(self, session):
+        """
+        Saves the session's progress every interval, when pieces were written since the last save
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            if len(session.written_pieces) != self.saved_count:
+                # Stat'ing every file and the fsync stay off the event loop
+                await asyncio.get_event_loop().run_in_executor(None, self.save, session.written_pieces)
@@ -0,0 +1,219 @@
+import asyncio
+import time
+
+from peer import Peer
+from tracker import Announcer
+
+SHUTDOWN_TIMEOUT = 10  # Seconds the peers get to end once the swarm stops
+
+
+class ConnectionBudget:
+    """
+    Peer connection slots, shared by the swarms of every torrent of a process
+    """
+    def __init__(self, max_connections: int = 200):
+        self.max_connections = max_connections
+        self.used = 0
+
+    def acquire(self) -> bool:
+        """
+        Takes a slot if one is free
+        """
+        if self.used >= self.max_connections:
+            return False
+        self.used += 1
+        return True
+
+    def release(self):
+        self.used -= 1
+
+
+class Swarm:
+    """
+    Long running manager of the peer connections of a download session
+    It keeps up to max_connections peers connected, replaces every dropped peer right away from a pool of
+    candidates filled by the trackers, and re-announces on the trackers' intervals. Pieces of a dropped peer are
+    handed back to the picker by the peer itself, so nothing waits for a round to end.
+    Peers connecting to us are accepted on the listening port as long as there is a free slot.
+    Several swarms can share a connection budget and an announcer's sockets, with the listening port owned by
+    whoever dispatches incoming connections to them
+    """
+    RETRY_DELAY = 60  # Seconds before a failed candidate is tried again, multiplied by its failures
+    MAX_FAILURES = 5
+
+    def __init__(self, session, torrent, max_connections: int = 30, port: int = 6881, announcer: Announcer = None,
+                 budget: ConnectionBudget = None):
+        self.session = session
+        self.torrent = torrent
+        self.max_connections = max_connections
+        self.port = port
+        self.server = None
+        self.budget = budget or ConnectionBudget(max_connections)
+        self.on_complete = None  # Callback once the session has every piece
+
+        self.candidates = []  # (host, port) waiting for a connection slot
+        self.known = set()  # Every (host, port) ever seen
+        self.failures = {}  # (host, port) -> number of connections which ended without a single block
+        self.retry_at = {}  # (host, port) -> time before which it is not tried again
+        self.connections = {}  # Task -> Peer
+        self.announcer = announcer or Announcer(torrent, port)
+
+    def add_candidates(self, addresses):
+        """
+        Adds peers returned by a tracker to the pool of candidates
+        :param addresses: iterable of (host, port)
+        """
+        for address in addresses:
+            address = tuple(address)
+            if address not in self.known:
+                self.known.add(address)
+                self.candidates.append(address)
+
+    async def announce(self, starving: bool = False):
+        """
+        Asks the trackers for peers, connecting to them as each tracker answers
+        :param starving: out of candidates, ask trackers past their min interval as well
+        """
+        async for peers in self.announcer.announce(
+                self.session.uploaded, self.session.downloaded, self.session.left, starving=starving):
+            self.add_candidates(peers)
+            self.connect_peers()
+        print('[Swarm] {} candidates, {} connected'.format(len(self.candidates), len(self.connections)))
+
+    def connect_peers(self):
+        """
+        Starts connections to candidates until max_connections peers are connected
+        """
+        now = time.monotonic()
+        deferred = []
+        while self.candidates and len(self.connections) < self.max_connections:
+            address = self.candidates.pop(0)
+            if self.retry_at.get(address, 0) > now:
+                deferred.append(address)
+                continue
+            if not self.budget.acquire():
+                deferred.append(address)
+                break
+            peer = Peer(self.session, *address)
+            self.connections[asyncio.ensure_future(peer.download())] = peer
+        self.candidates.extend(deferred)
+
+    async def listen(self, reuse_port: bool = False):
+        """
+        Starts accepting incoming peer connections
+        :param reuse_port: share the port with other processes, the kernel spreads connections over them
+        """
+        try:
+            self.server = await asyncio.start_server(self.on_incoming, port=self.port, reuse_port=reuse_port)
+        except OSError as e:
+            print('[Swarm] Not accepting incoming peers on port {}\n{}'.format(self.port, e))
+
+    async def on_incoming(self, reader, writer):
+        """
+        Handshake of an incoming connection, the peer sends its handshake first
+        """
+        try:
+            handshake = await asyncio.wait_for(reader.readexactly(68), timeout=5)
+        except Exception:
+            writer.close()
+            return
+        if Peer.parse_handshake(handshake) != self.session.info_hash:
+            writer.close()
+            return
+        self.accept(reader, writer)
+
+    def accept(self, reader, writer):
+        """
+        Takes over an incoming connection whose handshake is for this torrent, and answers it
+        """
+        if len(self.connections) >= self.max_connections or not self.budget.acquire():
+            writer.close()
+            return
+        host, port = writer.get_extra_info('peername')[:2]
+        peer = Peer(self.session, host, port, reader, writer)
+        writer.write(peer.handshake())
+        self.known.add((host, port))
+        self.connections[asyncio.ensure_future(peer.download())] = peer
+
+    def on_peer_done(self, peer):
+        """
+        Puts a dropped peer back in the pool, peers which never delivered anything are retried later and
+        eventually forgotten
+        """
+        self.budget.release()
+        if peer.incoming:
+            # Ephemeral port, can't be connected back to
+            return
+        address = (peer.host, peer.port)
+        if peer.pipeline.rate or peer.pipeline.min_rtt is not None:
+            self.failures.pop(address, None)
+        else:
+            self.failures[address] = self.failures.get(address, 0) + 1
+            if self.failures[address] >= self.MAX_FAILURES:
+                return
+            self.retry_at[address] = time.monotonic() + self.RETRY_DELAY * self.failures[address]
+        self.candidates.append(address)
+
+    async def run(self, seed: bool = False):
+        """
+        Runs the swarm until the session has every piece
+        :param seed: keep serving peers once the download is complete, until cancelled
+        """
+        announcing = None
+        completed = self.session.is_complete()
+        choking = asyncio.ensure_future(self.session.choker.run())
+        try:
+            while seed or not self.session.is_complete():
+                if not completed and self.session.is_complete():
+                    # Trackers get the completed event right away
+                    completed = True
+                    for tracker in self.announcer.trackers:
+                        tracker.next_announce = 0
+                    if self.on_complete:
+                        self.on_complete()
+                elif completed and not self.session.is_complete():
+                    # Files skipped until now were selected since
+                    completed = False
+                # Out of candidates with free slots, trackers are asked again sooner
+                starving = len(self.connections) < self.max_connections and not self.candidates
+                if (announcing is None or announcing.done()) and self.announcer.is_due(starving):
+                    announcing = asyncio.ensure_future(self.announce(starving))
+
+                self.connect_peers()
+                if not self.connections:
+                    await asyncio.sleep(1)
+                    continue
+
+                done, _ = await asyncio.wait(
+                    list(self.connections), timeout=1, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    self.on_peer_done(self.connections.pop(task))
+            if not completed:
+                # Trackers get the completed event right away
+                for tracker in self.announcer.trackers:
+                    tracker.next_announce = 0
+                if self.on_complete:
+                    self.on_complete()
+                await self.announce()
+        finally:
+            choking.cancel()
+            if announcing:
+                announcing.cancel()
+            if self.server:
+                self.server.close()
+                await self.server.wait_closed()
+                self.server = None
+            for task, peer in self.connections.items():
+                peer.close()
+                task.cancel()
+            if self.connections:
+                _, pending = await asyncio.wait(list(self.connections), timeout=SHUTDOWN_TIMEOUT)
+                for task in pending:
+                    print('[Swarm] {} still running {} seconds after being stopped'.format(
+                        self.connections[task], SHUTDOWN_TIMEOUT
+                    ))
+            for _ in self.connections:
+                self.budget.release()
+            self.connections = {}
+            await self.announcer.close()
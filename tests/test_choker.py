@@ -0,0 +1,203 @@
+import asyncio
+import random
+import unittest
+from unittest import mock
+
+from choker import Choker
+
+
+class StubPeer:
+    """
+    The parts of a Peer the choker looks at, the counters are driven by the tests
+    """
+    def __init__(self, name: str, connected_at: float = -1000, interested: bool = True):
+        self.name = name
+        self.connected_at = connected_at
+        self.peer_interested = interested
+        self.snubbed = False
+        self.am_choking = True
+        self.downloaded = 0
+        self.uploaded = 0
+
+    def choke(self):
+        self.am_choking = True
+
+    def unchoke(self):
+        self.am_choking = False
+
+    def __repr__(self):
+        return self.name
+
+
+class StubSession:
+    def __init__(self, peers: list):
+        self.peers = peers
+        self.complete = False
+
+    def is_complete(self) -> bool:
+        return self.complete
+
+
+class Clock:
+    """
+    Time of the choker, moved forward only by its sleeps
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+        await asyncio.sleep(0)
+
+
+class ChokerTest(unittest.TestCase):
+    """
+    Six interested peers for four regular slots and the optimistic one
+    """
+    def setUp(self):
+        random.seed(0)
+        self.peers = [StubPeer('peer{}'.format(index)) for index in range(6)]
+        self.session = StubSession(self.peers)
+        self.choker = Choker(self.session)
+
+    def unchoked(self) -> set:
+        return {peer for peer in self.peers if not peer.am_choking}
+
+    def send(self, amounts: list):
+        """
+        Every peer sends us that many bytes since the last rechoke
+        """
+        for peer, amount in zip(self.peers, amounts):
+            peer.downloaded += amount
+
+    def test_fastest_peers_get_the_regular_slots(self):
+        self.send([600, 500, 400, 300, 200, 100])
+        self.choker.rechoke(True)
+        regular = set(self.peers[:4])
+        self.assertTrue(regular <= self.unchoked())
+        self.assertIn(self.choker.optimistic, self.peers[4:])
+        self.assertEqual(self.unchoked(), regular | {self.choker.optimistic})
+
+    def test_rates_are_over_the_last_interval(self):
+        self.send([600, 500, 400, 300, 200, 100])
+        self.choker.rechoke(True)
+        # The first peers stop sending, the totals still rank them first but the last interval does not
+        self.send([0, 0, 0, 0, 200, 100])
+        self.choker.rechoke()
+        self.assertTrue({self.peers[4], self.peers[5]} <= self.unchoked())
+        self.assertEqual(len(self.unchoked()), 5)
+        self.assertEqual(self.choker.rates[self.peers[0]], 0)
+
+    def test_upload_rates_once_seeding(self):
+        self.send([600, 500, 400, 300, 200, 100])
+        self.choker.rechoke(True)
+        self.session.complete = True
+        for peer, amount in zip(self.peers, [100, 200, 300, 400, 500, 600]):
+            peer.uploaded += amount
+        self.choker.rechoke()
+        self.assertTrue(set(self.peers[2:]) <= self.unchoked())
+
+    def test_uninterested_and_snubbing_peers(self):
+        self.peers[0].peer_interested = False
+        self.peers[1].snubbed = True
+        self.send([600, 500, 400, 300, 200, 100])
+        self.choker.rechoke(True)
+        self.assertTrue(self.peers[0].am_choking)
+        # Only the optimistic slot is left for a snubbing peer
+        self.assertTrue(set(self.peers[2:]) <= self.unchoked())
+        self.assertEqual(len(self.unchoked()), 5 if self.choker.optimistic is self.peers[1] else 4)
+
+    def test_optimistic_slot_rotates(self):
+        self.send([600, 500, 400, 300, 200, 100])
+        self.choker.rechoke(True)
+        optimistic = self.choker.optimistic
+
+        # Kept over rechokes without rotation
+        for _ in range(5):
+            self.send([600, 500, 400, 300, 200, 100])
+            self.choker.rechoke()
+            self.assertIs(self.choker.optimistic, optimistic)
+            self.assertFalse(optimistic.am_choking)
+
+        holders = set()
+        for _ in range(50):
+            self.send([600, 500, 400, 300, 200, 100])
+            self.choker.rechoke(True)
+            holders.add(self.choker.optimistic)
+            # The other choked peer is choked again
+            self.assertEqual(self.unchoked(), set(self.peers[:4]) | {self.choker.optimistic})
+        self.assertEqual(holders, set(self.peers[4:]))
+
+    def test_optimistic_peer_earning_a_regular_slot(self):
+        self.send([600, 500, 400, 300, 200, 100])
+        self.choker.rechoke(True)
+        optimistic = self.choker.optimistic
+        amounts = [600, 500, 400, 300, 200, 100]
+        amounts[self.peers.index(optimistic)] = 1000
+        self.send(amounts)
+        self.choker.rechoke()
+        # The slot it held goes to another choked peer
+        self.assertIsNot(self.choker.optimistic, optimistic)
+        self.assertEqual(len(self.unchoked()), 5)
+
+    def test_optimistic_peer_gone(self):
+        self.choker.rechoke(True)
+        optimistic = self.choker.optimistic
+        self.peers.remove(optimistic)
+        self.choker.on_peer_gone(optimistic)
+        self.choker.rechoke()
+        self.assertIn(self.choker.optimistic, self.peers)
+
+    def test_new_peers_are_likelier_optimistic(self):
+        old = StubPeer('old')
+        new = StubPeer('new', connected_at=Choker.NEW_PEER_AGE * 1000)
+        with mock.patch('choker.time.monotonic', return_value=Choker.NEW_PEER_AGE * 1000 + 1):
+            picks = [self.choker.pick_optimistic([old, new]) for _ in range(4000)]
+        self.assertAlmostEqual(picks.count(new) / len(picks), 0.75, delta=0.03)
+
+    def test_interested_peer_unchoked_while_slots_are_free(self):
+        for peer in self.peers:
+            peer.peer_interested = False
+        for peer in self.peers:
+            peer.peer_interested = True
+            self.choker.on_interested(peer)
+        # The four regular slots and the optimistic one
+        self.assertEqual(self.unchoked(), set(self.peers[:5]))
+
+
+class ChokerRunTest(unittest.IsolatedAsyncioTestCase):
+    async def test_rechoke_and_rotation_intervals(self):
+        clock = Clock()
+        peers = [StubPeer('peer{}'.format(index)) for index in range(6)]
+        choker = Choker(StubSession(peers), interval=10, optimistic_interval=30)
+        rechokes = []
+        real_rechoke = choker.rechoke
+
+        def rechoke(rotate_optimistic: bool = False):
+            for peer in peers:
+                peer.downloaded += 100
+            real_rechoke(rotate_optimistic)
+            rechokes.append((clock.now, rotate_optimistic, choker.optimistic))
+
+        choker.rechoke = rechoke
+        with mock.patch('choker.time', clock), mock.patch('choker.asyncio', clock):
+            running = asyncio.ensure_future(choker.run())
+            while len(rechokes) < 9:
+                await asyncio.sleep(0)
+            running.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await running
+        self.assertEqual([now for now, _, _ in rechokes], [10.0 * index for index in range(1, 10)])
+        self.assertEqual([now for now, rotate, _ in rechokes if rotate], [30.0, 60.0, 90.0])
+        # The optimistic peer only changes when the slot rotates
+        for (_, _, before), (_, rotate, after) in zip(rechokes, rechokes[1:]):
+            if not rotate:
+                self.assertIs(after, before)
+        self.assertIn(rechokes[-1][2], peers[4:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import bitstring
+
+from bench import SyntheticTorrent
+from memory_budget import MemoryBudget
+from pytor import DownloadSession
+from torrent import Torrent
+
+
+class MemoryBudgetTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Budget of two pieces, both held by partial pieces of a peer which went away
+    """
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        synthetic = SyntheticTorrent('budget', 1, 8 * 32 * 1024, 32 * 1024)
+        path = os.path.join(self.tmp.name, 'budget.torrent')
+        synthetic.write(path, 'http://127.0.0.1:1/announce')
+        self.torrent = Torrent(path)
+        self.memory = MemoryBudget(2 * 32 * 1024)
+        self.session = DownloadSession(self.torrent, asyncio.Queue(), memory=self.memory)
+
+    async def asyncTearDown(self):
+        self.session.close()
+        self.tmp.cleanup()
+
+    def bitfield(self, pieces) -> bitstring.BitArray:
+        have_pieces = bitstring.BitArray(length=self.torrent.number_of_pieces)
+        for piece_idx in pieces:
+            have_pieces[piece_idx] = True
+        return have_pieces
+
+    def leave_partial(self, have_pieces: bitstring.BitArray):
+        """
+        A peer downloads a block of every piece it is handed and goes away
+        """
+        session = self.session
+        session.picker.add_peer(have_pieces)
+        pieces = [session.get_piece_request(have_pieces) for _ in range(2)]
+        for piece in pieces:
+            piece.save_block(0, bytes(piece.blocks[0].length))
+        session.release_pieces([piece.index for piece in pieces])
+        session.picker.remove_peer(have_pieces)
+        return pieces
+
+    async def test_partial_pieces_nobody_has_are_dropped(self):
+        self.leave_partial(self.bitfield([0, 1]))
+        self.assertEqual(self.memory.used, self.memory.max_bytes)
+
+        # The budget is full of pieces only the peer which left had, the next peer would stall
+        have_pieces = self.bitfield([2, 3])
+        self.session.picker.add_peer(have_pieces)
+        piece = self.session.get_piece_request(have_pieces)
+        self.assertIn(piece.index, (2, 3))
+        self.assertEqual(sorted(self.session.pieces), [piece.index])
+        self.assertEqual(self.memory.used, piece.length)
+
+        # They are picked again, from scratch, once a peer has them
+        returning = self.bitfield([0, 1])
+        self.session.picker.add_peer(returning)
+        self.assertIn(self.session.get_piece_request(returning).index, (0, 1))
+
+    async def test_partial_pieces_a_peer_has_are_kept(self):
+        have_pieces = self.bitfield([0, 1])
+        self.leave_partial(have_pieces)
+        self.session.picker.add_peer(have_pieces)  # Another peer has them
+
+        other = self.bitfield([2, 3])
+        self.session.picker.add_peer(other)
+        self.assertIsNone(self.session.get_piece_request(other))
+        piece = self.session.get_piece_request(have_pieces)
+        self.assertTrue(piece.downloaded_blocks[0])  # Finished rather than started over
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import random
+import tempfile
+import unittest
+
+import bencoding
+
+from torrent import Torrent
+
+
+class TinyFilesTest(unittest.TestCase):
+    """
+    50,000 files of a few hundred bytes at most, some empty, so most pieces span hundreds of files
+    """
+    @classmethod
+    def setUpClass(cls):
+        rand = random.Random(0)
+        cls.lengths = [rand.choice((0, 1, rand.randrange(2, 400))) for _ in range(50000)]
+        piece_length = 16 * 1024
+        total_length = sum(cls.lengths)
+        info = {
+            b'name': b'tiny',
+            b'piece length': piece_length,
+            b'pieces': os.urandom(20 * -(-total_length // piece_length)),
+            b'files': [
+                {b'length': length, b'path': [b'dir%d' % (index // 1000), b'file%d' % index]}
+                for index, length in enumerate(cls.lengths)
+            ],
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'tiny.torrent')
+            with open(path, 'wb') as f:
+                f.write(bencoding.bencode({b'announce': b'http://127.0.0.1:1/announce', b'info': info}))
+            cls.torrent = Torrent(path)
+        cls.layout = cls.torrent.layout
+
+    def check_range(self, offset: int, length: int, segments: list):
+        """
+        Segments are in file order, each inside its file, and together cover the range without gaps or overlaps
+        """
+        layout = self.layout
+        begin = 0
+        file_index = -1
+        for segment in segments:
+            self.assertGreater(segment.file_index, file_index)
+            file_index = segment.file_index
+            self.assertEqual(segment.begin, begin)
+            self.assertGreater(segment.length, 0)
+            self.assertGreaterEqual(segment.offset, 0)
+            self.assertLessEqual(segment.offset + segment.length, layout.lengths[file_index])
+            self.assertEqual(layout.starts[file_index] + segment.offset, offset + segment.begin)
+            self.assertEqual(segment.path, layout.paths[file_index])
+            begin += segment.length
+        self.assertEqual(begin, length)
+
+    def test_pieces_cover_every_file_once(self):
+        layout = self.layout
+        self.assertEqual(len(layout), 50000)
+        self.assertEqual(layout.total_length, sum(self.lengths))
+
+        covered = [0] * len(layout)
+        pieces_of_files = [set() for _ in range(len(layout))]
+        for piece_idx in range(self.torrent.number_of_pieces):
+            offset, length = layout.piece_range(piece_idx)
+            segments = layout.piece_segments(piece_idx)
+            self.check_range(offset, length, segments)
+            for segment in segments:
+                covered[segment.file_index] += segment.length
+                pieces_of_files[segment.file_index].add(piece_idx)
+
+        self.assertEqual(covered, self.lengths)
+        for file_index in range(len(layout)):
+            self.assertEqual(pieces_of_files[file_index], set(layout.file_pieces(file_index)))
+
+    def test_arbitrary_ranges(self):
+        rand = random.Random(1)
+        total_length = self.layout.total_length
+        for _ in range(2000):
+            offset = rand.randrange(total_length)
+            length = rand.randrange(1, min(total_length - offset, 64 * 1024) + 1)
+            self.check_range(offset, length, self.layout.map(offset, length))
+
+
+if __name__ == '__main__':
+    unittest.main()
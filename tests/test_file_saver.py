@@ -0,0 +1,157 @@
+import asyncio
+import errno
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import bitstring
+
+import disk_io
+from bench import SyntheticTorrent
+from file_saver import FileSaver
+from piece_picker import NORMAL, SKIP
+from pytor import DownloadSession
+from recheck import recheck
+from torrent import Torrent
+
+
+class SkippedFilesTest(unittest.IsolatedAsyncioTestCase):
+    """
+    40 files with every third one skipped, pieces on the boundaries of skipped files are partly in the parts file
+    """
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.synthetic = SyntheticTorrent('skipped', 40, 40 * 50000, 32 * 1024)
+        path = os.path.join(self.tmp.name, 'skipped.torrent')
+        self.synthetic.write(path, 'http://127.0.0.1:1/announce')
+        self.torrent = Torrent(path)
+        self.outdir = os.path.join(self.tmp.name, 'downloads')
+        self.priorities = [SKIP if file_index % 3 == 2 else NORMAL for file_index in range(40)]
+
+        layout = self.torrent.layout
+        self.wanted = sorted({
+            piece_idx for file_index, priority in enumerate(self.priorities) if priority
+            for piece_idx in layout.file_pieces(file_index)
+        })
+        self.saver = FileSaver(self.outdir, self.torrent, file_priorities=self.priorities)
+
+    async def asyncTearDown(self):
+        self.saver.received_pieces_queue.put_nowait(None)
+        self.saver.disk.close()
+        self.tmp.cleanup()
+
+    async def write(self, pieces: list):
+        written = set()
+        done = asyncio.get_running_loop().create_future()
+
+        def on_piece_written(piece_idx: int):
+            written.add(piece_idx)
+            if len(written) == len(pieces):
+                done.set_result(None)
+
+        self.saver.on_piece_written = on_piece_written
+        for piece_idx in pieces:
+            offset, length = self.torrent.layout.piece_range(piece_idx)
+            piece = SimpleNamespace(index=piece_idx, flush=lambda: None)
+            self.saver.received_pieces_queue.put_nowait((offset, self.synthetic.payload[offset:offset + length], piece))
+        return done
+
+    async def test_recheck_reads_the_parts_file(self):
+        await asyncio.wait_for(await self.write(self.wanted), 10)
+        self.assertTrue(os.path.exists(os.path.join(self.outdir, self.saver.parts_path)))
+
+        verified = await asyncio.get_running_loop().run_in_executor(None, recheck, self.torrent, self.outdir)
+        self.assertEqual([piece_idx for piece_idx, valid in enumerate(verified) if valid], self.wanted)
+
+    async def test_unskipping_while_writing(self):
+        done = await self.write(self.wanted)
+        await asyncio.sleep(0)  # Let some writes reach the disk threads
+        await self.saver.set_file_priorities([NORMAL] * 40)
+        await asyncio.wait_for(done, 10)
+
+        # Bytes of the formerly skipped files which the wanted pieces carried are in the files, nothing in the parts
+        layout = self.torrent.layout
+        for file_index, priority in enumerate(self.priorities):
+            if priority:
+                continue
+            start, length = layout.file_range(file_index)
+            with open(os.path.join(self.outdir, layout.paths[file_index]), 'rb') as f:
+                data = f.read()
+            for piece_idx in set(layout.file_pieces(file_index)) & set(self.wanted):
+                offset, piece_length = layout.piece_range(piece_idx)
+                begin, end = max(offset, start), min(offset + piece_length, start + length)
+                self.assertEqual(data[begin - start:end - start], self.synthetic.payload[begin:end])
+
+
+
+class WriteFailureTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Eight verified pieces, the disk refuses to write one of them
+    """
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.synthetic = SyntheticTorrent('failing', 1, 8 * 32 * 1024, 32 * 1024)
+        path = os.path.join(self.tmp.name, 'failing.torrent')
+        self.synthetic.write(path, 'http://127.0.0.1:1/announce')
+        self.torrent = Torrent(path)
+        self.outdir = os.path.join(self.tmp.name, 'downloads')
+        self.saver = FileSaver(self.outdir, self.torrent)
+        self.session = DownloadSession(self.torrent, self.saver.get_received_pieces_queue(), file_saver=self.saver)
+        self.saver.on_piece_written = self.session.on_piece_written
+        self.saver.on_piece_failed = self.session.on_piece_failed
+
+    async def asyncTearDown(self):
+        self.session.close()
+        self.saver.received_pieces_queue.put_nowait(None)
+        await self.saver.writing
+        self.saver.disk.close()
+        self.tmp.cleanup()
+
+    async def verify(self, pieces):
+        for piece_idx in pieces:
+            offset, length = self.torrent.layout.piece_range(piece_idx)
+            self.session.on_piece_verified(SimpleNamespace(
+                index=piece_idx, length=length, data=self.synthetic.payload[offset:offset + length],
+                flush=lambda: None
+            ))
+        # A piece nobody reports as written or failed stays unwritten forever
+        for _ in range(500):
+            if not self.session.unwritten:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(sorted(self.session.unwritten), [])
+
+    async def test_piece_failing_to_be_written_is_downloaded_again(self):
+        failing = 3 * 32 * 1024
+        pwrite_all = disk_io.pwrite_all
+
+        def full_disk(fd: int, data, offset: int):
+            if offset == failing:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            pwrite_all(fd, data, offset)
+
+        with mock.patch('disk_io.pwrite_all', full_disk):
+            await self.verify(range(8))
+
+        session = self.session
+        self.assertFalse(session.is_complete())
+        self.assertEqual(session.missing_pieces, 1)
+        self.assertEqual(session.left, 32 * 1024)
+        self.assertNotIn(3, session.received_pieces)
+        self.assertEqual(sorted(session.written_pieces), [0, 1, 2, 4, 5, 6, 7])
+        # Up for picking again, from any peer having it
+        have_pieces = bitstring.BitArray(length=8)
+        have_pieces.set(True)
+        session.picker.add_peer(have_pieces)
+        self.assertEqual(session.picker.pick(have_pieces), 3)
+
+        await self.verify([3])
+        self.assertTrue(session.is_complete())
+        self.assertEqual(len(session.written_pieces), 8)
+        self.assertTrue(self.synthetic.verify(self.outdir))
+
+
+if __name__ == '__main__':
+    unittest.main()
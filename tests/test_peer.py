@@ -0,0 +1,80 @@
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from bench import SyntheticTorrent
+from peer import Peer
+from pytor import DownloadSession
+from torrent import Torrent
+
+
+class BusyReader:
+    """
+    Stream with a keep alive always waiting, every read completes without suspending
+    """
+    async def read(self, n: int) -> bytes:
+        return b'\x00\x00\x00\x00'
+
+
+class NullWriter:
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+    async def drain(self):
+        pass
+
+
+class PeerShutdownTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        synthetic = SyntheticTorrent('shutdown', 1, 8 * 32 * 1024, 32 * 1024)
+        path = os.path.join(self.tmp.name, 'shutdown.torrent')
+        synthetic.write(path, 'http://127.0.0.1:1/announce')
+        self.session = DownloadSession(Torrent(path), asyncio.Queue())
+
+    async def asyncTearDown(self):
+        self.session.close()
+        self.tmp.cleanup()
+
+    async def test_cancel_while_reads_complete_at_once(self):
+        # The cancel lands while the read has completed already, wait_for hands back the data instead
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(20):
+                peer = Peer(self.session, '127.0.0.1', 1, BusyReader(), NullWriter())
+                running = asyncio.ensure_future(peer.run())
+                for _ in range(3):
+                    await asyncio.sleep(0)
+                running.cancel()
+                done, _ = await asyncio.wait([running], timeout=1)
+                if not done:
+                    peer.close()
+                    await asyncio.wait([running], timeout=1)
+                self.assertEqual(done, {running})
+
+    async def test_close_ends_a_pending_read(self):
+        accepted = asyncio.get_event_loop().create_future()
+        server = await asyncio.start_server(lambda reader, writer: accepted.set_result(writer), '127.0.0.1', 0)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+            remote = await accepted
+            peer = Peer(self.session, '127.0.0.1', 1, reader, writer)
+            running = asyncio.ensure_future(peer.run())
+            await asyncio.sleep(0.05)
+            self.assertFalse(running.done())
+            peer.close()
+            # The remote end is quiet, only closing the stream ends the read before CHECK_INTERVAL
+            await asyncio.wait_for(running, timeout=1)
+            remote.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import random
+import unittest
+
+import bitstring
+
+from piece_picker import PiecePicker, is_seed, set_bits
+
+
+class BitfieldTest(unittest.TestCase):
+    def test_set_bits_match_findall(self):
+        rand = random.Random(0)
+        for length in (1, 7, 8, 9, 1000, 100003):
+            have_pieces = bitstring.BitArray(length=length)
+            have_pieces.set(True, rand.sample(range(length), length // 3))
+            self.assertEqual(list(set_bits(have_pieces)), list(have_pieces.findall('0b1')))
+            have_pieces.set(True)
+            self.assertEqual(list(set_bits(have_pieces)), list(range(length)))
+
+    def test_peers_are_counted(self):
+        picker = PiecePicker(10)
+        have_pieces = bitstring.BitArray(length=10)
+        have_pieces.set(True, (1, 9))
+        picker.add_peer(have_pieces)
+        picker.add_peer(have_pieces)
+        picker.remove_peer(have_pieces)
+        self.assertEqual(list(picker.availability), [0, 1, 0, 0, 0, 0, 0, 0, 0, 1])
+        self.assertIn(picker.pick(have_pieces), (1, 9))
+
+    def test_is_seed(self):
+        for length in (1, 7, 8, 9, 100003):
+            have_pieces = bitstring.BitArray(length=length)
+            self.assertFalse(is_seed(have_pieces))
+            have_pieces.set(True)
+            self.assertTrue(is_seed(have_pieces))
+            for piece_idx in {0, length // 2, length - 1}:
+                have_pieces[piece_idx] = False
+                self.assertFalse(is_seed(have_pieces))
+                have_pieces[piece_idx] = True
+
+
+class SeedTest(unittest.TestCase):
+    """
+    Seeds are counted apart from the buckets, every piece moves up by one without being moved
+    """
+    def setUp(self):
+        self.picker = PiecePicker(10)
+        self.seed = bitstring.BitArray(length=10)
+        self.seed.set(True)
+        self.peer = bitstring.BitArray(length=10)
+        self.peer.set(True, range(1, 10))
+
+    def test_seeds_are_counted_once(self):
+        picker = self.picker
+        picker.add_peer(self.seed)
+        picker.add_peer(self.seed)
+        self.assertEqual(picker.seeds, 2)
+        self.assertEqual(list(picker.availability), [0] * 10)
+        self.assertEqual(picker.available(0), 2)
+        self.assertTrue(picker.has_wanted())
+
+        picker.remove_peer(self.seed)
+        picker.remove_peer(self.seed)
+        self.assertEqual(picker.seeds, 0)
+        self.assertFalse(picker.has_wanted())
+        self.assertIsNone(picker.pick(self.seed))
+
+    def test_rarest_first_with_seeds(self):
+        picker = self.picker
+        picker.add_peer(self.seed)
+        picker.add_peer(self.peer)
+        # Only the seed has piece 0, every other piece is on two peers
+        self.assertEqual(picker.pick(self.seed), 0)
+        self.assertIn(picker.pick(self.seed), range(1, 10))
+        picker.remove_peer(self.seed)
+        self.assertEqual(picker.available(5), 1)
+
+    def test_peer_completing_its_bitfield_becomes_a_seed(self):
+        picker = self.picker
+        picker.add_peer(self.peer)
+        self.peer[0] = True
+        picker.on_have(self.peer, 0)
+        self.assertEqual(picker.seeds, 1)
+        self.assertEqual(list(picker.availability), [0] * 10)
+
+        picker.remove_peer(self.peer)
+        self.assertEqual(picker.seeds, 0)
+        self.assertEqual(list(picker.availability), [0] * 10)
+
+    def test_have_from_another_peer(self):
+        picker = self.picker
+        have_pieces = bitstring.BitArray(length=10)
+        have_pieces[4] = True
+        picker.on_have(have_pieces, 4)
+        self.assertEqual(picker.seeds, 0)
+        self.assertEqual(picker.available(4), 1)
+        self.assertEqual(picker.pick(self.seed), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
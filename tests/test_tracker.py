@@ -0,0 +1,113 @@
+import asyncio
+import socket
+import struct
+import unittest
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from bench import FakeTracker
+from tracker import Announcer
+from udp_tracker import ACTION_ANNOUNCE, ACTION_CONNECT, UDPTrackerClient
+
+
+def fake_torrent(url: str):
+    return SimpleNamespace(info_hash=b'\x11' * 20, peer_id=b'-TEST-' + b'0' * 14, trackers=[url.encode()])
+
+
+class LossyUDPTracker(asyncio.DatagramProtocol):
+    """
+    UDP tracker stand-in dropping the responses to the first announces it receives
+    """
+    def __init__(self, drop: int = 1):
+        self.drop = drop
+        self.transport = None
+        self.announces = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        action, transaction_id = struct.unpack_from('>II', data, 8)
+        if action == ACTION_CONNECT:
+            self.transport.sendto(struct.pack('>IIQ', ACTION_CONNECT, transaction_id, 42), addr)
+        elif action == ACTION_ANNOUNCE:
+            self.announces += 1
+            if self.announces <= self.drop:
+                return
+            peers = socket.inet_aton('10.0.0.1') + struct.pack('>H', 6881)
+            self.transport.sendto(struct.pack('>IIIII', ACTION_ANNOUNCE, transaction_id, 900, 0, 1) + peers, addr)
+
+
+class UDPAnnounceTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tracker = LossyUDPTracker()
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self.tracker, local_addr=('127.0.0.1', 0)
+        )
+        self.url = 'udp://127.0.0.1:{}/announce'.format(self.transport.get_extra_info('sockname')[1])
+        self.udp = UDPTrackerClient()
+        self.udp.BASE_TIMEOUT = 0.2
+
+    async def asyncTearDown(self):
+        self.udp.close()
+        self.transport.close()
+
+    async def announce(self, announcer):
+        peers = []
+        async for found in announcer.announce(0, 0, 100):
+            peers.extend(found)
+        await announcer.close()
+        return peers
+
+    async def test_dropped_response_is_retransmitted(self):
+        # The HTTP timeout is shorter than the first retransmit, it must not cut the UDP backoff short
+        announcer = Announcer(fake_torrent(self.url), timeout=0.1, udp=self.udp)
+        peers = await self.announce(announcer)
+        self.assertEqual(self.tracker.announces, 2)
+        self.assertEqual(peers, [('10.0.0.1', 6881)])
+        self.assertEqual(announcer.trackers[0].interval, 900)
+
+    async def test_gives_up_after_the_retransmits(self):
+        self.tracker.drop = 10
+        announcer = Announcer(fake_torrent(self.url), udp=self.udp, udp_retransmits=1)
+        self.assertEqual(await self.announce(announcer), [])
+        self.assertGreaterEqual(self.tracker.announces, 2)
+        self.assertGreater(announcer.trackers[0].next_announce, 0)  # Retried later
+
+
+class HTTPAnnounceEventTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tracker = FakeTracker([('127.0.0.1', 6881)])
+        await self.tracker.start()
+        self.announcer = Announcer(fake_torrent(self.tracker.url))
+
+    async def asyncTearDown(self):
+        await self.announcer.close()
+        await self.tracker.close()
+
+    async def announce(self, left: int) -> list:
+        self.announcer.trackers[0].next_announce = 0
+        peers = []
+        async for found in self.announcer.announce(0, 0, left):
+            peers.extend(found)
+        return peers
+
+    def events(self) -> list:
+        return [parse_qs(query).get('event', [''])[0] for query in self.tracker.queries]
+
+    async def test_completed_during_the_session(self):
+        self.assertEqual(await self.announce(100), [('127.0.0.1', 6881)])
+        await self.announce(100)
+        await self.announce(0)
+        await self.announce(0)
+        self.assertEqual(self.events(), ['started', '', 'completed', ''])
+
+    async def test_complete_at_start(self):
+        # Resumed or seeding from the start, the swarm is never told about a completion it didn't see
+        await self.announce(0)
+        await self.announce(0)
+        self.assertEqual(self.events(), ['started', ''])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,13 @@
-import asyncio
 import math
 import os
 import random
-import socket
 import string
-import struct
 from hashlib import sha1
 from pprint import pformat
 
 import bencoding
-import requests
-from pybtracker import TrackerClient
+
+from file_layout import FileLayout
 
 
 # TODO Decode the whole thing to a map of python str
@@ -84,10 +81,13 @@ class Torrent:
 
         self.info_hash = sha1(bencoding.bencode(self.metaData[b'info'])).digest()
 
-        self.peers = []
-        # await self._get_peers()
+        self.layout = FileLayout(self)  # Byte ranges to file segments, shared by the writer and readers
 
-        # print(self.peers)
+        # Identifies this client to trackers and peers alike
+        self.peer_id = ('SA' + ''.join(
+            random.choice(string.ascii_lowercase + string.digits)
+            for _ in range(18)
+        )).encode()
 
     def get_piece_hash(self, piece_idx):
         """
@@ -120,78 +120,12 @@ class Torrent:
 
         return parsed_files, total_length, fractures
 
-    async def udp_tracker_client(self, url):
-        """
-        UDP Tracker client implementation
-        :param url: tracker url
-        :return: peers
+    @property
+    def trackers(self) -> list:
         """
-        client = TrackerClient(announce_uri=url)
-        await asyncio.wait_for(client.start(), timeout=10)
-        peers = await asyncio.wait_for(client.announce(
-            self.info_hash,  # infohash
-            0,  # downloaded
-            self._total_length,  # left
-            0,  # uploaded
-            0,  # event (0=none)
-            120  # number of peers wanted
-        ), timeout=10)
-        print("UDP TRACKER PEERS:", peers)
-        return peers
-
-    async def get_peers(self, numwant=100):
+        Announce URLs of every tier, flattened
         """
-        # TODO Separate out metadata parsing and HTTP client implementation
-        HTTP(S) Tracker client implementation
-        :param numwant: required number of peers
-        """
-        peer_id = 'SA' + ''.join(
-            random.choice(string.ascii_lowercase + string.digits)
-            for _ in range(18)
-            )
-        params = {
-            'info_hash': self.info_hash,
-            'peer_id': peer_id,
-            'port': 6881,
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': self._total_length,
-            'compact': 1,
-            'no_peer_id': 1,
-            'event': 'started',
-            'numwant': numwant
-            }
-        for url in self._trackers:
-            if b'udp' not in url:
-                try:
-                    print(url)
-                    r = requests.get(url, params=params, timeout=10)
-                except Exception as e:
-                    print("Exception occurred for {}\n{}".format(url, e))
-                    continue
-                resp = bencoding.bdecode(r.content)
-                print(r.status_code, r.reason)
-                peers = resp[b'peers']
-                start = 0
-
-                if isinstance(peers, list):
-                    self.peers = peers
-                elif len(peers) % 6 == 0:
-                    while start < len(peers):
-                        ip = peers[start:start+4]
-                        ip = socket.inet_ntoa(ip)
-                        port = peers[start+4:start+6]
-                        port, = struct.unpack('!H', port)
-                        self.peers.append((ip, port))
-                        start += 6
-            else:
-                try:
-                    print(url)
-                    udp_peers = await self.udp_tracker_client(url.decode())
-                    self.peers.extend(udp_peers)
-                except Exception as e:
-                    print("Exception occurred for {}\n{}".format(url, e))
-                    continue
+        return self._trackers
 
     def __str__(self):
         return pformat(self.metaData)
@@ -0,0 +1,209 @@
+import asyncio
+import time
+from urllib.parse import quote_from_bytes, urlencode
+
+import aiohttp
+import bencoding
+import yarl
+
+from udp_tracker import UDPTrackerClient, parse_compact_peers
+
+
+class Tracker:
+    """
+    Announce schedule of a single tracker, honoring the interval and min interval it asks for
+    """
+    DEFAULT_INTERVAL = 1800
+    DEFAULT_MIN_INTERVAL = 60
+    RETRY_INTERVAL = 300  # Seconds before a failing tracker is tried again
+
+    def __init__(self, url: str):
+        self.url = url
+        self.interval = self.DEFAULT_INTERVAL
+        self.min_interval = self.DEFAULT_MIN_INTERVAL
+        self.last_announce = None
+        self.next_announce = 0
+        self.started = False  # True once the 'started' event went through
+        self.completed = False  # True once the 'completed' event went through
+        self.incomplete = False  # True once announced with bytes left, only then is completing an event
+
+    def is_due(self, starving: bool = False) -> bool:
+        """
+        True when the tracker's interval has passed, or its min interval when more peers are needed right away
+        """
+        now = time.monotonic()
+        if now >= self.next_announce:
+            return True
+        return starving and self.last_announce is not None and now - self.last_announce >= self.min_interval
+
+    def on_announce(self, interval=None, min_interval=None):
+        self.last_announce = time.monotonic()
+        if interval:
+            self.interval = interval
+        if min_interval:
+            self.min_interval = min_interval
+        self.next_announce = self.last_announce + self.interval
+
+    def on_failure(self):
+        self.last_announce = time.monotonic()
+        self.next_announce = self.last_announce + self.RETRY_INTERVAL
+
+    def event(self, left: int) -> str:
+        """
+        Event of the next announce, 'completed' only for a download which completed while we were announcing it
+        """
+        if left:
+            self.incomplete = True
+        if not self.started:
+            return 'started'
+        if not left and self.incomplete and not self.completed:
+            return 'completed'
+        return ''
+
+    async def announce(self, announcer, uploaded: int, downloaded: int, left: int, numwant: int) -> list:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '[Tracker {}]'.format(self.url)
+
+
+class HTTPTracker(Tracker):
+    """
+    HTTP(S) tracker client
+    """
+    async def announce(self, announcer, uploaded: int, downloaded: int, left: int, numwant: int) -> list:
+        """
+        Announces to the tracker
+        :return: list of (host, port)
+        """
+        event = self.event(left)
+        params = {
+            'port': announcer.port,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
+            'compact': 1,
+            'no_peer_id': 1,
+            'numwant': numwant,
+        }
+        if event:
+            params['event'] = event
+        # Binary info hash and peer id are percent encoded by hand, the query is passed on already encoded
+        query = 'info_hash={}&peer_id={}&{}'.format(
+            quote_from_bytes(announcer.info_hash), quote_from_bytes(announcer.peer_id), urlencode(params)
+        )
+        url = yarl.URL('{}{}{}'.format(self.url, '&' if '?' in self.url else '?', query), encoded=True)
+
+        async with announcer.http.get(url, timeout=aiohttp.ClientTimeout(total=announcer.timeout)) as r:
+            content = await r.read()
+            print(self.url, r.status, r.reason)
+
+        resp = bencoding.bdecode(content)
+        if b'failure reason' in resp:
+            raise ValueError(resp[b'failure reason'].decode(errors='replace'))
+
+        self.on_announce(resp.get(b'interval'), resp.get(b'min interval'))
+        if event == 'started':
+            self.started = True
+        elif event == 'completed':
+            self.completed = True
+
+        peers = resp.get(b'peers', b'')
+        if isinstance(peers, list):
+            return [(peer[b'ip'].decode(), peer[b'port']) for peer in peers]
+        return parse_compact_peers(peers)
+
+
+class UDPTracker(Tracker):
+    """
+    UDP tracker, announced to through the announcer's shared UDP client
+    """
+    EVENTS = {'': 0, 'completed': 1, 'started': 2}
+
+    async def announce(self, announcer, uploaded: int, downloaded: int, left: int, numwant: int) -> list:
+        """
+        Announces to the tracker
+        :return: list of (host, port)
+        """
+        event = self.event(left)
+        # The client retransmits on its own backoff, the deadline only bounds how many times
+        interval, peers = await asyncio.wait_for(announcer.udp.announce(
+            self.url, announcer.info_hash, announcer.peer_id, downloaded, left, uploaded, self.EVENTS[event],
+            numwant, announcer.port
+        ), timeout=announcer.udp.deadline(announcer.udp_retransmits))
+        print("UDP TRACKER PEERS:", self.url, len(peers))
+        self.on_announce(interval)
+        if event == 'started':
+            self.started = True
+        elif event == 'completed':
+            self.completed = True
+        return peers
+
+
+class Announcer:
+    """
+    Announces a torrent to all of its trackers at once, each with its own timeout and schedule
+    The UDP client and the HTTP session can be shared between the announcers of several torrents
+    """
+    def __init__(self, torrent, port: int = 6881, timeout: float = 10, udp: UDPTrackerClient = None,
+                 http: aiohttp.ClientSession = None, udp_retransmits: int = 2):
+        self.info_hash = torrent.info_hash
+        self.peer_id = torrent.peer_id
+        self.port = port
+        self.timeout = timeout  # Of HTTP announces
+        self.udp_retransmits = udp_retransmits  # Of each UDP request before the tracker counts as failed
+        self.trackers = [
+            UDPTracker(url.decode()) if url.startswith(b'udp') else HTTPTracker(url.decode())
+            for url in torrent.trackers
+        ]
+        self.own_http = http is None
+        self.http = http  # aiohttp session shared by every HTTP announce, created on the first one
+        self.own_udp = udp is None
+        self.udp = udp or UDPTrackerClient()
+
+    def is_due(self, starving: bool = False) -> bool:
+        """
+        True when at least one tracker may be announced to
+        """
+        return any(tracker.is_due(starving) for tracker in self.trackers)
+
+    async def _announce(self, tracker, *stats):
+        try:
+            return await tracker.announce(self, *stats)
+        except Exception as e:
+            print("Exception occurred for {}\n{}".format(tracker.url, e))
+            tracker.on_failure()
+            return []
+
+    async def announce(self, uploaded: int, downloaded: int, left: int, numwant: int = 100, starving: bool = False):
+        """
+        Announces to every tracker which is due, concurrently
+        Asynchronous generator of peer lists, each one yielded as soon as its tracker answers
+        :param uploaded: bytes uploaded so far
+        :param downloaded: bytes downloaded so far
+        :param left: bytes left to download
+        :param numwant: number of peers wanted
+        :param starving: announce to trackers past their min interval as well
+        """
+        if self.http is None:
+            self.http = aiohttp.ClientSession()
+
+        tasks = [
+            asyncio.ensure_future(self._announce(tracker, uploaded, downloaded, left, numwant))
+            for tracker in self.trackers if tracker.is_due(starving)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                peers = await next_done
+                if peers:
+                    yield peers
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def close(self):
+        if self.own_http and self.http is not None:
+            await self.http.close()
+            self.http = None
+        if self.own_udp:
+            self.udp.close()
@@ -0,0 +1,194 @@
+import asyncio
+import random
+import socket
+import struct
+import time
+from urllib.parse import urlsplit
+
+PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_ERROR = 3
+
+
+def parse_compact_peers(peers: bytes) -> list:
+    """
+    Decodes a compact peer list, 6 bytes per peer: IPv4 address and port
+    :return: list of (host, port)
+    """
+    return [
+        (socket.inet_ntoa(peers[start:start + 4]), struct.unpack('!H', peers[start + 4:start + 6])[0])
+        for start in range(0, len(peers) - len(peers) % 6, 6)
+    ]
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram endpoint shared by every UDP tracker request, responses are matched to requests by transaction id
+    """
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # Transaction id -> future of the response
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        transaction_id, = struct.unpack_from('>I', data, 4)
+        future = self.pending.pop(transaction_id, None)
+        if future and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP errors can't be told apart per request, the requests time out and get retransmitted
+        pass
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('UDP tracker socket closed'))
+        self.pending.clear()
+
+
+class UDPTrackerClient:
+    """
+    BEP 15 UDP tracker client multiplexing any number of trackers and torrents over a single socket
+    Connection ids are cached for their 60 s lifetime, so an announce usually costs one round trip, and requests are
+    retransmitted after 15 * 2 ^ n seconds as the spec asks
+    """
+    CONNECTION_ID_LIFETIME = 60
+    BASE_TIMEOUT = 15
+
+    def __init__(self, max_retries: int = 8):
+        self.max_retries = max_retries
+        self.protocol = None
+        self.starting = None
+        self.connection_ids = {}  # (ip, port) -> (connection id, expiry time)
+        self.connecting = {}  # (ip, port) -> future of the connect in flight, shared by concurrent announces
+        self.addresses = {}  # (host, port) from the URL -> resolved (ip, port)
+
+    async def start(self):
+        """
+        Opens the shared socket, concurrent callers wait for the same endpoint
+        """
+        if self.protocol is None:
+            self.protocol = UDPTrackerProtocol()
+            self.starting = asyncio.ensure_future(asyncio.get_event_loop().create_datagram_endpoint(
+                lambda: self.protocol, local_addr=('0.0.0.0', 0)
+            ))
+        await asyncio.shield(self.starting)
+
+    async def resolve(self, url: str) -> tuple:
+        """
+        IPv4 address of a udp:// tracker URL, resolved once
+        """
+        parts = urlsplit(url)
+        key = (parts.hostname, parts.port)
+        if key not in self.addresses:
+            infos = await asyncio.get_event_loop().getaddrinfo(
+                parts.hostname, parts.port, family=socket.AF_INET, type=socket.SOCK_DGRAM
+            )
+            self.addresses[key] = infos[0][4]
+        return self.addresses[key]
+
+    async def _request(self, addr: tuple, build, timeout: float) -> bytes:
+        """
+        Sends one request and waits for its response
+        :param build: callable building the request from a transaction id
+        """
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self.protocol.pending:
+            transaction_id = random.getrandbits(32)
+        future = asyncio.get_event_loop().create_future()
+        self.protocol.pending[transaction_id] = future
+        try:
+            self.protocol.transport.sendto(build(transaction_id), addr)
+            data = await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            self.protocol.pending.pop(transaction_id, None)
+
+        action, = struct.unpack_from('>I', data)
+        if action == ACTION_ERROR:
+            raise ValueError(data[8:].decode(errors='replace'))
+        return data
+
+    async def _connect(self, addr: tuple) -> int:
+        for attempt in range(self.max_retries + 1):
+            try:
+                data = await self._request(
+                    addr,
+                    lambda transaction_id: struct.pack('>QII', PROTOCOL_ID, ACTION_CONNECT, transaction_id),
+                    self.BASE_TIMEOUT * 2 ** attempt
+                )
+            except asyncio.TimeoutError:
+                continue
+            if len(data) < 16:
+                raise ValueError('Short connect response from {}'.format(addr))
+            connection_id, = struct.unpack_from('>Q', data, 8)
+            self.connection_ids[addr] = (connection_id, time.monotonic() + self.CONNECTION_ID_LIFETIME)
+            return connection_id
+        raise asyncio.TimeoutError()
+
+    async def connection_id(self, addr: tuple) -> int:
+        """
+        Cached connection id of a tracker, connecting when it is missing or expired
+        """
+        cached = self.connection_ids.get(addr)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        if addr not in self.connecting:
+            self.connecting[addr] = asyncio.ensure_future(self._connect(addr))
+        try:
+            return await asyncio.shield(self.connecting[addr])
+        finally:
+            if addr in self.connecting and self.connecting[addr].done():
+                del self.connecting[addr]
+
+    async def announce(self, url: str, info_hash: bytes, peer_id: bytes, downloaded: int, left: int, uploaded: int,
+                       event: int, numwant: int, port: int) -> tuple:
+        """
+        Announces a torrent to a UDP tracker
+        :param event: 0 none, 1 completed, 2 started, 3 stopped
+        :return: interval and list of (host, port)
+        """
+        await self.start()
+        addr = await self.resolve(url)
+        key = random.getrandbits(32)
+
+        for attempt in range(self.max_retries + 1):
+            connection_id = await self.connection_id(addr)
+            try:
+                data = await self._request(
+                    addr,
+                    lambda transaction_id: struct.pack(
+                        '>QII20s20sQQQIIIiH', connection_id, ACTION_ANNOUNCE, transaction_id, info_hash, peer_id,
+                        downloaded, left, uploaded, event, 0, key, numwant, port
+                    ),
+                    self.BASE_TIMEOUT * 2 ** attempt
+                )
+            except asyncio.TimeoutError:
+                continue
+            except ValueError:
+                # The connection id may have been refused, the next announce connects again
+                self.connection_ids.pop(addr, None)
+                raise
+
+            if len(data) < 20:
+                raise ValueError('Short announce response from {}'.format(url))
+            interval, = struct.unpack_from('>I', data, 8)
+            return interval, parse_compact_peers(data[20:])
+        raise asyncio.TimeoutError()
+
+    def deadline(self, retransmits: int) -> float:
+        """
+        Seconds an announce may take for its connect and announce requests to be retransmitted that many times each
+        """
+        return 2 * self.BASE_TIMEOUT * (2 ** (retransmits + 1) - 1)
+
+    def close(self):
+        if self.protocol and self.protocol.transport:
+            self.protocol.transport.close()
+        self.protocol = None